@@ -0,0 +1,283 @@
+"""
+Remote deploy agent answering JSON-RPC requests over one SSH channel.
+
+django_prod_deploy starts this module on the server with `python3 -c` once per
+deploy and keeps the channel open, so hashing, writing and removing files,
+applying deltas and running commands no longer cost a channel and a shell each.
+
+Each message is one JSON-RPC 2.0 object on a line. A message with an
+"attachment" member is followed by that many raw bytes (file contents, deltas),
+so binary data is never base64-encoded. Output of running commands comes back
+as "output" notifications carrying the id of the request.
+
+Like delta.py, this module runs on the server's own python3 (see
+remote.module_source). The delta module source is passed as the first argument
+and loaded next to it.
+"""
+from __future__ import annotations
+
+import codecs
+import hashlib
+import io
+import json
+import os
+import signal
+import stat
+import subprocess
+import sys
+import threading
+import time
+import types
+
+READ_SIZE = 32768
+
+# Requests handled in order on the reading thread: pieces of a file must be written in sequence
+ORDERED_METHODS = ("write_files", "remove_files")
+
+
+def encode_message(message: dict, attachment: bytes = b"") -> bytes:
+    if attachment:
+        message = dict(message, attachment=len(attachment))
+    return json.dumps(message, separators=(",", ":")).encode() + b"\n" + attachment
+
+
+def read_message(stream):
+    """Return (message, attachment) read from a binary stream, or (None, b"") at EOF."""
+    line = stream.readline()
+    if not line:
+        return None, b""
+    message = json.loads(line)
+    size = message.get("attachment", 0)
+    attachment = b""
+    while len(attachment) < size:
+        chunk = stream.read(size - len(attachment))
+        if not chunk:
+            raise EOFError("Truncated attachment")
+        attachment += chunk
+    return message, attachment
+
+
+class RpcError(Exception):
+    def __init__(self, message: str, code: int = -32000):
+        super().__init__(message)
+        self.code = code
+
+
+class Agent:
+    """Serve requests read from `stdin` and write responses to `stdout` until EOF or shutdown."""
+
+    def __init__(self, stdin, stdout, delta=None):
+        self.stdin = stdin
+        self.stdout = stdout
+        self.delta = delta
+        self.write_lock = threading.Lock()
+        self.processes = set()
+        self.started = time.time()
+        self.counters = {"requests": 0, "bytes_received": 0, "bytes_written": 0, "commands": 0}
+
+    def send(self, message: dict, attachment: bytes = b""):
+        data = encode_message(dict(message, jsonrpc="2.0"), attachment)
+        with self.write_lock:
+            self.stdout.write(data)
+            self.stdout.flush()
+
+    def serve(self):
+        try:
+            while True:
+                message, attachment = read_message(self.stdin)
+                if message is None:
+                    break
+                self.counters["requests"] += 1
+                self.counters["bytes_received"] += len(attachment)
+                if message.get("method") == "shutdown":
+                    self.send({"id": message.get("id"), "result": True})
+                    break
+                if message.get("method") in ORDERED_METHODS:
+                    self.dispatch(message, attachment)
+                else:
+                    threading.Thread(target=self.dispatch, args=(message, attachment), daemon=True).start()
+        finally:
+            for process in list(self.processes):
+                _kill(process)
+
+    def dispatch(self, message: dict, attachment: bytes):
+        request_id = message.get("id")
+        handler = getattr(self, "rpc_" + str(message.get("method")), None)
+        try:
+            if handler is None:
+                raise RpcError("Method not found: %s" % message.get("method"), -32601)
+            result = handler(request_id, attachment, **message.get("params", {}))
+        except RpcError as e:
+            self.send({"id": request_id, "error": {"code": e.code, "message": str(e)}})
+        except Exception as e:
+            self.send({"id": request_id, "error": {"code": -32000, "message": "%s: %s" % (type(e).__name__, e)}})
+        else:
+            if isinstance(result, bytes):
+                # File contents go back as an attachment, the result is their size
+                self.send({"id": request_id, "result": len(result)}, result)
+            else:
+                self.send({"id": request_id, "result": result})
+
+    def rpc_ping(self, request_id, attachment):
+        return {"pid": os.getpid(), "python": sys.version.split()[0]}
+
+    def rpc_stats(self, request_id, attachment):
+        return dict(self.counters, uptime=round(time.time() - self.started, 3))
+
+    def rpc_stat(self, request_id, attachment, root: str, paths: list):
+        """Sizes of the regular files among `paths` below `root`; missing files are left out."""
+        sizes = {}
+        for path in paths:
+            try:
+                st = os.stat(os.path.join(root, path))
+            except OSError:
+                continue
+            if stat.S_ISREG(st.st_mode):
+                sizes[path] = st.st_size
+        return sizes
+
+    def rpc_hash_files(self, request_id, attachment, root: str, paths: list, digest_size: int = 32):
+        """BLAKE2b digests of files below `root` (None for unreadable files)."""
+        digests = {}
+        for path in paths:
+            digest = hashlib.blake2b(digest_size=digest_size)
+            try:
+                with open(os.path.join(root, path), "rb") as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                        digest.update(chunk)
+            except OSError:
+                digests[path] = None
+                continue
+            digests[path] = digest.hexdigest()
+        return digests
+
+    def rpc_write_files(self, request_id, attachment, root: str, pieces: list):
+        """
+        Write pieces of files from the attachment, in order.
+
+        Each piece is [relative path, offset, length, total size, mode]. A file is written
+        to a temporary name and renamed over the target once its last piece arrived, so
+        hardlinks to the previous release are replaced rather than modified.
+        """
+        position = 0
+        completed = []
+        for path, offset, length, total, mode in pieces:
+            target = os.path.join(root, path)
+            tmp_path = target + ".django_prod_part"
+            directory = os.path.dirname(target)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(tmp_path, "r+b" if offset else "wb") as f:
+                f.seek(offset)
+                f.write(attachment[position:position + length])
+                f.truncate()
+            position += length
+            self.counters["bytes_written"] += length
+            if offset + length >= total:
+                os.chmod(tmp_path, mode & 0o7777)
+                os.replace(tmp_path, target)
+                completed.append(path)
+        return {"completed": completed}
+
+    def rpc_read_file(self, request_id, attachment, path: str):
+        """Contents of a file, or None when it does not exist."""
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def rpc_remove_files(self, request_id, attachment, root: str, paths: list):
+        removed = 0
+        for path in paths:
+            try:
+                os.unlink(os.path.join(root, path))
+                removed += 1
+            except FileNotFoundError:
+                pass
+        return {"removed": removed}
+
+    def rpc_signatures(self, request_id, attachment, block_sizes: dict):
+        """Delta signatures of remote files, as `delta.py sig` computes them."""
+        self._require_delta()
+        signatures = {}
+        for path, block_size in block_sizes.items():
+            try:
+                signatures[path] = self.delta.file_signature(path, block_size)
+            except OSError:
+                signatures[path] = None
+        return signatures
+
+    def rpc_apply_delta(self, request_id, attachment, path: str, block_size: int, sha256: str):
+        self._require_delta()
+        try:
+            self.delta.apply_patch(path, block_size, sha256, io.BytesIO(attachment))
+        except ValueError as e:
+            raise RpcError(str(e))
+        return True
+
+    def rpc_run(self, request_id, attachment, command: str, timeout: float = 120):
+        """Run a command with /bin/sh, streaming its output as notifications until it exits."""
+        self.counters["commands"] += 1
+        # Deploy commands are written for sh, whatever the login shell of the user is
+        process = subprocess.Popen(
+            ["/bin/sh", "-c", command],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            start_new_session=True,
+        )
+        self.processes.add(process)
+        readers = [
+            threading.Thread(target=self._stream, args=(request_id, name, pipe), daemon=True)
+            for name, pipe in (("stdout", process.stdout), ("stderr", process.stderr))
+        ]
+        for reader in readers:
+            reader.start()
+        timed_out = False
+        try:
+            process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            timed_out = True
+            _kill(process)
+            process.wait()
+        finally:
+            self.processes.discard(process)
+        for reader in readers:
+            reader.join()
+        return {"exit_code": process.returncode, "timed_out": timed_out}
+
+    def _stream(self, request_id, name: str, pipe):
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        while True:
+            data = os.read(pipe.fileno(), READ_SIZE)
+            text = decoder.decode(data, final=not data)
+            if text:
+                self.send({"method": "output", "params": {"id": request_id, "stream": name, "data": text}})
+            if not data:
+                break
+        pipe.close()
+
+    def _require_delta(self):
+        if self.delta is None:
+            raise RpcError("The delta module was not loaded")
+
+
+def _kill(process):
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+def main(argv: list) -> int:
+    delta = None
+    if argv:
+        delta = types.ModuleType("delta")
+        exec(compile(argv[0], "delta.py", "exec"), delta.__dict__)
+    Agent(sys.stdin.buffer, sys.stdout.buffer, delta).serve()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,297 @@
+"""
+Pluggable transport backends for the upload step of django_prod_deploy.
+
+Every backend uploads a list of files into a remote directory and reports how
+many bytes it sent and how long it took, so the deploy command can remember
+which backend is fastest for each host and pick it automatically.
+"""
+import re
+import shlex
+import shutil
+import subprocess
+import time
+from pathlib import Path
+
+import paramiko
+from scp import SCPClient, SCPException
+
+from .connection import transfer_error
+from .exceptions import ConnectionLost, DeploymentError
+from .transfer import (
+    detect_archive_compression,
+    make_remote_dirs,
+    remove_remote_files,
+    sftp_upload,
+    stream_tar_archive,
+)
+
+
+class TransferStats:
+    """Outcome of one upload: payload size, bytes on the wire and wall time."""
+
+    def __init__(self, backend: str, files: int, payload_bytes: int, bytes_sent: int, seconds: float):
+        self.backend = backend
+        self.files = files
+        self.payload_bytes = payload_bytes
+        self.bytes_sent = bytes_sent
+        self.seconds = seconds
+
+    @property
+    def rate(self) -> float:
+        """Effective throughput in payload bytes per second."""
+        return self.payload_bytes / max(self.seconds, 1e-6)
+
+
+class TransportBackend:
+    """Base class for upload backends."""
+
+    name = ""
+    # Backends that transfer only the changed parts of files themselves
+    handles_deltas = False
+
+    def __init__(
+        self,
+        ssh: paramiko.SSHClient,
+        remote_dir: str,
+        *,
+        local_root: Path,
+        host: str,
+        user: str,
+        key_path: str,
+        jobs: int = 4,
+        checkpoint=None,
+        remote=None,
+        agent=None,
+        log=None,
+    ):
+        self.ssh = ssh
+        self.remote_dir = remote_dir
+        self.local_root = local_root
+        self.host = host
+        self.user = user
+        self.key_path = key_path
+        self.jobs = jobs
+        self.checkpoint = checkpoint
+        # RemoteEnvironment snapshot, so availability checks do not query the server again
+        self.remote = remote
+        # RemoteAgent running on the server, when it could be started
+        self.agent = agent
+        self.log = log or (lambda message: None)
+
+    def available(self) -> bool:
+        raise NotImplementedError
+
+    def upload(self, files: list[tuple[Path, Path]]) -> int:
+        """Upload files into `remote_dir`, returning the number of bytes sent."""
+        raise NotImplementedError
+
+    def run(self, files: list[tuple[Path, Path]]) -> TransferStats:
+        payload_bytes = sum(local_path.stat().st_size for local_path, _ in files)
+        start = time.perf_counter()
+        bytes_sent = self.upload(files)
+        return TransferStats(self.name, len(files), payload_bytes, bytes_sent, time.perf_counter() - start)
+
+    def _progress(self, verb: str, every: int):
+        def progress(done, total):
+            if done % every == 0 or done == total:
+                self.log(f"{verb} {done}/{total} files...")
+
+        return progress
+
+    def _unlink_targets(self, files: list[tuple[Path, Path]]):
+        # Writing in place would also modify the previous release through its hardlinks
+        remove_remote_files(self.ssh, self.remote_dir, [relative_path.as_posix() for _, relative_path in files])
+
+
+# rsync exit codes of a connection that failed or dropped: socket I/O, protocol stream,
+# timeouts and ssh itself (255)
+RSYNC_CONNECTION_ERRORS = (10, 12, 30, 35, 255)
+
+
+class RsyncBackend(TransportBackend):
+    """Native rsync over OpenSSH with the deploy key; rsync sends only changed blocks itself."""
+
+    name = "rsync"
+    handles_deltas = True
+
+    def available(self) -> bool:
+        if not shutil.which("rsync") or not shutil.which("ssh"):
+            return False
+        if self.remote is not None:
+            return self.remote.rsync
+        _, stdout, _ = self.ssh.exec_command("command -v rsync", timeout=30)
+        return stdout.channel.recv_exit_status() == 0
+
+    def upload(self, files: list[tuple[Path, Path]]) -> int:
+        ssh_cmd = (
+            f"ssh -i {shlex.quote(self.key_path)} -o BatchMode=yes -o StrictHostKeyChecking=accept-new"
+        )
+        cmd = [
+            "rsync",
+            "-az",
+            "--stats",
+            "--files-from=-",
+            "-e",
+            ssh_cmd,
+            f"{self.local_root}/",
+            f"{self.user}@{self.host}:{self.remote_dir}/",
+        ]
+        file_list = "\n".join(relative_path.as_posix() for _, relative_path in files) + "\n"
+        self.log(f"Syncing {len(files)} files with rsync...")
+        result = subprocess.run(cmd, input=file_list, capture_output=True, text=True)
+        if result.returncode != 0:
+            message = f"rsync failed (exit code {result.returncode}): {result.stderr.strip()}"
+            if result.returncode in RSYNC_CONNECTION_ERRORS:
+                raise ConnectionLost(message)
+            raise DeploymentError(message)
+
+        if self.checkpoint:
+            for _, relative_path in files:
+                self.checkpoint.file_done(relative_path.as_posix())
+        match = re.search(r"Total bytes sent: ([\d,.]+)", result.stdout)
+        return int(re.sub(r"[,.]", "", match.group(1))) if match else 0
+
+
+class TarBackend(TransportBackend):
+    """One compressed tar stream over a single channel, unpacked by the remote tar."""
+
+    name = "tar"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.compression = None
+
+    def available(self) -> bool:
+        self.compression = detect_archive_compression(self.ssh, self.remote)
+        return self.compression is not None
+
+    def upload(self, files: list[tuple[Path, Path]]) -> int:
+        self.log(f"Streaming {len(files)} files as a {self.compression} archive...")
+        return stream_tar_archive(
+            self.ssh,
+            files,
+            self.remote_dir,
+            self.compression,
+            self._progress("Archived", 100),
+            checkpoint=self.checkpoint,
+        )
+
+
+class SftpBackend(TransportBackend):
+    """Parallel pipelined SFTP sessions sharing the SSH transport."""
+
+    name = "sftp"
+
+    def available(self) -> bool:
+        try:
+            paramiko.SFTPClient.from_transport(self.ssh.get_transport()).close()
+        except paramiko.SSHException:
+            return False
+        return True
+
+    def upload(self, files: list[tuple[Path, Path]], offsets: dict[str, int] | None = None) -> int:
+        if not offsets:
+            self._unlink_targets(files)
+        self.log(f"Uploading {len(files)} files over {self.jobs} SFTP sessions...")
+        return sftp_upload(
+            self.ssh,
+            files,
+            self.remote_dir,
+            self.jobs,
+            self._progress("Uploaded", 10),
+            checkpoint=self.checkpoint,
+            offsets=offsets,
+        )
+
+
+class ScpBackend(TransportBackend):
+    """One SCP transfer per file; the slowest option, kept as the last resort."""
+
+    name = "scp"
+
+    def available(self) -> bool:
+        return True
+
+    def upload(self, files: list[tuple[Path, Path]]) -> int:
+        # Create all necessary directories first
+        make_remote_dirs(self.ssh, self.remote_dir, files)
+        self._unlink_targets(files)
+
+        progress = self._progress("Uploaded", 10)
+        bytes_sent = 0
+        with SCPClient(self.ssh.get_transport()) as scp:
+            for i, (local_path, relative_path) in enumerate(files, 1):
+                try:
+                    scp.put(str(local_path), remote_path=f"{self.remote_dir}/{relative_path.as_posix()}")
+                except (SCPException, OSError, paramiko.SSHException) as e:
+                    raise transfer_error(self.ssh.get_transport(), f"Failed to upload {relative_path}: {e}") from e
+                bytes_sent += local_path.stat().st_size
+                if self.checkpoint:
+                    self.checkpoint.file_done(relative_path.as_posix())
+                progress(i, len(files))
+        return bytes_sent
+
+
+class AgentBackend(TransportBackend):
+    """Batches of files written by the remote agent, pipelined over its single channel."""
+
+    name = "agent"
+
+    def available(self) -> bool:
+        return self.agent is not None and not self.agent.closed
+
+    def upload(self, files: list[tuple[Path, Path]]) -> int:
+        self.log(f"Writing {len(files)} files through the remote agent...")
+        progress = self._progress("Uploaded", 100)
+        done = 0
+
+        def file_done(path: str):
+            nonlocal done
+            done += 1
+            if self.checkpoint:
+                self.checkpoint.file_done(path)
+            progress(done, len(files))
+
+        return self.agent.write_files(self.remote_dir, files, file_done)
+
+
+# In order of preference when nothing has been measured for a host yet
+BACKENDS = {
+    backend.name: backend for backend in (RsyncBackend, TarBackend, AgentBackend, SftpBackend, ScpBackend)
+}
+
+# Backends tried automatically; SCP is only used when none of them is available
+AUTO_BACKENDS = ("rsync", "tar", "agent", "sftp")
+
+# Uploads smaller than this are too short to say anything about a backend's speed
+MIN_MEASURED_BYTES = 1024 * 1024
+
+
+def record_stats(history: dict, stats: TransferStats) -> dict:
+    """Fold a measurement into the per-backend history as a moving average."""
+    if stats.payload_bytes < MIN_MEASURED_BYTES:
+        return history
+    previous = history.get(stats.backend, {}).get("rate")
+    rate = stats.rate if previous is None else (previous + stats.rate) / 2
+    history[stats.backend] = {"rate": rate, "bytes_sent": stats.bytes_sent, "seconds": round(stats.seconds, 3)}
+    return history
+
+
+def choose_backend(backends: dict[str, TransportBackend], history: dict, payload_bytes: int) -> TransportBackend:
+    """
+    Pick the backend for an automatic upload of `payload_bytes`.
+
+    Each available backend is tried once before the fastest measured one is used for good.
+    Only uploads large enough to be measured try an unmeasured backend; smaller ones use
+    the fastest measured backend, or the first available one in order of preference.
+    """
+    available = [backends[name] for name in AUTO_BACKENDS if backends[name].available()]
+    if not available:
+        return backends["scp"]
+    unmeasured = [backend for backend in available if backend.name not in history]
+    if unmeasured and payload_bytes >= MIN_MEASURED_BYTES:
+        return unmeasured[0]
+    measured = [backend for backend in available if backend.name in history]
+    if not measured:
+        return available[0]
+    return max(measured, key=lambda backend: history[backend.name]["rate"])
@@ -0,0 +1,120 @@
+"""
+Keeping the SSH connection of a deploy alive across network blips.
+
+Keepalives are sent on the transport and must be answered by the server. When
+several in a row go unanswered the transport is closed, so every channel waiting
+on it fails at once instead of hanging until TCP gives up. The deploy then
+reconnects with backoff and retries the steps that are safe to run again.
+"""
+import errno
+import threading
+import time
+
+import paramiko
+
+from .exceptions import ConnectionLost, DeploymentError
+
+KEEPALIVE_INTERVAL = 15
+
+# Unanswered keepalive intervals after which the transport is considered dead
+KEEPALIVE_MISSES = 3
+
+# Seconds waited before each reconnection attempt
+RECONNECT_DELAYS = (1, 2, 4, 8, 16, 30)
+
+# Errors of the network or the SSH session; socket.timeout is TimeoutError
+CONNECTION_ERRORS = (ConnectionLost, ConnectionError, TimeoutError, paramiko.SSHException, EOFError)
+NETWORK_ERRNOS = {errno.ENETDOWN, errno.ENETUNREACH, errno.EHOSTDOWN, errno.EHOSTUNREACH, errno.ENOTCONN}
+
+
+def is_connection_error(error: BaseException) -> bool:
+    """
+    Whether `error` means the connection dropped, as opposed to a failing command.
+
+    Errors raised `from` another error are judged by their causes too, so an upload
+    failure wrapping a closed socket still counts. Other OSErrors, such as a local file
+    that went missing, are not connection errors.
+    """
+    while error is not None:
+        if isinstance(error, paramiko.AuthenticationException):
+            return False
+        if isinstance(error, CONNECTION_ERRORS) or getattr(error, "errno", None) in NETWORK_ERRNOS:
+            return True
+        error = error.__cause__
+    return False
+
+
+def transport_lost(ssh: paramiko.SSHClient) -> bool:
+    """Whether the connection of `ssh` is gone, whatever error the step failed with."""
+    transport = ssh.get_transport()
+    return transport is None or not transport.is_active()
+
+
+def transfer_error(transport, message: str) -> DeploymentError:
+    """The error for a failed transfer: ConnectionLost when the connection is gone, so the step is retried."""
+    if transport is None or not transport.is_active():
+        return ConnectionLost(message)
+    return DeploymentError(message)
+
+
+class KeepaliveMonitor:
+    """Send keepalives on a transport and close it once the server stops answering them."""
+
+    def __init__(
+        self,
+        transport: paramiko.Transport,
+        interval: float = KEEPALIVE_INTERVAL,
+        misses: int = KEEPALIVE_MISSES,
+    ):
+        self.transport = transport
+        self.interval = interval
+        self.misses = misses
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self) -> "KeepaliveMonitor":
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            if not self.transport.is_active():
+                return
+            answered = threading.Event()
+            threading.Thread(target=self._ping, args=(answered,), daemon=True).start()
+            if not answered.wait(self.interval * self.misses) and not self.stopped.is_set():
+                self.transport.close()
+                return
+
+    def _ping(self, answered: threading.Event):
+        # Servers answer unknown global requests with a failure, which is answer enough
+        try:
+            self.transport.global_request("keepalive@openssh.com", wait=True)
+        except (paramiko.SSHException, OSError, EOFError):
+            return
+        if self.transport.is_active():
+            answered.set()
+
+
+def reconnect(connect, log=None, delays: tuple[float, ...] = RECONNECT_DELAYS):
+    """
+    Call `connect` until it succeeds, waiting longer before each attempt.
+
+    Raises:
+        ConnectionLost: If every attempt failed
+    """
+    log = log or (lambda message: None)
+    error = None
+    for attempt, delay in enumerate(delays, 1):
+        time.sleep(delay)
+        try:
+            return connect()
+        except paramiko.AuthenticationException:
+            raise
+        except (paramiko.SSHException, OSError, EOFError, DeploymentError) as e:
+            error = e
+            log(f"Reconnection attempt {attempt}/{len(delays)} failed: {e}")
+    raise ConnectionLost(f"Could not reconnect after {len(delays)} attempts: {error}")
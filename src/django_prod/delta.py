@@ -0,0 +1,181 @@
+"""
+rsync-style delta transfer for large files that changed only a little.
+
+The remote side computes block signatures (a rolling weak checksum plus a strong
+BLAKE2 digest) of its copy, the local side finds matching blocks with a rolling
+window and sends only block references and literal bytes, and the remote side
+rebuilds the file from its old copy.
+
+Its own source is sent to the remote and run with `python3 -c` to compute
+signatures and apply patches (see remote.module_source).
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import struct
+import sys
+
+MIN_BLOCK_SIZE = 2048
+MAX_BLOCK_SIZE = 64 * 1024
+
+# Throughput of compute_delta under CPython, measured at about 1.7 MiB/s: a delta is
+# only worth computing on links slower than this
+DELTA_RATE = 1536 * 1024
+
+# Literal runs are split so the remote never has to buffer more than this at once
+MAX_LITERAL_SIZE = 1024 * 1024
+
+OP_COPY = b"C"
+OP_DATA = b"D"
+OP_END = b"E"
+
+
+def block_size_for(size: int) -> int:
+    """Pick a block size close to sqrt(size), like rsync does."""
+    block_size = int(size ** 0.5) // 8 * 8
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, block_size))
+
+
+def weak_checksum(block: bytes) -> tuple[int, int]:
+    """Return the (a, b) components of the rsync rolling checksum of `block`."""
+    length = len(block)
+    a = sum(block) & 0xFFFF
+    b = sum((length - i) * x for i, x in enumerate(block)) & 0xFFFF
+    return a, b
+
+
+def strong_checksum(block: bytes) -> str:
+    """Return the strong checksum used to confirm weak checksum matches."""
+    return hashlib.blake2b(block, digest_size=16).hexdigest()
+
+
+def file_signature(path: str, block_size: int) -> list[list]:
+    """Return [weak, strong] signatures for each block of a file."""
+    signature = []
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            a, b = weak_checksum(block)
+            signature.append([(b << 16) | a, strong_checksum(block)])
+    return signature
+
+
+def compute_delta(data: bytes, signature: list[list], block_size: int):
+    """
+    Yield delta operations turning the remote copy described by `signature` into `data`.
+
+    Operations are ("copy", block_index) or ("data", bytes). `data` may also be an
+    mmap of a large file: it is only read in slices.
+    """
+    weak_index = {}
+    for index, (weak, strong) in enumerate(signature):
+        weak_index.setdefault(weak, []).append((index, strong))
+
+    length = len(data)
+    if length < block_size or not weak_index:
+        if data:
+            yield "data", data[:]
+        return
+
+    pos = 0
+    literal_start = 0
+    a, b = weak_checksum(data[:block_size])
+    while True:
+        candidates = weak_index.get((b << 16) | a)
+        if candidates:
+            strong = strong_checksum(data[pos:pos + block_size])
+            match = next((index for index, s in candidates if s == strong), None)
+            if match is not None:
+                if literal_start < pos:
+                    yield "data", data[literal_start:pos]
+                yield "copy", match
+                pos += block_size
+                literal_start = pos
+                if pos + block_size > length:
+                    break
+                a, b = weak_checksum(data[pos:pos + block_size])
+                continue
+
+        if pos + block_size >= length:
+            break
+        out_byte = data[pos]
+        in_byte = data[pos + block_size]
+        a = (a - out_byte + in_byte) & 0xFFFF
+        b = (b - block_size * out_byte + a) & 0xFFFF
+        pos += 1
+
+    if literal_start < length:
+        yield "data", data[literal_start:]
+
+
+def encode_delta(operations) -> bytes:
+    """Encode delta operations in the binary format read by `apply_patch`."""
+    parts = []
+    for op, value in operations:
+        if op == "copy":
+            parts.append(OP_COPY + struct.pack(">I", value))
+        else:
+            for start in range(0, len(value), MAX_LITERAL_SIZE):
+                chunk = value[start:start + MAX_LITERAL_SIZE]
+                parts.append(OP_DATA + struct.pack(">I", len(chunk)) + chunk)
+    parts.append(OP_END)
+    return b"".join(parts)
+
+
+def _read_exact(stream, size: int) -> bytes:
+    data = stream.read(size)
+    if len(data) != size:
+        raise ValueError("Truncated delta stream")
+    return data
+
+
+def apply_patch(path: str, block_size: int, expected_sha256: str, stream) -> None:
+    """Rebuild `path` from its old contents and the delta read from `stream`."""
+    tmp_path = f"{path}.django_prod_delta"
+    digest = hashlib.sha256()
+    with open(path, "rb") as old, open(tmp_path, "wb") as new:
+        while True:
+            op = _read_exact(stream, 1)
+            if op == OP_END:
+                break
+            (value,) = struct.unpack(">I", _read_exact(stream, 4))
+            if op == OP_COPY:
+                old.seek(value * block_size)
+                chunk = old.read(block_size)
+            elif op == OP_DATA:
+                chunk = _read_exact(stream, value)
+            else:
+                raise ValueError(f"Unknown delta operation {op!r}")
+            digest.update(chunk)
+            new.write(chunk)
+
+    if digest.hexdigest() != expected_sha256:
+        os.unlink(tmp_path)
+        raise ValueError("Checksum mismatch after applying delta")
+    os.chmod(tmp_path, os.stat(path).st_mode & 0o7777)
+    os.replace(tmp_path, path)
+
+
+def main(argv: list[str]) -> int:
+    """Remote entry point: `sig` reads {path: block_size} JSON, `patch` applies a delta."""
+    command = argv[0]
+    if command == "sig":
+        requests = json.load(sys.stdin)
+        signatures = {}
+        for path, block_size in requests.items():
+            try:
+                signatures[path] = file_signature(path, block_size)
+            except OSError:
+                signatures[path] = None
+        json.dump(signatures, sys.stdout)
+        return 0
+    if command == "patch":
+        path, block_size, expected_sha256 = argv[1], int(argv[2]), argv[3]
+        apply_patch(path, block_size, expected_sha256, sys.stdin.buffer)
+        return 0
+    return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
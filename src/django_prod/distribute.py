@@ -0,0 +1,314 @@
+"""
+Build the image on one server of a rollout and copy it to the others.
+
+With `--build once`, the first server builds the image as usual and every other
+server loads it instead of repeating the build. A receiving server lists the
+layers it already has, and the sender saves the image once and streams it
+compressed without those layers (see imagetar.py).
+
+Every server that loaded the image becomes a sender in turn, so the copies fan
+out as a tree: 1, 2, 4, 8... servers hold the image after each round. Senders
+stream directly to the receiver over SSH with a one-off key that can only run
+`docker load`. When a sender cannot reach the receiver, the stream goes through
+this machine instead.
+"""
+import io
+import secrets
+import shlex
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import PurePosixPath
+
+import paramiko
+
+from . import imagetar
+from .exceptions import DeploymentError
+from .remote import READ_SIZE, module_source, run_remote
+from .transfer import write_remote_file
+
+IMAGE_ARCHIVE_DIRNAME = ".django_prod_images"
+
+# Receivers one server streams the image to at the same time
+DEFAULT_FANOUT = 1
+
+IMAGE_TRANSFER_TIMEOUT = 1800
+
+# Marks the authorized_keys lines of one-off transfer keys so they can be removed
+TRANSFER_KEY_COMMENT = "django-prod-image-transfer"
+
+
+def layer_listing_command() -> str:
+    """Print the layer diff IDs of the local images, one JSON list per image."""
+    return "docker image inspect --format '{{json .RootFS.Layers}}' $(docker image ls -q) 2>/dev/null | sort -u; true"
+
+
+def read_layer_listing(ssh: paramiko.SSHClient, timeout: float = 60) -> str:
+    """
+    The layer listing of a receiving server, read whole.
+
+    Hosts with many images list more than run_remote keeps of a command's output,
+    and every layer missing from the listing would be sent again.
+    """
+    _, stdout, _ = ssh.exec_command(layer_listing_command(), timeout=timeout)
+    return stdout.read().decode()
+
+
+def compress_command(compression: str) -> str:
+    return "zstd -3 -T0 -c" if compression == "zstd" else "gzip -1 -c"
+
+
+def load_command(compression: str) -> str:
+    return f"{'zstd' if compression == 'zstd' else 'gzip'} -dc | docker load"
+
+
+def send_command(images: list[str], archive: str, filtered: bool = True) -> str:
+    """
+    Command streaming `images` compressed to stdout, reading the receiver's layer listing on stdin.
+
+    The archive saved for filtering is kept for the next receivers of the same build.
+    Without python3, or unfiltered, the whole image is streamed from `docker save`.
+    """
+    names = " ".join(shlex.quote(image) for image in images)
+    if not filtered:
+        return f"docker save {names}"
+    path = shlex.quote(archive)
+    tmp = f"{path}.$$"
+    save = f"{{ [ -s {path} ] || {{ docker save -o {tmp} {names} && mv {tmp} {path}; }}; }}"
+    filter_images = f"python3 -c {shlex.quote(module_source(imagetar))} filter {path}"
+    return f"{save} && {filter_images}"
+
+
+class ImageSource:
+    """A server holding the built images, and how to open a new connection to it."""
+
+    # Images built on this machine, see localbuild.LocalImageSource
+    local = False
+
+    def __init__(self, label: str, connect, remote_path: str, env):
+        self.label = label
+        self.connect = connect
+        self.remote_path = remote_path
+        self.env = env
+
+
+class ImageDistribution:
+    """Hand out servers holding the images to the servers waiting for them."""
+
+    def __init__(self, images: list[str], fanout: int = DEFAULT_FANOUT):
+        self.images = images
+        self.fanout = max(1, fanout)
+        # Names the archives saved for this rollout, so older ones are never reused
+        self.build_id = time.strftime("%Y%m%d%H%M%S") + "-" + secrets.token_hex(4)
+        self.sources: list[ImageSource] = []
+        self.sending: dict[str, int] = {}
+        self.error = None
+        self.condition = threading.Condition()
+
+    def archive_path(self, source: ImageSource) -> str:
+        return f"{source.remote_path}/{IMAGE_ARCHIVE_DIRNAME}/images-{self.build_id}.tar"
+
+    def add_source(self, source: ImageSource):
+        with self.condition:
+            if source.label in self.sending:
+                return
+            self.sources.append(source)
+            self.sending[source.label] = 0
+            self.condition.notify_all()
+
+    def fail(self, error: str):
+        """Release the servers waiting for the images: they will not come."""
+        with self.condition:
+            self.error = error
+            self.condition.notify_all()
+
+    @contextmanager
+    def source(self, timeout: float = IMAGE_TRANSFER_TIMEOUT):
+        """
+        Wait for a server holding the images with a free sending slot, and reserve the slot.
+
+        Raises:
+            DeploymentError: If the build failed or no server got free in time
+        """
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                if self.error:
+                    raise DeploymentError(f"No image to copy: {self.error}")
+                free = [source for source in self.sources if self.sending[source.label] < self.fanout]
+                if free:
+                    source = min(free, key=lambda s: self.sending[s.label])
+                    self.sending[source.label] += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise DeploymentError(f"Timed out after {timeout}s waiting for a server holding the image")
+                self.condition.wait(remaining)
+        try:
+            yield source
+        finally:
+            with self.condition:
+                self.sending[source.label] -= 1
+                self.condition.notify_all()
+
+    def cleanup(self, log=None):
+        """Delete the archives saved on the servers that sent the images, and the local one."""
+        log = log or (lambda message: None)
+        for source in self.sources:
+            if source.local:
+                source.remove()
+                continue
+            try:
+                ssh = source.connect()
+            except (paramiko.SSHException, OSError, DeploymentError) as e:
+                log(f"Could not remove the image archive on {source.label}: {e}")
+                continue
+            try:
+                run_remote(ssh, f"rm -rf {shlex.quote(f'{source.remote_path}/{IMAGE_ARCHIVE_DIRNAME}')}", timeout=60)
+            except (paramiko.SSHException, OSError, DeploymentError) as e:
+                log(f"Could not remove the image archive on {source.label}: {e}")
+            finally:
+                ssh.close()
+
+
+def send_images(
+    distribution: ImageDistribution,
+    source: ImageSource,
+    target_ssh: paramiko.SSHClient,
+    target_login: str,
+    target_env,
+    log=None,
+    timeout: float = IMAGE_TRANSFER_TIMEOUT,
+) -> str:
+    """
+    Copy the images from `source` to the server behind `target_ssh`.
+
+    Tries, in order: a direct stream of the missing layers from the source to the target,
+    the same stream relayed through this machine, and the whole images relayed.
+
+    Returns:
+        Short description of how the images were sent
+
+    Raises:
+        DeploymentError: If every way failed
+    """
+    log = log or (lambda message: None)
+    if source.local:
+        return f"from this machine: {source.send_to(target_ssh, target_env, timeout)}"
+    listing = read_layer_listing(target_ssh)
+    compression = "zstd" if source.env.zstd and target_env.zstd else "gzip"
+    archive = distribution.archive_path(source)
+    filtered = source.env.python3
+    archive_dir = shlex.quote(str(PurePosixPath(archive).parent))
+    send = f"mkdir -p -m 700 {archive_dir} && {send_command(distribution.images, archive, filtered)}"
+    send = f"{{ {send}; }} | {compress_command(compression)}"
+
+    source_ssh = source.connect()
+    try:
+        error = _direct_transfer(source_ssh, send, listing, target_ssh, target_login, compression, archive, timeout)
+        if error is None:
+            return f"from {source.label} directly ({compression})"
+        log(f"Direct copy from {source.label} failed ({error}), relaying through this machine")
+        error = _relay(source_ssh, send, listing, target_ssh, load_command(compression), timeout)
+        if error is None:
+            return f"from {source.label} through this machine ({compression})"
+        if filtered:
+            log(f"Copy of the missing layers failed ({error}), sending the whole image")
+            error = _relay(source_ssh, send, "", target_ssh, load_command(compression), timeout)
+            if error is None:
+                return f"from {source.label} through this machine, whole image ({compression})"
+        raise DeploymentError(f"Could not copy the image from {source.label}: {error}")
+    finally:
+        source_ssh.close()
+
+
+def _direct_transfer(
+    source_ssh: paramiko.SSHClient,
+    send: str,
+    listing: str,
+    target_ssh: paramiko.SSHClient,
+    target_login: str,
+    compression: str,
+    archive: str,
+    timeout: float,
+) -> str | None:
+    """Stream from the source to the target with a one-off key. Returns None on success, else the error."""
+    key = paramiko.RSAKey.generate(2048)
+    private = io.StringIO()
+    key.write_private_key(private)
+    marker = f"{TRANSFER_KEY_COMMENT}-{secrets.token_hex(8)}"
+    options = f'command="{load_command(compression)}",no-port-forwarding,no-agent-forwarding,no-X11-forwarding,no-pty'
+    authorized = shlex.quote(f"{options} {key.get_name()} {key.get_base64()} {marker}")
+    key_path = f"{archive}.key"
+
+    exit_code, _, err = run_remote(
+        target_ssh, f"umask 077 && mkdir -p ~/.ssh && printf '%s\\n' {authorized} >> ~/.ssh/authorized_keys"
+    )
+    if exit_code != 0:
+        return f"could not authorize the transfer key: {err.strip()}"
+    try:
+        run_remote(source_ssh, f"mkdir -p -m 700 {shlex.quote(str(PurePosixPath(archive).parent))}")
+        write_remote_file(source_ssh, key_path, private.getvalue().encode())
+        ssh_command = (
+            f"ssh -i {shlex.quote(key_path)} -o BatchMode=yes -o StrictHostKeyChecking=no "
+            f"-o UserKnownHostsFile=/dev/null -o ConnectTimeout=10 -o LogLevel=ERROR {shlex.quote(target_login)}"
+        )
+        channel = source_ssh.get_transport().open_session()
+        try:
+            channel.exec_command(f"command -v ssh >/dev/null || exit 127; chmod 600 {shlex.quote(key_path)} && "
+                                 f"{send} | {ssh_command}")
+            channel.sendall(listing.encode())
+            channel.shutdown_write()
+            channel.settimeout(timeout)
+            output = channel.makefile("rb").read()
+            errors = channel.makefile_stderr("rb").read()
+            exit_code = channel.recv_exit_status()
+        finally:
+            channel.close()
+        if exit_code == 127:
+            return "no ssh client on the sending server"
+        if exit_code != 0 or b"Loaded image" not in output:
+            return _last_line(errors or output) or f"exit code {exit_code}"
+        return None
+    finally:
+        run_remote(source_ssh, f"rm -f {shlex.quote(key_path)}")
+        run_remote(target_ssh, f"sed -i '/{marker}/d' ~/.ssh/authorized_keys")
+
+
+def _relay(
+    source_ssh: paramiko.SSHClient,
+    send: str,
+    listing: str,
+    target_ssh: paramiko.SSHClient,
+    load: str,
+    timeout: float,
+) -> str | None:
+    """Stream from the source to the target through this machine. Returns None on success, else the error."""
+    sender = source_ssh.get_transport().open_session()
+    receiver = target_ssh.get_transport().open_session()
+    try:
+        sender.settimeout(timeout)
+        receiver.settimeout(timeout)
+        sender.exec_command(send)
+        receiver.exec_command(load)
+        sender.sendall(listing.encode())
+        sender.shutdown_write()
+        while True:
+            data = sender.recv(READ_SIZE)
+            if not data:
+                break
+            receiver.sendall(data)
+        receiver.shutdown_write()
+        output = receiver.makefile("rb").read()
+        errors = receiver.makefile_stderr("rb").read() + sender.makefile_stderr("rb").read()
+        if receiver.recv_exit_status() != 0 or b"Loaded image" not in output:
+            return _last_line(errors or output) or f"exit code {receiver.recv_exit_status()}"
+        return None
+    finally:
+        sender.close()
+        receiver.close()
+
+
+def _last_line(output: bytes) -> str:
+    lines = output.decode(errors="replace").strip().splitlines()
+    return lines[-1] if lines else ""
@@ -0,0 +1,15 @@
+"""
+Exceptions shared by the django-prod deployment modules.
+"""
+
+
+class DeploymentError(Exception):
+    """Custom exception for deployment failures."""
+
+    pass
+
+
+class ConnectionLost(DeploymentError):
+    """The SSH connection dropped while a remote operation was running."""
+
+    pass
@@ -0,0 +1,83 @@
+"""
+Hot-reload of code-only changes into running containers.
+
+A changeset that does not touch the files the image is built from (requirements,
+Dockerfile, entrypoint, compose file) can be applied without rebuilding: the
+changed files are copied into the running containers with `docker cp` and
+gunicorn is sent HUP, which replaces its workers gracefully.
+"""
+import shlex
+from pathlib import PurePosixPath
+
+# Directory the project is copied to inside the image (WORKDIR of prod.Dockerfile)
+CONTAINER_APP_DIR = "/code"
+
+# Files that change the image or the containers themselves
+REBUILD_FILES = {
+    "requirements.txt",
+    "prod.Dockerfile",
+    "entrypoint.prod.sh",
+    "docker-compose.yaml",
+    ".dockerignore",
+}
+
+
+class Changeset:
+    """Changed and deleted relative paths, classified by what they require on the server."""
+
+    def __init__(self, changed: list[str], deleted: list[str]):
+        self.changed = sorted(changed)
+        self.deleted = sorted(deleted)
+
+    @property
+    def paths(self) -> list[str]:
+        return self.changed + self.deleted
+
+    @property
+    def is_empty(self) -> bool:
+        return not self.changed and not self.deleted
+
+    @property
+    def needs_rebuild(self) -> bool:
+        return any(path in REBUILD_FILES for path in self.paths)
+
+    @property
+    def needs_migrate(self) -> bool:
+        return any("migrations" in PurePosixPath(path).parts for path in self.paths)
+
+    @property
+    def needs_collectstatic(self) -> bool:
+        return any("static" in PurePosixPath(path).parts for path in self.paths)
+
+    def describe(self) -> str:
+        if self.needs_rebuild:
+            touched = sorted(path for path in self.paths if path in REBUILD_FILES)
+            return f"rebuild required ({', '.join(touched)} changed)"
+        steps = ["copy"]
+        if self.needs_migrate:
+            steps.append("migrate")
+        if self.needs_collectstatic:
+            steps.append("collectstatic")
+        steps.append("reload")
+        return " + ".join(steps)
+
+
+def hot_reload_command(container_id: str, source_dir: str, changeset: Changeset) -> str:
+    """Build the remote command applying a code-only changeset to one container."""
+    container = shlex.quote(container_id)
+    commands = []
+    if changeset.changed:
+        sources = " ".join(shlex.quote(path) for path in changeset.changed)
+        commands.append(
+            f"cd {shlex.quote(source_dir)} && tar -cf - {sources} | docker cp - {container}:{CONTAINER_APP_DIR}"
+        )
+    if changeset.deleted:
+        targets = " ".join(shlex.quote(f"{CONTAINER_APP_DIR}/{path}") for path in changeset.deleted)
+        commands.append(f"docker exec {container} rm -f {targets}")
+    if changeset.needs_migrate:
+        commands.append(f"docker exec {container} python manage.py migrate --noinput")
+    if changeset.needs_collectstatic:
+        commands.append(f"docker exec {container} python manage.py collectstatic --noinput")
+    # gunicorn runs as PID 1 (exec from the entrypoint): HUP restarts its workers gracefully
+    commands.append(f"docker kill -s HUP {container}")
+    return " && ".join(commands)
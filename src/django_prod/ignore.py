@@ -0,0 +1,210 @@
+"""
+Ignore rules deciding which project files are uploaded on deploy.
+
+Patterns follow .gitignore semantics (negation with `!`, directory-only patterns
+ending in `/`, anchoring with `/`, `*`, `?`, `[...]` and `**`). They are compiled
+to regular expressions once, and the project walk prunes ignored directories
+instead of descending into them.
+"""
+import os
+import re
+from pathlib import Path
+
+# Patterns always excluded from uploads, before any project ignore file
+DEFAULT_IGNORE_PATTERNS = [
+    "venv/",
+    ".venv/",
+    "env/",
+    ".env",
+    "__pycache__/",
+    ".git/",
+    ".idea/",
+    "node_modules/",
+    "*.pyc",
+    ".DS_Store",
+    "deployment_target.json",
+    ".deployment_*",
+]
+
+# Project-specific ignore list read in addition to .gitignore and .dockerignore
+DJANGO_PROD_IGNORE_FILE = ".django_prod_ignore"
+
+# Files generated by django-prod that the production image needs, even when ignored by git
+ALWAYS_INCLUDE_PATTERNS = [
+    "!.env.prod",
+    "!settings_prod.py",
+    "!/docker-compose.yaml",
+    "!/prod.Dockerfile",
+    "!/entrypoint.prod.sh",
+    "!/requirements.txt",
+]
+
+
+def _translate(pattern: str) -> str:
+    """Translate a gitignore glob (without flags) to a regular expression body."""
+    out = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == "*":
+            if pattern[i:i + 2] == "**":
+                i += 2
+                if i < n and pattern[i] == "/":
+                    out.append("(?:.*/)?")
+                    i += 1
+                else:
+                    out.append(".*")
+                continue
+            out.append("[^/]*")
+        elif c == "?":
+            out.append("[^/]")
+        elif c == "[":
+            end = pattern.find("]", i + 2)
+            if end == -1:
+                out.append(re.escape(c))
+            else:
+                body = pattern[i + 1:end].replace("\\", "\\\\")
+                if body.startswith("!"):
+                    body = "^" + body[1:]
+                out.append(f"[{body}]")
+                i = end
+        elif c == "\\" and i + 1 < n:
+            i += 1
+            out.append(re.escape(pattern[i]))
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return "".join(out)
+
+
+class IgnoreRule:
+    """A single compiled ignore pattern, scoped to the directory of its ignore file."""
+
+    __slots__ = ("pattern", "negate", "dir_only", "anchored", "base", "regex")
+
+    def __init__(self, pattern: str, base: str = "", anchored: bool = False):
+        self.pattern = pattern
+        self.base = base
+        self.negate = pattern.startswith("!")
+        if self.negate:
+            pattern = pattern[1:]
+        elif pattern.startswith(("\\!", "\\#")):
+            pattern = pattern[1:]
+
+        self.dir_only = pattern.endswith("/")
+        pattern = pattern.rstrip("/")
+        self.anchored = anchored or "/" in pattern
+        pattern = pattern.lstrip("/")
+
+        prefix = "" if self.anchored else "(?:.*/)?"
+        self.regex = re.compile(f"^{prefix}{_translate(pattern)}$")
+
+    def matches(self, relative_path: str, is_dir: bool) -> bool:
+        if self.dir_only and not is_dir:
+            return False
+        if self.base:
+            if not relative_path.startswith(self.base + "/"):
+                return False
+            relative_path = relative_path[len(self.base) + 1:]
+        return self.regex.match(relative_path) is not None
+
+
+def parse_ignore_lines(lines, base: str = "", anchored: bool = False) -> list[IgnoreRule]:
+    """Compile the non-empty, non-comment lines of an ignore file."""
+    rules = []
+    for line in lines:
+        line = line.rstrip("\n").rstrip()
+        if not line or line.startswith("#"):
+            continue
+        rules.append(IgnoreRule(line, base=base, anchored=anchored))
+    return rules
+
+
+def _read_lines(path: Path) -> list[str]:
+    try:
+        return path.read_text().splitlines()
+    except (OSError, UnicodeDecodeError):
+        return []
+
+
+class IgnoreMatcher:
+    """Ordered ignore rules where the last matching rule wins, as in git."""
+
+    def __init__(self, rules: list[IgnoreRule] | None = None):
+        self.rules = rules or []
+
+    @classmethod
+    def for_project(cls, project_root: Path) -> "IgnoreMatcher":
+        """Build the matcher from the defaults and the project's ignore files."""
+        rules = parse_ignore_lines(DEFAULT_IGNORE_PATTERNS)
+        rules += parse_ignore_lines(_read_lines(project_root / ".gitignore"))
+        # .dockerignore patterns are always relative to the build context root
+        rules += parse_ignore_lines(_read_lines(project_root / ".dockerignore"), anchored=True)
+        rules += parse_ignore_lines(_read_lines(project_root / DJANGO_PROD_IGNORE_FILE))
+        rules += parse_ignore_lines(ALWAYS_INCLUDE_PATTERNS)
+        return cls(rules)
+
+    def with_rules(self, rules: list[IgnoreRule]) -> "IgnoreMatcher":
+        """Return a matcher with extra rules appended (e.g. from a nested .gitignore)."""
+        if not rules:
+            return self
+        # Keep the always-include rules last so nested files cannot override them
+        always = parse_ignore_lines(ALWAYS_INCLUDE_PATTERNS)
+        return IgnoreMatcher(self.rules + rules + always)
+
+    def is_ignored(self, relative_path: str, is_dir: bool = False) -> bool:
+        ignored = False
+        for rule in self.rules:
+            if rule.negate == ignored and rule.matches(relative_path, is_dir):
+                ignored = not rule.negate
+        return ignored
+
+    def to_dockerignore(self) -> str:
+        """Render the rules in .dockerignore syntax (root-anchored, `**/` for unanchored patterns)."""
+        lines = []
+        for rule in self.rules:
+            pattern = rule.pattern
+            negate = "!" if rule.negate else ""
+            if rule.negate:
+                pattern = pattern[1:]
+            pattern = pattern.rstrip("/").lstrip("/")
+            if rule.base:
+                pattern = f"{rule.base}/{pattern}" if rule.anchored else f"{rule.base}/**/{pattern}"
+            elif not rule.anchored:
+                pattern = f"**/{pattern}"
+            lines.append(f"{negate}{pattern}")
+        return "\n".join(lines) + "\n"
+
+
+def walk_project(project_root: Path, matcher: IgnoreMatcher | None = None) -> list[tuple[Path, Path]]:
+    """
+    Collect (local_path, relative_path) tuples for every file that is not ignored.
+
+    Ignored directories are pruned during the walk, and nested .gitignore files
+    apply to the directory they live in.
+    """
+    matcher = matcher or IgnoreMatcher.for_project(project_root)
+    files = []
+    stack = [(project_root, "", matcher)]
+    while stack:
+        directory, relative_dir, dir_matcher = stack.pop()
+        if relative_dir:
+            nested = directory / ".gitignore"
+            if nested.is_file():
+                dir_matcher = dir_matcher.with_rules(parse_ignore_lines(_read_lines(nested), base=relative_dir))
+
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            continue
+
+        for entry in entries:
+            relative_path = f"{relative_dir}/{entry.name}" if relative_dir else entry.name
+            if entry.is_dir(follow_symlinks=False):
+                if not dir_matcher.is_ignored(relative_path, is_dir=True):
+                    stack.append((Path(entry.path), relative_path, dir_matcher))
+            elif entry.is_file() and not dir_matcher.is_ignored(relative_path):
+                files.append((Path(entry.path), Path(relative_path)))
+
+    files.sort(key=lambda f: f[1])
+    return files
@@ -0,0 +1,87 @@
+"""
+Strip the layers a server already has from a `docker save` archive.
+
+`docker load` looks layers up by chain ID and only reads the layer files it is
+missing, so an archive without the layers the receiving server already holds
+still loads. The receiver lists the layers of its images, their chain IDs are
+computed from that list, and the sender writes the archive again without the
+matching layer files.
+
+Its source is sent to the server holding the image and run with `python3 -c`
+(see remote.module_source).
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import sys
+import tarfile
+
+
+def chain_ids(diff_ids: list) -> list:
+    """Chain IDs of the layers of an image, from the diff IDs of its root filesystem."""
+    chain = []
+    for diff_id in diff_ids:
+        if chain:
+            diff_id = "sha256:" + hashlib.sha256((chain[-1] + " " + diff_id).encode()).hexdigest()
+        chain.append(diff_id)
+    return chain
+
+
+def present_chain_ids(listing: str) -> set:
+    """Chain IDs of every layer in the output of `docker image inspect --format '{{json .RootFS.Layers}}'`."""
+    present = set()
+    for line in listing.splitlines():
+        try:
+            diff_ids = json.loads(line)
+        except ValueError:
+            continue
+        if isinstance(diff_ids, list):
+            present.update(chain_ids(diff_ids))
+    return present
+
+
+def layers_to_skip(archive: tarfile.TarFile, present: set) -> set:
+    """Paths of the layer files of `archive` whose chain ID is in `present`."""
+    skip = set()
+    needed = set()
+    for image in json.load(archive.extractfile("manifest.json")):
+        config = json.load(archive.extractfile(image["Config"]))
+        for path, chain_id in zip(image["Layers"], chain_ids(config["rootfs"]["diff_ids"])):
+            (skip if chain_id in present else needed).add(path)
+    # A layer file shared with an image that misses it must stay
+    return skip - needed
+
+
+def write_missing_layers(path: str, present: set, out) -> tuple:
+    """
+    Write the archive at `path` to the binary stream `out`, without the layers in `present`.
+
+    Returns:
+        Tuple of (layers skipped, bytes skipped)
+    """
+    skipped = skipped_bytes = 0
+    with tarfile.open(path, "r:") as archive:
+        skip = layers_to_skip(archive, present)
+        with tarfile.open(fileobj=out, mode="w|") as filtered:
+            for member in archive:
+                if member.name in skip and member.isfile():
+                    skipped += 1
+                    skipped_bytes += member.size
+                    continue
+                filtered.addfile(member, archive.extractfile(member) if member.isfile() else None)
+    return skipped, skipped_bytes
+
+
+def main(argv: list) -> int:
+    """Remote entry point: `filter ARCHIVE` reads the receiver's layer listing on stdin."""
+    if argv[:1] != ["filter"] or len(argv) != 2:
+        return 2
+    present = present_chain_ids(sys.stdin.read())
+    skipped, skipped_bytes = write_missing_layers(argv[1], present, sys.stdout.buffer)
+    sys.stderr.write("Skipped %d layers (%d bytes) the receiver already has\n" % (skipped, skipped_bytes))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,189 @@
+"""
+Build the image on this machine and send the server only the layers it lacks.
+
+With `--build local`, the compose services are built by the local Docker daemon
+for the server's platform, so its build cache stays warm across deploys and a
+small server never compiles dependencies. The build context is staged from the
+files a deploy uploads, so the image holds what a server-side build would. The
+server lists the layers it already has, and the images saved by `docker save`
+are streamed into `docker load` on the server without those layers (see
+imagetar.py).
+"""
+import gzip
+import os
+import shutil
+import subprocess
+import tempfile
+from pathlib import Path
+
+import paramiko
+
+from . import imagetar
+from .distribute import ImageSource, load_command, read_layer_listing
+from .exceptions import DeploymentError
+from .transfer import ChannelWriter, zstandard
+
+# `uname -m` of the server -> platform the image is built for
+PLATFORMS = {
+    "x86_64": "linux/amd64",
+    "amd64": "linux/amd64",
+    "aarch64": "linux/arm64",
+    "arm64": "linux/arm64",
+    "armv7l": "linux/arm/v7",
+    "armv6l": "linux/arm/v6",
+    "i686": "linux/386",
+    "ppc64le": "linux/ppc64le",
+    "s390x": "linux/s390x",
+}
+
+IMAGE_LOAD_TIMEOUT = 1800
+
+# Staging directory of the build context, inside the project so files can be hardlinked.
+# Matched by the `.deployment_*` default ignore pattern, so never uploaded itself.
+BUILD_CONTEXT_DIRNAME = ".deployment_build_context"
+
+
+def platform_for(arch: str | None) -> str | None:
+    return PLATFORMS.get(arch or "")
+
+
+def local_compose_command() -> list[str]:
+    """
+    The local Docker Compose command, preferring `docker compose` (v2).
+
+    Raises:
+        DeploymentError: If neither Docker Compose nor Docker runs locally
+    """
+    candidates = (["docker", "compose"], ["docker-compose"])
+    for command in candidates:
+        try:
+            result = subprocess.run([*command, "version"], capture_output=True, timeout=30)
+        except (OSError, subprocess.TimeoutExpired):
+            continue
+        if result.returncode == 0:
+            return command
+    raise DeploymentError("--build local needs Docker and Docker Compose on this machine")
+
+
+def stage_build_context(files: list[tuple[Path, Path]], directory: Path):
+    """Lay out (local_path, relative_path) files under `directory`, hardlinked when possible."""
+    shutil.rmtree(directory, ignore_errors=True)
+    for local_path, relative_path in files:
+        target = directory / relative_path
+        target.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.link(local_path, target)
+        except OSError:
+            shutil.copy2(local_path, target)
+
+
+def build_images(project_root: Path, files: list[tuple[Path, Path]], platform: str | None, log=None):
+    """
+    Build the compose services of the project with the local Docker daemon.
+
+    The build context only holds `files`, the files a deploy uploads, so the image matches
+    the one the server would build and local-only files (.env, virtualenvs, .git...) stay out.
+
+    Raises:
+        DeploymentError: If the build fails
+    """
+    log = log or (lambda line: None)
+    env = dict(os.environ)
+    if platform:
+        env["DOCKER_DEFAULT_PLATFORM"] = platform
+    context = project_root / BUILD_CONTEXT_DIRNAME
+    stage_build_context(files, context)
+    try:
+        process = subprocess.Popen(
+            [*local_compose_command(), "-f", "docker-compose.yaml", "build"],
+            cwd=context,
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            errors="replace",
+        )
+        tail = []
+        for line in process.stdout:
+            line = line.rstrip()
+            log(line)
+            tail = (tail + [line])[-20:]
+        if process.wait() != 0:
+            raise DeploymentError("Local image build failed:\n" + "\n".join(tail))
+    finally:
+        shutil.rmtree(context, ignore_errors=True)
+
+
+class LocalImageSource(ImageSource):
+    """The images built on this machine, saved once and sent to each server."""
+
+    local = True
+
+    def __init__(self, images: list[str], env):
+        super().__init__("local", None, None, env)
+        self.images = images
+        self.directory = tempfile.mkdtemp(prefix="django-prod-images-")
+        self.archive = os.path.join(self.directory, "images.tar")
+
+    def save(self):
+        """
+        Save the built images to a local archive.
+
+        Raises:
+            DeploymentError: If `docker save` fails
+        """
+        result = subprocess.run(["docker", "save", "-o", self.archive, *self.images], capture_output=True, text=True)
+        if result.returncode != 0:
+            raise DeploymentError(f"docker save failed: {result.stderr.strip()}")
+
+    def send_to(self, target_ssh: paramiko.SSHClient, target_env, timeout: float = IMAGE_LOAD_TIMEOUT) -> str:
+        """
+        Stream the layers the server is missing into `docker load` on it.
+
+        Returns:
+            Short description of what was sent
+
+        Raises:
+            DeploymentError: If the server could not load the images
+        """
+        listing = read_layer_listing(target_ssh)
+        present = imagetar.present_chain_ids(listing)
+        compression = "zstd" if zstandard is not None and target_env.zstd else "gzip"
+        try:
+            return self._stream(target_ssh, present, compression, timeout)
+        except DeploymentError:
+            if not present:
+                raise
+        # Some image stores want every layer in the archive
+        return self._stream(target_ssh, set(), compression, timeout)
+
+    def _stream(self, target_ssh: paramiko.SSHClient, present: set, compression: str, timeout: float) -> str:
+        channel = target_ssh.get_transport().open_session()
+        try:
+            channel.settimeout(timeout)
+            channel.exec_command(load_command(compression))
+            writer = ChannelWriter(channel)
+            if compression == "zstd":
+                compressor = zstandard.ZstdCompressor(level=3).stream_writer(writer, closefd=False)
+            else:
+                compressor = gzip.GzipFile(fileobj=writer, mode="wb", compresslevel=1)
+            skipped, skipped_bytes = imagetar.write_missing_layers(self.archive, present, compressor)
+            compressor.close()
+            channel.shutdown_write()
+            output = channel.makefile("rb").read()
+            errors = channel.makefile_stderr("rb").read()
+            exit_code = channel.recv_exit_status()
+        except (OSError, paramiko.SSHException) as e:
+            raise DeploymentError(f"Sending the image failed: {e}")
+        finally:
+            channel.close()
+        if exit_code != 0 or b"Loaded image" not in output:
+            message = (errors or output).decode(errors="replace").strip()
+            raise DeploymentError(f"docker load failed on the server (exit code {exit_code}): {message}")
+        return (
+            f"{writer.bytes_sent / 1024**2:.1f} MiB sent ({compression}), "
+            f"{skipped} layers ({skipped_bytes / 1024**2:.1f} MiB) already on the server"
+        )
+
+    def remove(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -1,13 +1,108 @@
+import hashlib
 import importlib
 import json
+import mmap
 import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import partial
 from pathlib import Path
 
 import paramiko
 import questionary
 from django.core.management.base import BaseCommand
-from scp import SCPClient, SCPException
+from django.utils.module_loading import import_string
+from scp import SCPException
+
+from django_prod import mux
+from django_prod.backends import BACKENDS, choose_backend, record_stats
+from django_prod.chunking import CHUNK_STORE_DIRNAME, CHUNKING_RATE, chunk_file, read_chunk
+from django_prod.delta import DELTA_RATE, block_size_for, compute_delta, encode_delta
+from django_prod.distribute import DEFAULT_FANOUT, ImageDistribution, ImageSource, send_images
+from django_prod.connection import KeepaliveMonitor, is_connection_error, reconnect, transport_lost
+from django_prod.exceptions import DeploymentError
+from django_prod.hotreload import Changeset, hot_reload_command
+from django_prod.ignore import IgnoreMatcher, walk_project
+from django_prod.localbuild import LocalImageSource, build_images, platform_for
+from django_prod.manifest import (
+    HASH_ALGORITHM,
+    HASH_CACHE_FILENAME,
+    MANIFEST_FILENAME,
+    HashCache,
+    build_manifest,
+    diff_manifests,
+    dump_manifest,
+    parse_manifest,
+)
+from django_prod.pipeline import Pipeline, Step
+from django_prod.prebuild import DependencyPrebuild, dependency_stage, prebuild_image
+from django_prod.probe import PROVISION_STATE_FILENAME, probe_remote
+from django_prod.remote import (
+    OutputLog,
+    RemoteAgent,
+    detached_command,
+    follow_command,
+    output_tail,
+    run_remote,
+)
+from django_prod.releases import (
+    CURRENT_LINK,
+    DEFAULT_KEEP_RELEASES,
+    compose_image_names,
+    compose_project_name,
+    list_releases_command,
+    new_release_name,
+    prepare_release_command,
+    prune_releases_command,
+    release_path,
+    releases_to_prune,
+    switch_release_command,
+    tag_release_images_command,
+)
+from django_prod.resume import UPLOAD_STATE_FILENAME, UploadCheckpoint
+from django_prod.rollout import (
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_HEALTH_CHECK_URL,
+    HEALTH_CHECK_TIMEOUT,
+    HostOutput,
+    health_check_command,
+    make_batches,
+    rollout_targets,
+)
+from django_prod.transfer import (
+    apply_remote_delta,
+    assemble_remote_files,
+    detect_archive_compression,
+    fetch_delta_signatures,
+    missing_remote_chunks,
+    read_remote_file,
+    remote_file_sizes,
+    remove_remote_files,
+    stream_chunks,
+    write_remote_file,
+)
+from django_prod.tuning import build_sample, connect_kwargs, tune_ssh
+from django_prod.watch import batches, create_watcher
+
+# Changed files at least this large are sent as rsync-style deltas when possible
+DELTA_MIN_SIZE = 1024 * 1024
+
+# Files at least this large go through the remote chunk store to deduplicate their content
+CHUNK_MIN_SIZE = 4 * 1024 * 1024
+
+# Full output of the remote commands of the last deploy, with --output-log
+OUTPUT_LOG_FILENAME = ".deployment_output.log"
+
+# Output and exit codes of the commands run detached on the server, below the app directory
+JOBS_DIRNAME = ".django_prod_jobs"
+
+# Times a step that can safely run again is retried after a dropped connection
+STEP_RETRIES = 3
+
+# Entries of deployment_target.json keyed by server IP, merged back per host during a rollout
+PER_HOST_CONFIG_KEYS = ("ssh_tuning", "transport_stats", "provisioning")
 
 
 class Command(BaseCommand):
@@ -21,23 +116,151 @@ class Command(BaseCommand):
         self.ssh_user = None
         self.path_to_ssh_key = None
         self.remote_path = None
+        self.release = None
+        self.release_path = None
+        self.previous_release = None
+        self.keep_releases = DEFAULT_KEEP_RELEASES
+        self.deployment_config = {}
+        self.ssh_settings = None
+        self.tune_ssh = False
+        self.full_upload = False
+        self.transport = "auto"
+        self.jobs = 4
+        self.ignore_matcher = None
+        self.checkpoint = None
+        self.local_manifest = None
+        self.changeset = None
+        self.upload_plan = None
+        self.compose_cmd = None
+        self.remote_env = None
+        self.agent = None
+        self.prebuild = None
+        self.fast = False
+        self.hot_reloaded = False
+        self.watch = False
+        self.output_log = None
+        self.keepalive = None
+        self.reprovision = False
+        # Steps save deployment_target.json from several threads
+        self.config_lock = threading.Lock()
+        # Detached commands started on the server: name -> output lines received so far
+        self.detached_jobs = {}
+        self.persist = 0
+        # Set on the per-host commands of a rollout to several servers
+        self.shared_config = None
+        self.plan_lock = threading.Lock()
+        self.launch_gate = nullcontext()
+        self.health_check = None
+        # "remote" builds on the server, "local" on this machine, "once" on the first server of a rollout
+        self.build = "remote"
+        self.local_image = None
+        # With --build once or local: the servers of the rollout share the image built by the first one
+        self.image_distribution = None
+        self.builds_image = False
+        self.image_received = False
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--full-upload",
+            action="store_true",
+            help="Upload every file instead of only the files changed since the last deploy",
+        )
+        parser.add_argument(
+            "--transport",
+            choices=["auto", *BACKENDS],
+            default="auto",
+            help="Upload backend; 'auto' picks the fastest one measured for this server (default: auto)",
+        )
+        parser.add_argument(
+            "--jobs",
+            type=int,
+            default=4,
+            help="Number of parallel SFTP sessions used when uploading file by file (default: 4)",
+        )
+        parser.add_argument(
+            "--keep-releases",
+            type=int,
+            default=DEFAULT_KEEP_RELEASES,
+            help=f"Number of releases kept on the server for rollbacks (default: {DEFAULT_KEEP_RELEASES})",
+        )
+        parser.add_argument(
+            "--fast",
+            action="store_true",
+            help="Skip the Docker rebuild when only application code changed: copy it into the running "
+            "containers and reload gunicorn gracefully",
+        )
+        parser.add_argument(
+            "--watch",
+            action="store_true",
+            help="After deploying, keep watching the project and push changes to the server as they are saved",
+        )
+        parser.add_argument(
+            "--reprovision",
+            action="store_true",
+            help="Check the server's Docker setup again instead of trusting the state saved by a previous deploy",
+        )
+        parser.add_argument(
+            "--output-log",
+            action="store_true",
+            help=f"Write the full output of every remote command to {OUTPUT_LOG_FILENAME}; "
+            "otherwise only the last lines of a failing command are kept",
+        )
+        parser.add_argument(
+            "--persist",
+            type=int,
+            metavar="SECONDS",
+            help="Keep the SSH connection open in the background for this many idle seconds and reuse it "
+            "in later django-prod commands; 0 disables it (default: the last value used, else 0)",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            help="With several targets, number of servers deployed at the same time "
+            f"(default: rollout.batch_size in deployment_target.json, else {DEFAULT_BATCH_SIZE})",
+        )
+        parser.add_argument(
+            "--max-unavailable",
+            type=int,
+            help="With several targets, number of servers of a batch restarting their containers "
+            "at the same time (default: rollout.max_unavailable, else 1)",
+        )
+        parser.add_argument(
+            "--build",
+            choices=["remote", "once", "local"],
+            help="Where the image is built: 'remote' on each server, 'local' with the Docker daemon of this "
+            "machine, sending only the layers the server lacks, 'once' (several targets) on the first server, "
+            "copied to the others (default: rollout.build with several targets, else remote)",
+        )
+        parser.add_argument(
+            "--tune-ssh",
+            action="store_true",
+            help="Measure upload throughput for several SSH cipher, window and compression settings "
+            "and keep the fastest for this server",
+        )
 
     def handle(self, *args, **kwargs):
-        # Validate settings module
-        if not self.settings_module:
-            self.stderr.write(self.style.ERROR("DJANGO_SETTINGS_MODULE is not set"))
-            return
+        self._apply_options(kwargs)
 
-        try:
-            settings_file = Path(importlib.import_module(self.settings_module).__file__)
-        except Exception as e:
-            self.stderr.write(self.style.ERROR(f"Could not locate settings module: {e}"))
+        if not self._locate_project_root():
             return
 
-        self.project_root_dir = settings_file.parent.parent
-
         # Load saved deployment config
         deployment_target = self._load_deployment_config()
+        self.deployment_config = deployment_target
+        if kwargs.get("persist") is not None:
+            deployment_target["ssh_persist"] = max(0, kwargs["persist"])
+
+        # Several servers listed under "targets" are deployed in rolling batches, without prompts
+        targets = rollout_targets(deployment_target)
+        if targets:
+            if self.watch:
+                self.stderr.write(self.style.ERROR("--watch only works with a single target"))
+                return
+            self._deploy_many(targets, kwargs)
+            return
+
+        if kwargs.get("output_log"):
+            self.output_log = OutputLog(self.project_root_dir / OUTPUT_LOG_FILENAME)
 
         # Prompt for deployment details
         if not self._prompt_deployment_details(deployment_target):
@@ -48,7 +271,9 @@ class Command(BaseCommand):
         if not self._validate_inputs():
             return
 
-        self.remote_path = "/root/app" if self.ssh_user == "root" else f"/home/{self.ssh_user}/app"
+        self.remote_path = self._default_remote_path()
+        self.ssh_settings = deployment_target.get("ssh_tuning", {}).get(self.vps_ip)
+        self.persist = deployment_target.get("ssh_persist", 0)
 
         # Save config for future deployments
         self._save_deployment_config()
@@ -56,6 +281,153 @@ class Command(BaseCommand):
         # Execute deployment
         self._deploy()
 
+    def _apply_options(self, kwargs: dict):
+        self.full_upload = kwargs.get("full_upload", False)
+        self.transport = kwargs.get("transport") or "auto"
+        self.jobs = max(1, kwargs.get("jobs") or 1)
+        self.keep_releases = max(1, kwargs.get("keep_releases") or DEFAULT_KEEP_RELEASES)
+        self.tune_ssh = kwargs.get("tune_ssh", False)
+        self.fast = kwargs.get("fast", False)
+        self.watch = kwargs.get("watch", False)
+        self.reprovision = kwargs.get("reprovision", False)
+        self.build = kwargs.get("build") or "remote"
+
+    def _deploy_many(self, targets: list[dict], kwargs: dict):
+        """
+        Deploy to every server of `targets`, batch after batch.
+
+        The servers of a batch are deployed concurrently, each with its own command whose
+        output is prefixed with the server IP. The remaining batches are skipped as soon as
+        a server of the current batch fails, including its health check.
+        """
+        rollout = self.deployment_config.get("rollout", {})
+        batch_size = kwargs.get("batch_size") or rollout.get("batch_size", DEFAULT_BATCH_SIZE)
+        max_unavailable = max(1, kwargs.get("max_unavailable") or rollout.get("max_unavailable", 1))
+        if rollout.get("health_check", True):
+            self.health_check = {
+                "url": rollout.get("health_check_url", DEFAULT_HEALTH_CHECK_URL),
+                "timeout": rollout.get("health_check_timeout", HEALTH_CHECK_TIMEOUT),
+            }
+        self.build = kwargs.get("build") or rollout.get("build", "remote")
+        if self.build != "remote":
+            images = compose_image_names(self.project_root_dir / "docker-compose.yaml")
+            if images:
+                self.image_distribution = ImageDistribution(images, rollout.get("fanout", DEFAULT_FANOUT))
+            else:
+                self.build = "remote"
+                self.stderr.write(
+                    self.style.WARNING("docker-compose.yaml names no image to copy, every server builds its own.")
+                )
+
+        batches = make_batches(targets, batch_size)
+        label_width = max(len(target.get("vps_ip", "")) for target in targets)
+        output_lock = threading.Lock()
+        # Shared by the hosts of every batch: at most max_unavailable restart at once
+        self.launch_gate = threading.BoundedSemaphore(max_unavailable)
+        self.stdout.write(
+            f"Deploying to {len(targets)} servers in {len(batches)} batches "
+            f"({batch_size} at a time, at most {max_unavailable} restarting at once)."
+        )
+        if self.image_distribution:
+            builder = "this machine" if self.build == "local" else targets[0].get("vps_ip")
+            self.stdout.write(f"The image is built on {builder} and copied to the servers.")
+        self._save_deployment_config()
+
+        def deploy_host(target: dict) -> tuple[str, bool, float]:
+            started = time.monotonic()
+            label = target.get("vps_ip", "?").ljust(label_width)
+            verbose = kwargs.get("verbosity", 1) > 1
+            host = Command(
+                stdout=HostOutput(self.stdout, label, output_lock, verbose),
+                stderr=HostOutput(self.stderr, label, output_lock, verbose),
+                no_color=kwargs.get("no_color", False),
+                force_color=kwargs.get("force_color", False),
+            )
+            host.builds_image = bool(self.image_distribution) and target is targets[0]
+            ok = host._deploy_as_rollout_host(self, target, kwargs)
+            if host.builds_image and not ok:
+                self.image_distribution.fail(f"the build on {target.get('vps_ip')} failed")
+            return label, ok, time.monotonic() - started
+
+        started = time.monotonic()
+        try:
+            for number, batch in enumerate(batches, 1):
+                self.stdout.write(f"\nBatch {number}/{len(batches)}: {', '.join(t.get('vps_ip', '?') for t in batch)}")
+                with ThreadPoolExecutor(max_workers=len(batch)) as executor:
+                    results = list(executor.map(deploy_host, batch))
+                for label, ok, seconds in results:
+                    status = self.style.SUCCESS("ok") if ok else self.style.ERROR("failed")
+                    self.stdout.write(f"  {label}  {status}  {seconds:.1f}s")
+                failed = [label.strip() for label, ok, _ in results if not ok]
+                if failed:
+                    skipped = sum(len(batch) for batch in batches[number:])
+                    self.stderr.write(
+                        self.style.ERROR(
+                            f"Batch {number} failed on {', '.join(failed)}; "
+                            f"{skipped} remaining servers were not deployed."
+                        )
+                    )
+                    return
+            self.stdout.write(
+                self.style.SUCCESS(f"\nDeployed to {len(targets)} servers in {time.monotonic() - started:.1f}s.")
+            )
+        finally:
+            if self.image_distribution:
+                self.image_distribution.cleanup(log=lambda message: self.stderr.write(self.style.WARNING(message)))
+
+    def _deploy_as_rollout_host(self, parent: "Command", target: dict, kwargs: dict) -> bool:
+        """Deploy to one server of a rollout, sharing the configuration, local caches and gates of `parent`."""
+        self._apply_options(kwargs)
+        self.project_root_dir = parent.project_root_dir
+        self.shared_config = parent.deployment_config
+        self.config_lock = parent.config_lock
+        self.plan_lock = parent.plan_lock
+        self.launch_gate = parent.launch_gate
+        self.health_check = parent.health_check
+        self.image_distribution = parent.image_distribution
+        self.build = parent.build
+        if self.builds_image:
+            # The other servers wait for a rebuilt image, never for a hot reload
+            self.fast = False
+        self.deployment_config = json.loads(json.dumps(parent.deployment_config))
+        self.vps_ip = target.get("vps_ip")
+        self.ssh_user = target.get("ssh_user", "root")
+        self.path_to_ssh_key = target.get("path_to_ssh_key", str(Path.home() / ".ssh" / "id_rsa"))
+        if not self._validate_inputs():
+            return False
+        self.remote_path = target.get("remote_path") or self._default_remote_path()
+        self.ssh_settings = self.deployment_config.get("ssh_tuning", {}).get(self.vps_ip)
+        self.persist = self.deployment_config.get("ssh_persist", 0)
+        if kwargs.get("output_log"):
+            self.output_log = OutputLog(self._local_state_path(OUTPUT_LOG_FILENAME))
+        return self._deploy()
+
+    def _local_state_path(self, filename: str) -> Path:
+        """Path of a local state file, one per server during a rollout so concurrent deploys keep theirs apart."""
+        if self.shared_config is None:
+            return self.project_root_dir / filename
+        stem, _, suffix = filename.rpartition(".")
+        return self.project_root_dir / f"{stem}.{self.vps_ip}.{suffix}"
+
+    def _locate_project_root(self) -> bool:
+        """Find the project root from the settings module. Returns False on failure."""
+        # Validate settings module
+        if not self.settings_module:
+            self.stderr.write(self.style.ERROR("DJANGO_SETTINGS_MODULE is not set"))
+            return False
+
+        try:
+            settings_file = Path(importlib.import_module(self.settings_module).__file__)
+        except Exception as e:
+            self.stderr.write(self.style.ERROR(f"Could not locate settings module: {e}"))
+            return False
+
+        self.project_root_dir = settings_file.parent.parent
+        return True
+
+    def _default_remote_path(self) -> str:
+        return "/root/app" if self.ssh_user == "root" else f"/home/{self.ssh_user}/app"
+
     def _load_deployment_config(self) -> dict:
         """Load deployment configuration from file if it exists."""
         config_path = self.project_root_dir / "deployment_target.json"
@@ -120,47 +492,95 @@ class Command(BaseCommand):
         self.path_to_ssh_key = str(Path(self.path_to_ssh_key).expanduser())
         return True
 
-    def _save_deployment_config(self):
-        """Save deployment configuration for future use."""
+    def _save_deployment_config(self, update=None):
+        """
+        Save deployment configuration for future use.
+
+        Steps run in several threads, so changes to the configuration go through `update`,
+        called with it under config_lock together with the save.
+        """
         config_path = self.project_root_dir / "deployment_target.json"
         try:
-            with open(config_path, "w") as f:
-                json.dump(
-                    {
-                        "vps_ip": self.vps_ip,
-                        "ssh_user": self.ssh_user,
-                        "path_to_ssh_key": self.path_to_ssh_key,
-                    },
-                    f,
-                    indent=2,
-                )
+            with self.config_lock:
+                if update is not None:
+                    update(self.deployment_config)
+                config = self.deployment_config
+                if self.shared_config is not None:
+                    # A server of a rollout only records what it learned about itself
+                    config = self.shared_config
+                    for key in PER_HOST_CONFIG_KEYS:
+                        if self.vps_ip in self.deployment_config.get(key, {}):
+                            config.setdefault(key, {})[self.vps_ip] = self.deployment_config[key][self.vps_ip]
+                elif self.vps_ip:
+                    config.update(
+                        {
+                            "vps_ip": self.vps_ip,
+                            "ssh_user": self.ssh_user,
+                            "path_to_ssh_key": self.path_to_ssh_key,
+                        }
+                    )
+                with open(config_path, "w") as f:
+                    json.dump(config, f, indent=2)
         except IOError as e:
             self.stderr.write(self.style.WARNING(f"Could not save deployment config: {e}"))
 
-    def _deploy(self):
-        """Execute the deployment process."""
+    def _deploy(self) -> bool:
+        """Execute the deployment process. Returns whether it succeeded."""
         ssh = None
-        try:
-            # Connect to VPS
+        succeeded = False
+
+        def connect():
+            nonlocal ssh
             self.stdout.write("Connecting to VPS...")
             ssh = self._create_ssh_client()
+            self._monitor_connection(ssh)
             self.stdout.write(self.style.SUCCESS("  Connected."))
 
-            # Upload project
-            self.stdout.write(f"Uploading project to {self.remote_path}...")
-            self._upload_project(ssh)
-            self.stdout.write(self.style.SUCCESS("  Upload complete."))
-
-            # Ensure Docker is installed
-            self.stdout.write("Checking Docker installation...")
-            self._ensure_docker(ssh)
+        def recover(step: Step, error: BaseException) -> bool:
+            """Reconnect after a dropped connection, so the failed step can run again."""
+            nonlocal ssh
+            if ssh is None or not (is_connection_error(error) or transport_lost(ssh)):
+                return False
+            self.stderr.write(self.style.WARNING(f"  Step {step.name} lost the connection: {error}"))
+            if self.checkpoint and self.checkpoint.has_progress:
+                self.checkpoint.save(force=True)
+            if transport_lost(ssh):
+                self.stdout.write("  Reconnecting...")
+                ssh.close()
+                ssh = reconnect(self._create_ssh_client, log=lambda message: self.stderr.write(f"  {message}"))
+                self._monitor_connection(ssh)
+                self.stdout.write(self.style.SUCCESS("  Reconnected."))
+                if self.prebuild is not None:
+                    # The build goes on in the background and its layers stay in the build cache
+                    self.prebuild = None
+            if self.agent and self.agent.closed:
+                self.agent.close()
+                self.agent = None
+                self._start_agent(ssh)
+            self.stdout.write(f"  Retrying step {step.name}...")
+            return True
 
-            # Launch with Docker Compose
-            self.stdout.write("Launching application...")
-            self._launch_docker_compose(ssh)
+        try:
+            pipeline = self._build_pipeline(connect, lambda: ssh)
+            pipeline.run(recover)
 
             self.stdout.write(self.style.SUCCESS("\nDeployment completed successfully!"))
             self.stdout.write(f"Your app should be available at http://{self.vps_ip}:8000")
+            self.stdout.write(
+                "Critical path: "
+                + " -> ".join(f"{step.name} ({step.duration:.1f}s)" for step in pipeline.critical_path())
+            )
+            if self.agent:
+                stats = self.agent.stats()
+                self.stdout.write(
+                    f"Remote agent: {stats['requests']} requests, {stats['commands']} commands, "
+                    f"{stats['bytes_received'] / 1024:.1f} KiB received"
+                )
+
+            succeeded = True
+
+            if self.watch:
+                self._watch(ssh)
 
         except paramiko.AuthenticationException:
             self.stderr.write(self.style.ERROR("Authentication failed. Check your SSH key and username."))
@@ -175,11 +595,139 @@ class Command(BaseCommand):
         except Exception as e:
             self.stderr.write(self.style.ERROR(f"Unexpected error: {e}"))
         finally:
+            if self.checkpoint and self.checkpoint.has_progress:
+                self.checkpoint.save(force=True)
+                self.stdout.write("Upload progress saved, run the command again to resume.")
+            if self.keepalive:
+                self.keepalive.stop()
+            if self.agent:
+                self.agent.close()
             if ssh:
                 ssh.close()
+            if self.local_image and not self.image_distribution:
+                self.local_image.remove()
+            if self.output_log:
+                self.output_log.close()
+                self.stdout.write(f"Command output written to {self.output_log.path}")
+        return succeeded
+
+    def _build_pipeline(self, connect, get_ssh) -> Pipeline:
+        """
+        Declare the deployment steps and what each one waits for.
+
+        Checking Docker runs while the project uploads, and the dependency layers build
+        as soon as both the Docker check and the upload plan are done.
+        """
+        def upload():
+            self.stdout.write(f"Uploading project to {self.remote_path}...")
+            self._upload_project(get_ssh())
+            self.stdout.write(self.style.SUCCESS(f"  Upload complete (release {self.release})."))
+
+        def probe():
+            self._probe_remote(get_ssh())
+            self.stdout.write(f"  Server: {self.remote_env.describe()}")
+            self._start_agent(get_ssh())
+
+        def docker():
+            provisioning = self.remote_env.provisioning
+            if provisioning:
+                verified = time.strftime("%Y-%m-%d %H:%M", time.localtime(provisioning["verified_at"]))
+                self.stdout.write(
+                    self.style.SUCCESS(f"Server already provisioned ({self.remote_env.docker}, checked {verified}).")
+                )
+                return
+            if self.deployment_config.get("provisioning", {}).get(self.vps_ip) and not self.reprovision:
+                self.stdout.write("The server changed since it was provisioned, checking its setup again.")
+            self.stdout.write("Checking Docker installation...")
+            self._ensure_docker(get_ssh())
+            self._save_provisioning(get_ssh())
+
+        def launch():
+            # Wait for the image outside the gate: the server building it may need the gate first
+            if self._receives_image() and not self.image_received and not self._may_hot_reload():
+                self._receive_images(get_ssh())
+            # During a rollout, only a few servers of a batch restart at once
+            with self.launch_gate:
+                # Activate the new release, then launch with Docker Compose
+                self._run_command(get_ssh(), switch_release_command(self.remote_path, self.release))
+                self.stdout.write("Launching application...")
+                if not (self.fast and self._hot_reload(get_ssh())):
+                    self._wait_prebuild()
+                    self._launch_docker_compose(get_ssh())
+                if self.health_check:
+                    self._check_health(get_ssh())
+                if self.builds_image:
+                    self.image_distribution.add_source(self._image_source())
+
+        # Every built-in step but connect can run again after a reconnect: the upload resumes
+        # from its checkpoint and the launch re-attaches to the build running on the server
+        retries = STEP_RETRIES
+        pipeline = Pipeline([
+            Step("connect", connect, requires=["tune"] if self.tune_ssh else []),
+            Step("probe", probe, requires=["connect"], retries=retries),
+            Step("plan", lambda: self._plan_upload(get_ssh()), requires=["probe"], retries=retries),
+            Step("upload", upload, requires=["plan"], retries=retries),
+            Step("docker", docker, requires=["probe"], retries=retries),
+            Step("compose", lambda: self._get_compose_command(get_ssh()), requires=["docker"], retries=retries),
+            Step("prebuild", lambda: self._start_prebuild(get_ssh()), requires=["docker", "plan"], retries=retries),
+            Step("launch", launch, requires=["upload", "compose", "prebuild"], retries=retries),
+            Step("finalize", lambda: self._finalize_release(get_ssh()), requires=["launch"], retries=retries),
+        ])
+        if self.tune_ssh:
+            pipeline.add(Step("tune", self._tune_ssh_settings))
+
+        if self.build == "local" and not self._receives_image():
+            pipeline.add(Step("build", self._build_locally, requires=["probe"]))
+            pipeline.add(
+                Step("ship", lambda: self._ship_local_images(get_ssh()), requires=["build", "docker"], retries=retries),
+                before=["launch"],
+            )
+
+        for step_config in self.deployment_config.get("steps", []):
+            step = self._custom_step(step_config, get_ssh)
+            pipeline.add(step, before=step_config.get("before", []))
+        return pipeline
+
+    def _custom_step(self, step_config: dict, get_ssh) -> Step:
+        """
+        Build a user step from the "steps" list of deployment_target.json.
+
+        A step runs either a shell `command` on the server, from the remote app directory, or a
+        `callable` given as a dotted path and called with this command and the SSH client.
+        """
+        name = step_config.get("name")
+        if not name:
+            raise DeploymentError(f"Deploy step without a name: {step_config}")
+        if step_config.get("callable"):
+            func = import_string(step_config["callable"])
+
+            def run():
+                self.stdout.write(f"Running step {name}...")
+                func(self, get_ssh())
+        elif step_config.get("command"):
+            def run():
+                self.stdout.write(f"Running step {name}...")
+                _, out, _ = self._run_command(
+                    get_ssh(),
+                    f"cd {self.remote_path} && {step_config['command']}",
+                    timeout=step_config.get("timeout", 600),
+                )
+                for line in out.splitlines():
+                    self.stdout.write(f"  {line}")
+        else:
+            raise DeploymentError(f"Deploy step {name} needs a 'command' or a 'callable'")
+        return Step(name, run, requires=step_config.get("after", ["connect"]), retries=step_config.get("retries", 0))
+
+    def _create_ssh_client(self, ssh_settings: dict | None = None) -> paramiko.SSHClient:
+        """
+        Create and connect SSH client with timeout, using the tuned settings for this host.
+
+        With --persist, the connection of the background multiplexer is reused instead
+        (and started if needed). Explicit settings, used by the tuner, always get a new connection.
+        """
+        if self.persist and ssh_settings is None and mux.mux_available():
+            return mux.connect(self.vps_ip, self.ssh_user, self.path_to_ssh_key, self.persist, self.ssh_settings)
 
-    def _create_ssh_client(self) -> paramiko.SSHClient:
-        """Create and connect SSH client with timeout."""
         ssh = paramiko.SSHClient()
         ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         ssh.connect(
@@ -189,69 +737,551 @@ class Command(BaseCommand):
             timeout=30,
             banner_timeout=30,
             auth_timeout=30,
+            **connect_kwargs(ssh_settings or self.ssh_settings),
         )
         return ssh
 
+    def _tune_ssh_settings(self):
+        """Measure SSH settings against this host and save the fastest in deployment_target.json."""
+        self.stdout.write("Tuning SSH transport settings...")
+        payload = build_sample(walk_project(self.project_root_dir))
+        best = tune_ssh(self._create_ssh_client, payload, log=lambda msg: self.stdout.write(f"  {msg}"))
+        if not best["throughput"]:
+            raise DeploymentError("SSH tuning failed: no setting could be measured")
+
+        self.ssh_settings = best
+        tuning = {**best, "tuned_at": int(time.time())}
+        self._save_deployment_config(lambda config: config.setdefault("ssh_tuning", {}).update({self.vps_ip: tuning}))
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"  Best: cipher={best['cipher'] or 'default'}, window={best['window_size'] // 1024} KiB, "
+                f"packet={best['max_packet_size'] // 1024} KiB, compression={'on' if best['compress'] else 'off'} "
+                f"({best['throughput'] / 1024 / 1024:.2f} MiB/s)"
+            )
+        )
+
+    def _probe_remote(self, ssh: paramiko.SSHClient):
+        """Create the remote directory and take the snapshot later steps read instead of querying the server."""
+        self.remote_env = probe_remote(ssh, self.remote_path, trust_provisioning=not self.reprovision)
+
+    def _save_provisioning(self, ssh: paramiko.SSHClient):
+        """
+        Record on the server, and in deployment_target.json, that its Docker setup was checked.
+
+        The next probe on the same host fingerprint reads Docker and compose from this state.
+        """
+        if not self.remote_env.compose:
+            return
+        state = self.remote_env.provisioning_state()
+        self._write_remote_file(ssh, f"{self.remote_path}/{PROVISION_STATE_FILENAME}", json.dumps(state).encode())
+        self.remote_env.provisioning = state
+        self._save_deployment_config(lambda config: config.setdefault("provisioning", {}).update({self.vps_ip: state}))
+
+    def _monitor_connection(self, ssh: paramiko.SSHClient):
+        """Send keepalives and close the transport once they go unanswered, so a dead connection fails fast."""
+        if self.keepalive:
+            self.keepalive.stop()
+        transport = ssh.get_transport()
+        # The multiplexer keeps its own connection alive
+        if isinstance(transport, paramiko.Transport):
+            self.keepalive = KeepaliveMonitor(transport).start()
+
+    def _start_agent(self, ssh: paramiko.SSHClient):
+        """Start the remote agent that later file operations and commands go through, when python3 is there."""
+        if not self.remote_env.python3 or (self.agent and not self.agent.closed):
+            return
+        try:
+            self.agent = RemoteAgent.start(ssh)
+        except (DeploymentError, paramiko.SSHException) as e:
+            self.stderr.write(self.style.WARNING(f"  Could not start the remote agent, using plain commands: {e}"))
+
+    def _write_remote_file(self, ssh: paramiko.SSHClient, remote_file: str, data: bytes):
+        if self.agent:
+            self.agent.write_file(remote_file, data)
+        else:
+            write_remote_file(ssh, remote_file, data)
+
+    def _read_remote_file(self, ssh: paramiko.SSHClient, remote_file: str) -> bytes | None:
+        if self.agent:
+            return self.agent.read_file(remote_file)
+        return read_remote_file(ssh, remote_file)
+
+    def _remove_remote_files(self, ssh: paramiko.SSHClient, remote_path: str, relative_paths: list[str]):
+        if self.agent:
+            self.agent.remove_files(remote_path, relative_paths)
+        else:
+            remove_remote_files(ssh, remote_path, relative_paths)
+
+    def _plan_upload(self, ssh: paramiko.SSHClient):
+        """Compare the project against the manifest of the current release."""
+        self.previous_release = self.remote_env.current_release
+
+        self.ignore_matcher = IgnoreMatcher.for_project(self.project_root_dir)
+        files = self._collect_files()
+        if not files:
+            raise DeploymentError("No files to upload")
+
+        # Compare against the manifest left by the previous deploy
+        remote_manifest = {}
+        if self.previous_release and not self.full_upload:
+            remote_manifest = self._fetch_remote_manifest(ssh)
+        # The servers of a rollout share the hash cache, the first one fills it for the others
+        with self.plan_lock:
+            hash_cache = HashCache.load(self.project_root_dir / HASH_CACHE_FILENAME)
+            local_manifest = build_manifest(files, remote_manifest, hash_cache)
+            try:
+                hash_cache.save()
+            except OSError as e:
+                self.stderr.write(self.style.WARNING(f"  Could not save hash cache: {e}"))
+        self.local_manifest = local_manifest
+        changed, deleted = diff_manifests(local_manifest, remote_manifest)
+        self.changeset = Changeset(changed, deleted) if self.previous_release else None
+        self.stdout.write(
+            f"  {len(changed)} changed, {len(deleted)} deleted, {len(files) - len(changed)} unchanged files."
+        )
+        self.upload_plan = (files, remote_manifest, changed, deleted)
+
     def _upload_project(self, ssh: paramiko.SSHClient):
-        """Upload project files to remote server."""
-        ignore_patterns = {
-            "venv",
-            ".venv",
-            "env",
-            ".env",
-            "__pycache__",
-            ".git",
-            ".idea",
-            "node_modules",
-            "*.pyc",
-            ".DS_Store",
+        """Upload project files changed since the current release into a new release directory."""
+        files, remote_manifest, changed, deleted = self.upload_plan
+        local_manifest = self.local_manifest
+        files_by_path = {relative_path.as_posix(): (local_path, relative_path) for local_path, relative_path in files}
+
+        # Pick up where an interrupted upload to this target stopped
+        self.checkpoint = UploadCheckpoint.load(
+            self._local_state_path(UPLOAD_STATE_FILENAME), self.vps_ip, self.remote_path
+        )
+        self._prepare_release(ssh)
+        already_uploaded, partial_offsets = self._verify_resume(ssh, local_manifest, changed)
+        base = None if self.full_upload else self.previous_release
+        self.checkpoint.begin(local_manifest, already_uploaded, self.release, base)
+        changed = [path for path in changed if path not in already_uploaded]
+        files_to_upload = [files_by_path[path] for path in changed]
+        payload_bytes = sum(local_manifest[path]["size"] for path in changed)
+        backend = self._select_backend(ssh, payload_bytes) if files_to_upload else None
+
+        # rsync already sends only the changed blocks, the other backends need help for large files.
+        # Deltas and chunks are computed in Python, which is slower than a fast link: they are
+        # skipped on links measured faster than the computation
+        link_rate = self._link_rate()
+        if backend and not backend.handles_deltas:
+            # Large files the remote already has a version of only need their changed blocks
+            delta_candidates = [
+                files_by_path[path] for path in changed
+                if path in remote_manifest and path not in partial_offsets
+                and local_manifest[path]["size"] >= DELTA_MIN_SIZE
+            ] if link_rate is None or link_rate < DELTA_RATE else []
+            patched = self._upload_deltas(ssh, delta_candidates) if delta_candidates else set()
+            files_to_upload = [f for f in files_to_upload if f[1].as_posix() not in patched]
+
+            # Finish partially uploaded large files from their byte offset
+            sftp = self._make_backend("sftp", ssh)
+            if partial_offsets and sftp.available():
+                self.stdout.write(f"  Resuming {len(partial_offsets)} partially uploaded files...")
+                sftp.upload([files_by_path[path] for path in partial_offsets], offsets=partial_offsets)
+                files_to_upload = [f for f in files_to_upload if f[1].as_posix() not in partial_offsets]
+
+            # Large files only send the content-defined chunks the remote does not have yet
+            chunk_candidates = [
+                f for f in files_to_upload if local_manifest[f[1].as_posix()]["size"] >= CHUNK_MIN_SIZE
+            ] if link_rate is None or link_rate < CHUNKING_RATE else []
+            if chunk_candidates:
+                chunked = self._upload_chunked(ssh, chunk_candidates, local_manifest)
+                files_to_upload = [f for f in files_to_upload if f[1].as_posix() not in chunked]
+
+        if files_to_upload:
+            stats = backend.run(files_to_upload)
+            self.stdout.write(
+                f"  {stats.backend}: {stats.files} files, {stats.payload_bytes / 1024:.1f} KiB "
+                f"({stats.bytes_sent / 1024:.1f} KiB sent) in {stats.seconds:.1f}s"
+            )
+            self._save_deployment_config(
+                lambda config: record_stats(config.setdefault("transport_stats", {}).setdefault(self.vps_ip, {}), stats)
+            )
+
+        if deleted:
+            self._remove_remote_files(ssh, self.release_path, deleted)
+
+        self._prune_chunk_store(ssh, local_manifest, remote_manifest)
+
+        # Keep the remote Docker build context as small as the upload
+        if not (self.project_root_dir / ".dockerignore").exists():
+            dockerignore = self.ignore_matcher.to_dockerignore() + f"{MANIFEST_FILENAME}\n{CHUNK_STORE_DIRNAME}\n"
+            self._write_remote_file(ssh, f"{self.release_path}/.dockerignore", dockerignore.encode())
+
+        # Record what the release holds for the next deploy
+        self._write_remote_file(ssh, f"{self.release_path}/{MANIFEST_FILENAME}", dump_manifest(local_manifest))
+        self.checkpoint.clear()
+        self.checkpoint = None
+
+    def _start_prebuild(self, ssh: paramiko.SSHClient):
+        """Start building the dependency layers of the image while the rest of the project uploads."""
+        if self._may_hot_reload() or self._receives_image() or self.build == "local":
+            return
+
+        dockerfile_path = self.project_root_dir / "prod.Dockerfile"
+        try:
+            stage = dependency_stage(dockerfile_path.read_text())
+        except OSError:
+            return
+        if stage is None:
+            return
+        dockerfile, sources = stage
+
+        # The build cache already holds these layers when none of their inputs changed
+        changed = self.upload_plan[2]
+        if self.changeset is not None and not {"prod.Dockerfile", *sources} & set(changed):
+            return
+        try:
+            files = {source: (self.project_root_dir / source).read_bytes() for source in sources}
+        except OSError:
+            return
+
+        self.stdout.write("  Building dependency layers in the background...")
+        image = prebuild_image(compose_project_name(self.remote_path))
+        self.prebuild = DependencyPrebuild(ssh, self.remote_path, image)
+        try:
+            self.prebuild.start(dockerfile, files)
+        except (paramiko.SSHException, OSError) as e:
+            self.stderr.write(self.style.WARNING(f"  Could not start the dependency build: {e}"))
+            self.prebuild = None
+
+    def _wait_prebuild(self):
+        """Wait for the background dependency build, the full build redoes it if it failed."""
+        if self.prebuild is None:
+            return
+        self.stdout.write("  Waiting for the dependency layers...")
+        ok, log_tail = self.prebuild.wait()
+        self.prebuild = None
+        if ok:
+            self.stdout.write(self.style.SUCCESS("  Dependency layers ready."))
+        else:
+            self.stderr.write(self.style.WARNING(f"  Dependency prebuild failed, building from scratch:\n{log_tail}"))
+
+    def _watch(self, ssh: paramiko.SSHClient):
+        """Push saved changes to the current release until interrupted."""
+        watcher = create_watcher(self.project_root_dir, self.ignore_matcher)
+        backend = next(
+            (b for b in (self._make_backend(name, ssh) for name in ("agent", "tar", "sftp")) if b.available()),
+            self._make_backend("scp", ssh),
+        )
+        compose = self._compose_in_current(self._get_compose_command(ssh))
+        self.stdout.write(f"\nWatching {self.project_root_dir} for changes (Ctrl+C to stop)...")
+        try:
+            for changed in batches(watcher):
+                self._push_changes(ssh, backend, compose, sorted(changed))
+        except KeyboardInterrupt:
+            self.stdout.write("Stopped watching.")
+        finally:
+            watcher.close()
+
+    def _push_changes(self, ssh: paramiko.SSHClient, backend, compose: str, paths: list[str]):
+        """Sync changed paths into the current release, then reload or rebuild the app."""
+        start = time.perf_counter()
+        files = [(self.project_root_dir / path, Path(path)) for path in paths if (self.project_root_dir / path).is_file()]
+        deleted = [path for path in paths if not (self.project_root_dir / path).exists()]
+
+        if files:
+            backend.upload(files)
+        if deleted:
+            self._remove_remote_files(ssh, self.release_path, deleted)
+
+        # Keep the release manifest in step so the next deploy only sends newer changes
+        self.local_manifest.update(build_manifest(files))
+        for path in deleted:
+            self.local_manifest.pop(path, None)
+        self._write_remote_file(ssh, f"{self.release_path}/{MANIFEST_FILENAME}", dump_manifest(self.local_manifest))
+
+        changeset = Changeset([path.as_posix() for _, path in files], deleted)
+        if not changeset.needs_rebuild:
+            self._reload_containers(ssh, compose, changeset)
+            action = "reloaded"
+        else:
+            self._run_command(ssh, f"{compose} up -d --build --remove-orphans", timeout=600, stream=True)
+            action = "rebuilt"
+        self.stdout.write(
+            f"  Synced {len(files)} changed, {len(deleted)} deleted files and {action} "
+            f"in {time.perf_counter() - start:.1f}s"
+        )
+
+    def _hot_reload(self, ssh: paramiko.SSHClient) -> bool:
+        """
+        Apply a code-only changeset to the running containers without rebuilding the image.
+
+        Returns:
+            False when a full `compose up --build` is needed instead
+        """
+        if self.changeset is None:
+            self.stdout.write("  No previous release, doing a full build.")
+            return False
+        self.stdout.write(f"  Changes: {self.changeset.describe()}")
+        if self.changeset.needs_rebuild:
+            return False
+
+        compose = self._compose_in_current(self._get_compose_command(ssh))
+        if not self._reload_containers(ssh, compose, self.changeset):
+            self.stdout.write("  No running containers, doing a full build.")
+            return False
+
+        self.hot_reloaded = True
+        self.stdout.write(self.style.SUCCESS("  Application reloaded without rebuilding."))
+        return True
+
+    def _reload_containers(self, ssh: paramiko.SSHClient, compose: str, changeset: Changeset) -> bool:
+        """Copy a changeset into each running container and reload gunicorn. False if none is running."""
+        _, container_ids, _ = self._run_command(ssh, f"{compose} ps -q", check=False)
+        if not container_ids.split():
+            return False
+        for container_id in container_ids.split():
+            self._run_command(ssh, hot_reload_command(container_id, self.release_path, changeset), timeout=300)
+        return True
+
+    def _make_backend(self, name: str, ssh: paramiko.SSHClient):
+        return BACKENDS[name](
+            ssh,
+            self.release_path,
+            local_root=self.project_root_dir,
+            host=self.vps_ip,
+            user=self.ssh_user,
+            key_path=self.path_to_ssh_key,
+            jobs=self.jobs,
+            checkpoint=self.checkpoint,
+            remote=self.remote_env,
+            agent=self.agent,
+            log=lambda message: self.stdout.write(f"  {message}"),
+        )
+
+    def _select_backend(self, ssh: paramiko.SSHClient, payload_bytes: int):
+        """Return the backend forced with --transport, or the fastest one known for this host."""
+        if self.transport != "auto":
+            backend = self._make_backend(self.transport, ssh)
+            if not backend.available():
+                raise DeploymentError(f"Transport '{self.transport}' is not available for this server")
+            return backend
+
+        backends = {name: self._make_backend(name, ssh) for name in BACKENDS}
+        with self.config_lock:
+            history = dict(self.deployment_config.get("transport_stats", {}).get(self.vps_ip, {}))
+        return choose_backend(backends, history, payload_bytes)
+
+    def _prepare_release(self, ssh: paramiko.SSHClient):
+        """
+        Create the release directory the upload goes into.
+
+        An interrupted upload is resumed in its own release directory; otherwise a new
+        release is seeded with hardlinks to the current one so unchanged files are not copied.
+        The interrupted release is only reused when it was seeded from the current release:
+        the files to upload were computed against that one. A full upload always starts afresh.
+        """
+        resumable = self.checkpoint.release if self.checkpoint.has_progress else None
+        if (
+            resumable
+            and resumable != self.previous_release
+            and self.checkpoint.base == self.previous_release
+            and not self.full_upload
+        ):
+            exit_code, _, _ = self._run_command(
+                ssh, f"test -d {release_path(self.remote_path, resumable)}", check=False
+            )
+            if exit_code == 0:
+                self.release = resumable
+                self.release_path = release_path(self.remote_path, resumable)
+                return
+        # Progress recorded for another release directory says nothing about the new one
+        self.checkpoint.clear()
+
+        _, listing, _ = self._run_command(ssh, list_releases_command(self.remote_path), check=False)
+        self.release = new_release_name(listing.split())
+        self.release_path = release_path(self.remote_path, self.release)
+        previous = None if self.full_upload else self.previous_release
+        self._run_command(ssh, prepare_release_command(self.remote_path, self.release, previous), timeout=300)
+
+    def _finalize_release(self, ssh: paramiko.SSHClient):
+        """Tag the images of the new release and delete releases beyond --keep-releases."""
+        images = compose_image_names(self.project_root_dir / "docker-compose.yaml")
+        # A hot-reloaded release runs on the previous image, so it gets no image tag of its own:
+        # rolling back to it rebuilds from its directory instead
+        if images and not self.hot_reloaded:
+            self._run_command(ssh, tag_release_images_command(images, self.release), check=False)
+
+        _, listing, _ = self._run_command(ssh, list_releases_command(self.remote_path), check=False)
+        stale = releases_to_prune(listing.split(), self.release, self.keep_releases)
+        if stale:
+            self._run_command(ssh, prune_releases_command(self.remote_path, stale, images), check=False)
+            self.stdout.write(f"  Removed {len(stale)} old releases.")
+
+    def _verify_resume(self, ssh: paramiko.SSHClient, local_manifest: dict, changed: list[str]):
+        """
+        Check the progress recorded by an interrupted upload against the remote.
+
+        Returns:
+            Tuple of (paths already fully uploaded, {path: offset} of partial files to resume)
+        """
+        if not self.checkpoint.has_progress:
+            return set(), {}
+
+        completed, partial = self.checkpoint.resumable(local_manifest, changed)
+        paths = sorted(completed | partial.keys())
+        if self.agent:
+            remote_sizes = self.agent.file_sizes(self.release_path, paths)
+        else:
+            remote_sizes = remote_file_sizes(ssh, self.release_path, paths)
+
+        verified = {path for path in completed if remote_sizes.get(path) == local_manifest[path]["size"]}
+        if self.agent and HASH_ALGORITHM == "blake2b" and verified:
+            # The agent hashes like the manifest does, so completed files are checked by content too
+            remote_hashes = self.agent.hash_files(self.release_path, sorted(verified))
+            verified = {path for path in verified if remote_hashes.get(path) == local_manifest[path]["hash"]}
+        offsets = {
+            path: remote_sizes[path] for path in partial
+            if 0 < remote_sizes.get(path, 0) < local_manifest[path]["size"]
         }
+        if verified or offsets:
+            self.stdout.write(
+                f"  Resuming interrupted upload: {len(verified)} files already on the remote"
+                + (f", {len(offsets)} partial." if offsets else ".")
+            )
+        return verified, offsets
+
+    def _link_rate(self) -> float | None:
+        """Best upload throughput measured to this server in bytes per second, None before any measurement."""
+        with self.config_lock:
+            history = self.deployment_config.get("transport_stats", {}).get(self.vps_ip, {})
+            rates = [entry["rate"] for entry in history.values() if entry.get("rate")]
+        return max(rates) if rates else None
+
+    def _upload_deltas(self, ssh: paramiko.SSHClient, candidates: list[tuple[Path, Path]]) -> set[str]:
+        """
+        Send changed large files as deltas against their remote copies.
 
-        # Create remote directory
-        self._run_command(ssh, f"mkdir -p {self.remote_path}")
+        Returns:
+            Relative paths that were patched; the others need a full upload
+        """
+        if not self.remote_env.python3:
+            self.stdout.write("  No python3 on the remote for the delta helper, sending full files.")
+            return set()
 
-        # Collect files to upload
-        files_to_upload = []
-        for item in self.project_root_dir.rglob("*"):
-            # Skip ignored patterns
-            if any(ignored in item.parts for ignored in ignore_patterns):
+        block_sizes = {
+            f"{self.release_path}/{relative_path.as_posix()}": block_size_for(local_path.stat().st_size)
+            for local_path, relative_path in candidates
+        }
+        if self.agent:
+            signatures = self.agent.signatures(block_sizes)
+        else:
+            signatures = fetch_delta_signatures(ssh, block_sizes)
+        if signatures is None:
+            self.stdout.write("  Delta helper unavailable on remote (python3 missing?), sending full files.")
+            return set()
+
+        patched = set()
+        for local_path, relative_path in candidates:
+            remote_file = f"{self.release_path}/{relative_path.as_posix()}"
+            signature = signatures.get(remote_file)
+            if not signature:
                 continue
-            if item.is_file():
-                relative_path = item.relative_to(self.project_root_dir)
-                files_to_upload.append((item, relative_path))
 
-        if not files_to_upload:
-            raise DeploymentError("No files to upload")
+            block_size = block_sizes[remote_file]
+            # Mapped rather than read: candidates can be assets of several GB
+            with open(local_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                size = len(data)
+                payload = encode_delta(compute_delta(data, signature, block_size))
+                sha256 = hashlib.sha256(data).hexdigest()
+            if len(payload) >= size * 0.9:
+                continue
 
-        # Create all necessary directories first
-        directories = set()
-        for _, relative_path in files_to_upload:
-            if relative_path.parent != Path("."):
-                directories.add(str(relative_path.parent))
-
-        if directories:
-            # Create all directories in one command
-            dir_paths = " ".join(f"{self.remote_path}/{d}" for d in sorted(directories))
-            self._run_command(ssh, f"mkdir -p {dir_paths}")
-
-        # Upload files
-        total_files = len(files_to_upload)
-        with SCPClient(ssh.get_transport()) as scp:
-            for i, (local_path, relative_path) in enumerate(files_to_upload, 1):
-                remote_file_path = f"{self.remote_path}/{relative_path}"
-                try:
-                    scp.put(str(local_path), remote_path=remote_file_path)
-                    if i % 10 == 0 or i == total_files:
-                        self.stdout.write(f"  Uploaded {i}/{total_files} files...")
-                except SCPException as e:
-                    raise DeploymentError(f"Failed to upload {relative_path}: {e}")
+            try:
+                if self.agent:
+                    self.agent.apply_delta(remote_file, block_size, payload, sha256)
+                else:
+                    apply_remote_delta(ssh, remote_file, block_size, payload, sha256)
+            except DeploymentError as e:
+                self.stderr.write(self.style.WARNING(f"  {e}, sending full file."))
+                continue
+
+            patched.add(relative_path.as_posix())
+            self.checkpoint.file_done(relative_path.as_posix())
+            self.stdout.write(f"  Delta {relative_path}: sent {len(payload) / 1024:.1f} of {size / 1024:.1f} KiB")
+        return patched
+
+    def _upload_chunked(
+        self, ssh: paramiko.SSHClient, candidates: list[tuple[Path, Path]], local_manifest: dict
+    ) -> set[str]:
+        """
+        Upload large files through the remote chunk store.
+
+        Each file is split into content-defined chunks; only chunks missing from the
+        store are sent, then the files are rebuilt on the remote from their chunks.
+
+        Returns:
+            Relative paths that were uploaded; the others need a regular upload
+        """
+        compression = detect_archive_compression(ssh, self.remote_env)
+        if not compression:
+            return set()
+
+        store = f"{self.remote_path}/{CHUNK_STORE_DIRNAME}"
+        recipes = {}
+        locations = {}
+        for local_path, relative_path in candidates:
+            chunks = chunk_file(local_path)
+            recipes[relative_path.as_posix()] = [chunk_id for chunk_id, _, _ in chunks]
+            for chunk_id, offset, length in chunks:
+                locations.setdefault(chunk_id, (local_path, offset, length))
+
+        try:
+            missing = missing_remote_chunks(ssh, store, list(locations))
+            sent = 0
+            if missing:
+                sent = stream_chunks(
+                    ssh,
+                    ((chunk_id, read_chunk(*locations[chunk_id])) for chunk_id in sorted(missing)),
+                    store,
+                    compression,
+                )
+            assemble_remote_files(ssh, store, self.release_path, recipes)
+        except DeploymentError as e:
+            self.stderr.write(self.style.WARNING(f"  Chunked upload failed ({e}), sending full files."))
+            return set()
+
+        for path, chunk_ids in recipes.items():
+            local_manifest[path]["chunks"] = chunk_ids
+            self.checkpoint.file_done(path)
+        self.stdout.write(
+            f"  Chunked {len(recipes)} large files: sent {len(missing)}/{len(locations)} chunks"
+            f" ({sent / 1024:.1f} KiB)."
+        )
+        return set(recipes)
+
+    def _prune_chunk_store(self, ssh: paramiko.SSHClient, local_manifest: dict, remote_manifest: dict):
+        """Carry chunk lists over for unchanged files and delete chunks no file uses anymore."""
+        for path, entry in local_manifest.items():
+            previous = remote_manifest.get(path, {})
+            if "chunks" not in entry and previous.get("chunks") and previous.get("hash") == entry["hash"]:
+                entry["chunks"] = previous["chunks"]
+
+        in_use = {chunk_id for entry in local_manifest.values() for chunk_id in entry.get("chunks", ())}
+        stale = {
+            chunk_id for entry in remote_manifest.values() for chunk_id in entry.get("chunks", ())
+        } - in_use
+        if stale:
+            self._remove_remote_files(ssh, f"{self.remote_path}/{CHUNK_STORE_DIRNAME}", sorted(stale))
+
+    def _fetch_remote_manifest(self, ssh: paramiko.SSHClient) -> dict:
+        """Read the manifest of the previous deploy from the remote, if any."""
+        # Read as a file: command output only keeps its tail, and the manifest is one long line
+        content = self._read_remote_file(ssh, f"{self.remote_path}/{CURRENT_LINK}/{MANIFEST_FILENAME}")
+        if content is None:
+            return {}
+        return parse_manifest(content.decode())
+
+    def _collect_files(self) -> list[tuple[Path, Path]]:
+        """Collect (local_path, relative_path) tuples for every file to upload."""
+        return walk_project(self.project_root_dir, self.ignore_matcher)
 
     def _ensure_docker(self, ssh: paramiko.SSHClient):
         """Ensure Docker is installed on the remote server."""
-        exit_code, _, _ = self._run_command(ssh, "docker --version", check=False)
-
-        if exit_code == 0:
-            self.stdout.write(self.style.SUCCESS("  Docker is already installed."))
+        if self.remote_env.docker:
+            self.stdout.write(self.style.SUCCESS(f"  Docker is already installed: {self.remote_env.docker}"))
             return
 
         self.stdout.write("  Docker not found. Installing...")
@@ -269,16 +1299,16 @@ class Command(BaseCommand):
         for cmd in install_commands:
             self.stdout.write(f"    Running: {cmd[:50]}...")
             try:
-                self._run_command(ssh, cmd, timeout=300)
+                self._run_command(ssh, cmd, timeout=300, stream=True)
             except DeploymentError as e:
                 self.stderr.write(self.style.WARNING(f"    Warning: {e}"))
 
-        # Verify installation
-        exit_code, version, _ = self._run_command(ssh, "docker --version", check=False)
-        if exit_code != 0:
+        # Verify installation, the snapshot also needs the compose command that came with it
+        self._probe_remote(ssh)
+        if not self.remote_env.docker:
             raise DeploymentError("Failed to install Docker. Please install it manually.")
 
-        self.stdout.write(self.style.SUCCESS(f"  Docker installed: {version}"))
+        self.stdout.write(self.style.SUCCESS(f"  Docker installed: {self.remote_env.docker}"))
 
     def _launch_docker_compose(self, ssh: paramiko.SSHClient):
         """Launch the application using Docker Compose."""
@@ -288,45 +1318,162 @@ class Command(BaseCommand):
         self.stdout.write(f"  Using: {compose_cmd}")
 
         # Build and start containers
-        cmd = f"cd {self.remote_path} && {compose_cmd} up -d --build --force-recreate --remove-orphans"
+        compose = self._compose_in_current(compose_cmd)
+        # A server that received the image from another one must not rebuild it
+        build = "--no-build" if self.image_received else "--build"
+        cmd = f"{compose} up -d {build} --force-recreate --remove-orphans"
 
         self.stdout.write("  Building and starting containers (this may take a few minutes)...")
-        exit_code, stdout, stderr = self._run_command(ssh, cmd, timeout=600, check=False)
+        exit_code = self._run_detached(ssh, "compose-up", cmd, timeout=600)
 
         if exit_code != 0:
             # Show logs for debugging
             self.stderr.write(self.style.ERROR(f"  Docker Compose failed (exit code {exit_code})"))
-            if stderr:
-                self.stderr.write(f"  Error output:\n{stderr}")
 
             # Try to get container logs
             self.stdout.write("  Fetching container logs for debugging...")
             _, logs, _ = self._run_command(
-                ssh, f"cd {self.remote_path} && {compose_cmd} logs --tail=50", check=False, timeout=30
+                ssh, f"{compose} logs --tail=50", check=False, timeout=30
             )
             if logs:
                 self.stdout.write(f"  Container logs:\n{logs}")
 
-            raise DeploymentError("Docker Compose failed to start the application")
+            raise DeploymentError(
+                "Docker Compose failed to start the application "
+                "(run django_prod_rollback to go back to the previous release)"
+            )
 
         self.stdout.write(self.style.SUCCESS("  Application started successfully."))
 
         # Show running containers
-        _, ps_output, _ = self._run_command(ssh, f"cd {self.remote_path} && {compose_cmd} ps", check=False)
+        _, ps_output, _ = self._run_command(ssh, f"{compose} ps", check=False)
         if ps_output:
             self.stdout.write(f"  Running containers:\n{ps_output}")
 
+    def _may_hot_reload(self) -> bool:
+        """Whether --fast can skip the image build, as far as the changed files tell."""
+        return bool(self.fast and self.changeset and not self.changeset.needs_rebuild)
+
+    def _receives_image(self) -> bool:
+        """Whether this server of a rollout loads the image built elsewhere instead of building it."""
+        return bool(self.image_distribution) and not self.builds_image
+
+    def _build_locally(self):
+        """Build the image with the local Docker daemon, for the platform of the server."""
+        images = compose_image_names(self.project_root_dir / "docker-compose.yaml")
+        if not images:
+            raise DeploymentError("--build local needs an 'image:' name for the services in docker-compose.yaml")
+        platform = platform_for(self.remote_env.arch)
+        self.stdout.write(f"Building the image locally for {platform or 'this machine'}...")
+        started = time.monotonic()
+        files = walk_project(self.project_root_dir, IgnoreMatcher.for_project(self.project_root_dir))
+        build_images(self.project_root_dir, files, platform, log=lambda line: self.stdout.write(f"    {line}"))
+        self.local_image = LocalImageSource(images, self.remote_env)
+        self.local_image.save()
+        self.stdout.write(self.style.SUCCESS(f"  Image built in {time.monotonic() - started:.1f}s."))
+        if self.image_distribution:
+            self.image_distribution.add_source(self.local_image)
+
+    def _ship_local_images(self, ssh: paramiko.SSHClient):
+        """Load the locally built image on the server, sending only the layers it does not have."""
+        self.stdout.write("Sending the image to the server...")
+        started = time.monotonic()
+        summary = self.local_image.send_to(ssh, self.remote_env)
+        self.image_received = True
+        if self.image_distribution:
+            self.image_distribution.add_source(self._image_source())
+        self.stdout.write(self.style.SUCCESS(f"  Image loaded in {time.monotonic() - started:.1f}s: {summary}."))
+
+    def _image_source(self) -> ImageSource:
+        return ImageSource(self.vps_ip, self._create_ssh_client, self.remote_path, self.remote_env)
+
+    def _receive_images(self, ssh: paramiko.SSHClient):
+        """Load the image built by another server of the rollout instead of building it here."""
+        self.stdout.write("Waiting for the image built on another server...")
+        with self.image_distribution.source() as source:
+            if source.env.arch and self.remote_env.arch and source.env.arch != self.remote_env.arch:
+                raise DeploymentError(
+                    f"The image was built for {source.env.arch}, this server runs {self.remote_env.arch}"
+                )
+            self.stdout.write(f"  Copying the image from {source.label}...")
+            started = time.monotonic()
+            how = send_images(
+                self.image_distribution,
+                source,
+                ssh,
+                f"{self.ssh_user}@{self.vps_ip}",
+                self.remote_env,
+                log=lambda message: self.stderr.write(self.style.WARNING(f"  {message}")),
+            )
+        self.image_received = True
+        # This server can now pass the image on
+        self.image_distribution.add_source(self._image_source())
+        self.stdout.write(self.style.SUCCESS(f"  Image copied {how} in {time.monotonic() - started:.1f}s."))
+
+    def _check_health(self, ssh: paramiko.SSHClient):
+        """
+        Wait until the application answers HTTP requests on the server.
+
+        Raises:
+            DeploymentError: If it does not answer before the health check timeout
+        """
+        url, timeout = self.health_check["url"], self.health_check["timeout"]
+        self.stdout.write(f"  Waiting for {url} to answer...")
+        exit_code, out, _ = self._run_command(
+            ssh, health_check_command(url, timeout), check=False, timeout=timeout + 30
+        )
+        if exit_code != 0:
+            raise DeploymentError(f"Health check failed: {output_tail(out, lines=1)}")
+        self.stdout.write(self.style.SUCCESS(f"  Healthy: {output_tail(out, lines=1)}"))
+
+    def _run_detached(self, ssh: paramiko.SSHClient, name: str, cmd: str, timeout: int = 600) -> int:
+        """
+        Run a long command in the background on the server and stream its output.
+
+        The command keeps running if the connection drops. When the step is retried after
+        reconnecting, its output is followed again from the last line received.
+
+        Returns:
+            Exit code of the command
+        """
+        job_dir = f"{self.remote_path}/{JOBS_DIRNAME}/{name}"
+        if name in self.detached_jobs:
+            self.stdout.write(f"  Re-attaching to {name} on the server...")
+        else:
+            self._run_command(ssh, detached_command(job_dir, cmd))
+            self.detached_jobs[name] = 0
+
+        def count_line(line: str):
+            self.detached_jobs[name] += 1
+
+        exit_code, _, _ = self._run_command(
+            ssh,
+            follow_command(job_dir, self.detached_jobs[name]),
+            check=False,
+            timeout=timeout,
+            stream=True,
+            on_stdout=count_line,
+        )
+        return exit_code
+
+    def _compose_in_current(self, compose_cmd: str) -> str:
+        """Prefix running compose from the current release under a stable project name."""
+        return (
+            f"cd {self.remote_path}/{CURRENT_LINK} && "
+            f"{compose_cmd} -p {compose_project_name(self.remote_path)}"
+        )
+
     def _get_compose_command(self, ssh: paramiko.SSHClient) -> str:
         """Determine which docker compose command to use."""
-        # Try docker compose (v2) first
-        exit_code, _, _ = self._run_command(ssh, "docker compose version", check=False)
-        if exit_code == 0:
-            return "docker compose"
+        if self.compose_cmd:
+            return self.compose_cmd
 
-        # Fall back to docker-compose (v1)
-        exit_code, _, _ = self._run_command(ssh, "docker-compose --version", check=False)
-        if exit_code == 0:
-            return "docker-compose"
+        # The probe prefers docker compose (v2) over docker-compose (v1)
+        if self.remote_env is None:
+            self._probe_remote(ssh)
+        if self.remote_env.compose:
+            self.compose_cmd = self.remote_env.compose
+            return self.compose_cmd
 
         raise DeploymentError("Neither 'docker compose' nor 'docker-compose' is available")
 
@@ -336,6 +1483,8 @@ class Command(BaseCommand):
         cmd: str,
         check: bool = True,
         timeout: int = 120,
+        stream: bool = False,
+        on_stdout=None,
     ) -> tuple[int, str, str]:
         """
         Execute a command on the remote server.
@@ -345,31 +1494,48 @@ class Command(BaseCommand):
             cmd: Command to execute
             check: If True, raise exception on non-zero exit code
             timeout: Command timeout in seconds
+            stream: If True, print output lines as they arrive
+            on_stdout: Called with each stdout line as it arrives
 
         Returns:
-            Tuple of (exit_code, stdout, stderr)
+            Tuple of (exit_code, stdout, stderr), holding only the last OUTPUT_TAIL_BYTES of each
         """
-        stdin, stdout, stderr = ssh.exec_command(cmd, timeout=timeout)
-
-        # Wait for command to complete with timeout
-        start_time = time.time()
-        while not stdout.channel.exit_status_ready():
-            if time.time() - start_time > timeout:
-                raise DeploymentError(f"Command timed out after {timeout}s: {cmd[:50]}...")
-            time.sleep(0.5)
-
-        exit_code = stdout.channel.recv_exit_status()
-        out = stdout.read().decode().strip()
-        err = stderr.read().decode().strip()
+        stdout_callbacks = [lambda line: self.stdout.write(f"    {line}")] if stream else []
+        stderr_callbacks = [lambda line: self.stderr.write(f"    {line}")] if stream else []
+        if on_stdout:
+            stdout_callbacks.append(on_stdout)
+        if self.output_log:
+            command_id = self.output_log.command(cmd)
+            stdout_callbacks.append(self.output_log.writer(command_id, "stdout"))
+            stderr_callbacks.append(self.output_log.writer(command_id, "stderr"))
+
+        # Through the remote agent when it runs, otherwise on a channel of its own
+        run = self.agent.run if self.agent else partial(run_remote, ssh)
+        exit_code, out, err = run(
+            cmd,
+            timeout=timeout,
+            on_stdout=_fan_out(stdout_callbacks),
+            on_stderr=_fan_out(stderr_callbacks),
+        )
+        if self.output_log:
+            self.output_log.exit(command_id, exit_code)
 
         if check and exit_code != 0:
-            error_msg = err or out or f"Command failed with exit code {exit_code}"
+            error_msg = output_tail(err or out) or f"Command failed with exit code {exit_code}"
+            if self.output_log:
+                error_msg += f"\n(full output in {self.output_log.path})"
             raise DeploymentError(f"Command failed: {cmd[:50]}...\n{error_msg}")
 
         return exit_code, out, err
 
 
-class DeploymentError(Exception):
-    """Custom exception for deployment failures."""
+def _fan_out(callbacks: list):
+    """One line callback calling each of `callbacks`, or None when there are none."""
+    if not callbacks:
+        return None
+
+    def on_line(line: str):
+        for callback in callbacks:
+            callback(line)
 
-    pass
+    return on_line
@@ -0,0 +1,113 @@
+import paramiko
+
+from django_prod.exceptions import DeploymentError
+from django_prod.management.commands.django_prod_deploy import Command as DeployCommand
+from django_prod.releases import (
+    compose_image_names,
+    list_releases_command,
+    previous_release,
+    release_image,
+    restore_release_images_command,
+    switch_release_command,
+)
+
+
+class Command(DeployCommand):
+    help = "Roll back the VPS to a previous release"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--release",
+            help="Name of the release to activate (default: the release before the current one)",
+        )
+        parser.add_argument(
+            "--list",
+            action="store_true",
+            help="List the releases available on the server and exit",
+        )
+
+    def handle(self, *args, **kwargs):
+        if not self._locate_project_root():
+            return
+
+        # Use the target saved by django_prod_deploy, prompting only if there is none
+        deployment_target = self._load_deployment_config()
+        if {"vps_ip", "ssh_user", "path_to_ssh_key"} <= deployment_target.keys():
+            self.vps_ip = deployment_target["vps_ip"]
+            self.ssh_user = deployment_target["ssh_user"]
+            self.path_to_ssh_key = deployment_target["path_to_ssh_key"]
+        elif not self._prompt_deployment_details(deployment_target):
+            self.stdout.write("Rollback cancelled.")
+            return
+
+        if not self._validate_inputs():
+            return
+
+        self.remote_path = self._default_remote_path()
+        self.ssh_settings = deployment_target.get("ssh_tuning", {}).get(self.vps_ip)
+        self.persist = deployment_target.get("ssh_persist", 0)
+        self._rollback(kwargs.get("release"), kwargs.get("list", False))
+
+    def _rollback(self, requested: str | None, list_only: bool):
+        """Point `current` at another release and restart the containers on its images."""
+        ssh = None
+        try:
+            ssh = self._create_ssh_client()
+
+            self._probe_remote(ssh)
+            _, listing, _ = self._run_command(ssh, list_releases_command(self.remote_path))
+            current = self.remote_env.current_release
+            releases = sorted(listing.split())
+
+            if list_only:
+                for release in releases:
+                    marker = "*" if release == current else " "
+                    self.stdout.write(f" {marker} {release}")
+                return
+
+            target = requested or self._previous_release(releases, current)
+            if target not in releases:
+                raise DeploymentError(f"Release not found on the server: {target}")
+            if target == current:
+                self.stdout.write(f"Release {target} is already active.")
+                return
+
+            self.stdout.write(f"Rolling back from {current or 'nothing'} to {target}...")
+            self._run_command(ssh, switch_release_command(self.remote_path, target))
+
+            compose_cmd = self._get_compose_command(ssh)
+            compose = self._compose_in_current(compose_cmd)
+
+            # Reuse the images tagged for the release when they still exist
+            images = compose_image_names(self.project_root_dir / "docker-compose.yaml")
+            tagged = images and all(
+                self._run_command(ssh, f"docker image inspect {release_image(image, target)}", check=False)[0] == 0
+                for image in images
+            )
+            if tagged:
+                self._run_command(ssh, restore_release_images_command(images, target))
+                up = f"{compose} up -d --no-build --force-recreate --remove-orphans"
+            else:
+                self.stdout.write("  No images saved for this release, rebuilding...")
+                up = f"{compose} up -d --build --force-recreate --remove-orphans"
+
+            self._run_command(ssh, up, timeout=600)
+            self.stdout.write(self.style.SUCCESS(f"Rolled back to release {target}."))
+
+        except paramiko.AuthenticationException:
+            self.stderr.write(self.style.ERROR("Authentication failed. Check your SSH key and username."))
+        except paramiko.SSHException as e:
+            self.stderr.write(self.style.ERROR(f"SSH connection error: {e}"))
+        except TimeoutError:
+            self.stderr.write(self.style.ERROR("Connection timed out. Check VPS IP and network."))
+        except DeploymentError as e:
+            self.stderr.write(self.style.ERROR(f"Rollback failed: {e}"))
+        finally:
+            if ssh:
+                ssh.close()
+
+    def _previous_release(self, releases: list[str], current: str) -> str:
+        release = previous_release(releases, current)
+        if release is None:
+            raise DeploymentError("No previous release to roll back to")
+        return release
@@ -0,0 +1,186 @@
+"""
+Content manifests used to upload only the files that changed since the last deploy.
+
+A manifest maps each relative path (POSIX style) to its size, mtime and content hash.
+The manifest of the last successful deploy is stored on the remote next to the project.
+
+Hashes of unchanged local files are kept in a local cache next to deployment_target.json,
+keyed by (path, size, mtime_ns, inode), so only files that changed are read again.
+"""
+import hashlib
+import json
+import mmap
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+try:
+    import xxhash
+except ImportError:  # pragma: no cover - optional dependency
+    xxhash = None
+
+from .exceptions import DeploymentError
+
+MANIFEST_FILENAME = ".django_prod_manifest.json"
+HASH_CACHE_FILENAME = ".deployment_hash_cache.json"
+
+HASH_ALGORITHM = "xxh3_128" if xxhash is not None else "blake2b"
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Files at least this large are hashed through mmap instead of buffered reads
+MMAP_MIN_SIZE = 8 * 1024 * 1024
+
+
+def _new_digest():
+    if xxhash is not None:
+        return xxhash.xxh3_128()
+    return hashlib.blake2b(digest_size=32)
+
+
+def hash_file(path: Path) -> str:
+    """Return the hex digest of a file with the fastest available algorithm."""
+    digest = _new_digest()
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size >= MMAP_MIN_SIZE:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                digest.update(mapped)
+        else:
+            while chunk := f.read(HASH_CHUNK_SIZE):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+class HashCache:
+    """Local cache of file hashes keyed by (path, size, mtime_ns, inode)."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.entries = {}
+        self.dirty = False
+
+    @classmethod
+    def load(cls, path: Path) -> "HashCache":
+        cache = cls(path)
+        try:
+            data = json.loads(path.read_text())
+        except (OSError, json.JSONDecodeError):
+            return cache
+        if isinstance(data, dict) and data.get("algorithm") == HASH_ALGORITHM:
+            cache.entries = data.get("entries", {})
+        return cache
+
+    def lookup(self, key: str, stat: os.stat_result) -> str | None:
+        entry = self.entries.get(key)
+        if entry and entry[:3] == [stat.st_size, stat.st_mtime_ns, stat.st_ino]:
+            return entry[3]
+        return None
+
+    def store(self, key: str, stat: os.stat_result, file_hash: str):
+        self.entries[key] = [stat.st_size, stat.st_mtime_ns, stat.st_ino, file_hash]
+        self.dirty = True
+
+    def prune(self, keep: set[str]):
+        """Drop entries for files that are no longer part of the project."""
+        stale = self.entries.keys() - keep
+        for key in stale:
+            del self.entries[key]
+        self.dirty = self.dirty or bool(stale)
+
+    def save(self):
+        if not self.dirty:
+            return
+        tmp_path = self.path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps({"algorithm": HASH_ALGORITHM, "entries": self.entries}))
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+
+def build_manifest(
+    files: list[tuple[Path, Path]],
+    previous: dict | None = None,
+    cache: HashCache | None = None,
+    max_workers: int | None = None,
+) -> dict:
+    """
+    Build a manifest for the given (local_path, relative_path) tuples.
+
+    Hashes come from `cache` when the file is unchanged, or from `previous` when
+    its size and mtime match; the remaining files are hashed on a thread pool.
+    """
+    previous = previous or {}
+    manifest = {}
+    to_hash = []
+    for local_path, relative_path in files:
+        key = relative_path.as_posix()
+        stat = local_path.stat()
+        entry = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+        manifest[key] = entry
+
+        cached = cache.lookup(key, stat) if cache else None
+        old = previous.get(key)
+        if cached:
+            entry["hash"] = cached
+        elif old and old.get("hash") and old.get("size") == entry["size"] and old.get("mtime") == entry["mtime"]:
+            entry["hash"] = old["hash"]
+            if cache:
+                cache.store(key, stat, old["hash"])
+        else:
+            to_hash.append((key, local_path, stat))
+
+    if to_hash:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            hashes = pool.map(hash_file, [local_path for _, local_path, _ in to_hash])
+            for (key, _, stat), file_hash in zip(to_hash, hashes):
+                manifest[key]["hash"] = file_hash
+                if cache:
+                    cache.store(key, stat, file_hash)
+
+    if cache:
+        cache.prune(set(manifest))
+    return manifest
+
+
+def diff_manifests(local: dict, remote: dict) -> tuple[list[str], list[str]]:
+    """
+    Compare two manifests.
+
+    Returns:
+        Tuple of (changed, deleted): paths added or modified locally, and paths
+        present on the remote that no longer exist locally
+    """
+    changed = [
+        path for path, entry in local.items()
+        if path not in remote or remote[path].get("hash") != entry["hash"]
+    ]
+    deleted = [path for path in remote if path not in local]
+    return sorted(changed), sorted(deleted)
+
+
+def parse_manifest(content: str) -> dict:
+    """
+    Parse a manifest read from the remote.
+
+    Hashes computed with another algorithm are dropped so those files count as changed.
+
+    Raises:
+        DeploymentError: If the manifest is not valid: treating it as empty would upload
+            every file and leave deleted files in the release
+    """
+    try:
+        data = json.loads(content)
+    except (json.JSONDecodeError, TypeError) as e:
+        raise DeploymentError(f"Invalid manifest on the server ({e}), deploy with --full-upload") from e
+    if not isinstance(data, dict) or not isinstance(data.get("files", {}), dict):
+        raise DeploymentError("Invalid manifest on the server, deploy with --full-upload")
+    files = data.get("files", {})
+    if data.get("algorithm") != HASH_ALGORITHM:
+        files = {path: {**entry, "hash": None} for path, entry in files.items()}
+    return files
+
+
+def dump_manifest(manifest: dict) -> bytes:
+    """Serialize a manifest for storage on the remote."""
+    return json.dumps(
+        {"version": 1, "algorithm": HASH_ALGORITHM, "files": manifest}, separators=(",", ":")
+    ).encode()
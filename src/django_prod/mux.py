@@ -0,0 +1,517 @@
+"""
+Persistent SSH connections shared by django-prod commands, like OpenSSH ControlMaster.
+
+A background process (`python -m django_prod.mux`) keeps one authenticated paramiko
+transport open and listens on a Unix socket that only the current user can reach.
+Each connection to the socket is one SSH channel: the client sends a JSON request
+line (exec or subsystem), then both sides exchange frames of a one-byte type and a
+four-byte length. The process exits once no channel has been open for the idle time.
+
+MuxClient offers the part of paramiko.SSHClient the deploy uses (exec_command,
+get_transport().open_session(), SFTP and SCP), so the rest of the code does not
+know whether it talks to a direct connection or to the multiplexer.
+"""
+import argparse
+import hashlib
+import json
+import os
+import select
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import paramiko
+from paramiko import pipe
+from paramiko.buffered_pipe import BufferedPipe, PipeTimeout
+from paramiko.util import asbytes
+
+from .exceptions import DeploymentError
+from .tuning import connect_kwargs
+
+# Frame types
+ACK = b"k"
+ERROR = b"!"
+STDIN = b"d"
+STDOUT = b"o"
+STDERR = b"r"
+EOF = b"e"
+EXIT = b"x"
+
+FRAME_HEADER = struct.Struct(">cI")
+READ_SIZE = 32768
+
+# Seconds to wait for a new multiplexer to authenticate and start listening
+STARTUP_TIMEOUT = 45
+
+# Seconds a multiplexer that answered is taken to be alive without asking it again
+LIVENESS_TTL = 5
+
+
+def mux_available() -> bool:
+    return hasattr(socket, "AF_UNIX")
+
+
+def socket_path(host: str, user: str, key_path: str, port: int = 22) -> Path:
+    """
+    Socket of the multiplexer for user@host:port authenticated with `key_path`.
+
+    The socket is in a directory private to the current user. A connection made with
+    another key is another multiplexer, so a deploy never runs as a key it was not given.
+    """
+    directory = Path(tempfile.gettempdir()) / f"django_prod-{os.getuid()}"
+    directory.mkdir(mode=0o700, exist_ok=True)
+    if directory.stat().st_uid != os.getuid() or directory.stat().st_mode & 0o077:
+        raise DeploymentError(f"Refusing to use {directory}: it must belong to you with mode 0700")
+    # Hashed to stay under the Unix socket path length limit
+    key = Path(key_path).expanduser().resolve()
+    name = hashlib.sha1(f"{user}@{host}:{port} {key}".encode()).hexdigest()[:16]
+    return directory / f"{name}.sock"
+
+
+def _send_frame(sock: socket.socket, kind: bytes, payload: bytes = b""):
+    sock.sendall(FRAME_HEADER.pack(kind, len(payload)) + payload)
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes | None:
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def _recv_line(sock: socket.socket, limit: int = 1024 * 1024) -> bytes:
+    """Read the request line without consuming the frames that may follow it."""
+    line = b""
+    while not line.endswith(b"\n") and len(line) < limit:
+        char = sock.recv(1)
+        if not char:
+            break
+        line += char
+    return line
+
+
+def _recv_frame(sock: socket.socket) -> tuple[bytes, bytes] | None:
+    """Return (type, payload) of the next frame, or None once the socket is closed."""
+    header = _recv_exactly(sock, FRAME_HEADER.size)
+    if header is None:
+        return None
+    kind, length = FRAME_HEADER.unpack(header)
+    payload = _recv_exactly(sock, length) if length else b""
+    if payload is None:
+        return None
+    return kind, payload
+
+
+class MuxChannel:
+    """One SSH channel opened through the multiplexer, with the interface of paramiko.Channel."""
+
+    def __init__(self, path: Path, transport: "MuxTransport", options: dict):
+        self.transport = transport
+        self.options = options
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(str(path))
+        self.in_buffer = BufferedPipe()
+        self.in_stderr_buffer = BufferedPipe()
+        self.status_event = threading.Event()
+        self.exit_status = -1
+        self.eof_received = False
+        self.closed = False
+        self.timeout = None
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self._pipe = None
+
+    def _request(self, **request):
+        self.sock.sendall(json.dumps({**self.options, **request}).encode() + b"\n")
+        frame = _recv_frame(self.sock)
+        if frame is None or frame[0] != ACK:
+            self.close()
+            raise paramiko.SSHException(frame[1].decode() if frame else "SSH multiplexer closed the channel")
+        self.transport.alive()
+        threading.Thread(target=self._read_frames, daemon=True).start()
+
+    def _read_frames(self):
+        try:
+            while (frame := _recv_frame(self.sock)) is not None:
+                kind, payload = frame
+                if kind == STDOUT:
+                    self.in_buffer.feed(payload)
+                elif kind == STDERR:
+                    self.in_stderr_buffer.feed(payload)
+                elif kind == EOF:
+                    self._set_eof()
+                elif kind == EXIT:
+                    self.exit_status = int(payload)
+                    self.status_event.set()
+        except OSError:
+            pass
+        self._set_closed()
+
+    def _set_eof(self):
+        with self.lock:
+            self.eof_received = True
+            self.in_buffer.close()
+            self.in_stderr_buffer.close()
+            if self._pipe is not None:
+                self._pipe.set_forever()
+
+    def _set_closed(self):
+        self._set_eof()
+        self.closed = True
+        self.status_event.set()
+
+    def exec_command(self, command: str):
+        self._request(kind="exec", command=command)
+
+    def invoke_subsystem(self, name: str):
+        self._request(kind="subsystem", name=name)
+
+    def settimeout(self, timeout: float | None):
+        self.timeout = timeout
+
+    def gettimeout(self) -> float | None:
+        return self.timeout
+
+    def setblocking(self, blocking: bool):
+        self.timeout = None if blocking else 0.0
+
+    def recv(self, nbytes: int) -> bytes:
+        try:
+            return self.in_buffer.read(nbytes, self.timeout)
+        except PipeTimeout:
+            raise socket.timeout()
+
+    def recv_stderr(self, nbytes: int) -> bytes:
+        try:
+            return self.in_stderr_buffer.read(nbytes, self.timeout)
+        except PipeTimeout:
+            raise socket.timeout()
+
+    def recv_ready(self) -> bool:
+        return self.in_buffer.read_ready()
+
+    def recv_stderr_ready(self) -> bool:
+        return self.in_stderr_buffer.read_ready()
+
+    def send(self, data: bytes) -> int:
+        data = asbytes(data)
+        if self.closed:
+            raise OSError("Channel is closed")
+        with self.send_lock:
+            _send_frame(self.sock, STDIN, data)
+        return len(data)
+
+    def sendall(self, data: bytes):
+        self.send(data)
+
+    def shutdown_write(self):
+        with self.send_lock:
+            _send_frame(self.sock, EOF)
+
+    def exit_status_ready(self) -> bool:
+        return self.status_event.is_set()
+
+    def recv_exit_status(self) -> int:
+        self.status_event.wait()
+        return self.exit_status
+
+    def fileno(self) -> int:
+        """A descriptor that select() reports readable when data or EOF arrived, as in paramiko."""
+        with self.lock:
+            if self._pipe is None:
+                self._pipe = pipe.make_pipe()
+                stdout_event, stderr_event = pipe.make_or_pipe(self._pipe)
+                self.in_buffer.set_event(stdout_event)
+                self.in_stderr_buffer.set_event(stderr_event)
+                if self.eof_received:
+                    self._pipe.set_forever()
+            return self._pipe.fileno()
+
+    def makefile(self, *params):
+        return paramiko.ChannelFile(self, *params)
+
+    def makefile_stderr(self, *params):
+        return paramiko.ChannelStderrFile(self, *params)
+
+    def makefile_stdin(self, *params):
+        return paramiko.ChannelStdinFile(self, *params)
+
+    def get_transport(self) -> "MuxTransport":
+        return self.transport
+
+    def get_name(self) -> str:
+        return "mux"
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        self._set_closed()
+
+
+class MuxTransport:
+    """Opens channels through the multiplexer socket, like paramiko.Transport.open_session."""
+
+    def __init__(self, path: Path, host: str, port: int = 22):
+        self.path = path
+        self.host = host
+        self.port = port
+        self.alive_at = None
+
+    def open_session(self, window_size=None, max_packet_size=None, timeout=None) -> MuxChannel:
+        try:
+            return MuxChannel(self.path, self, {"window_size": window_size, "max_packet_size": max_packet_size})
+        except OSError:
+            self.alive_at = None
+            raise
+
+    def alive(self):
+        """Record that the multiplexer just answered."""
+        self.alive_at = time.monotonic()
+
+    def is_active(self) -> bool:
+        """Whether the multiplexer answers, pinging it only once the last answer is older than LIVENESS_TTL."""
+        if self.alive_at is not None and time.monotonic() - self.alive_at < LIVENESS_TTL:
+            return True
+        if ping(self.path):
+            self.alive()
+            return True
+        self.alive_at = None
+        return False
+
+    def getpeername(self) -> tuple[str, int]:
+        return self.host, self.port
+
+    def get_log_channel(self) -> str:
+        return "paramiko.transport"
+
+
+class MuxClient:
+    """The subset of paramiko.SSHClient used by django-prod, backed by the multiplexer."""
+
+    def __init__(self, path: Path, host: str, port: int = 22):
+        self.transport = MuxTransport(path, host, port)
+
+    def exec_command(self, command: str, bufsize: int = -1, timeout: float | None = None, **kwargs):
+        channel = self.transport.open_session()
+        channel.settimeout(timeout)
+        channel.exec_command(command)
+        return channel.makefile_stdin("wb", bufsize), channel.makefile("r", bufsize), channel.makefile_stderr("r", bufsize)
+
+    def get_transport(self) -> MuxTransport:
+        return self.transport
+
+    def open_sftp(self) -> paramiko.SFTPClient:
+        return paramiko.SFTPClient.from_transport(self.transport)
+
+    def close(self):
+        """Leave the shared connection open for the next command."""
+
+
+def ping(path: Path) -> bool:
+    """Whether a multiplexer answers on this socket."""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(5)
+            sock.connect(str(path))
+            sock.sendall(b'{"kind": "ping"}\n')
+            frame = _recv_frame(sock)
+    except OSError:
+        return False
+    return frame is not None and frame[0] == ACK
+
+
+def connect(
+    host: str, user: str, key_path: str, persist: int, ssh_settings: dict | None = None, port: int = 22
+) -> MuxClient:
+    """
+    Return a client on the multiplexer for user@host:port with this key, starting one if none is running.
+
+    Raises:
+        DeploymentError: If the multiplexer could not connect to the server
+    """
+    path = socket_path(host, user, key_path, port)
+    if ping(path):
+        return MuxClient(path, host, port)
+    path.unlink(missing_ok=True)
+
+    log_path = path.with_suffix(".log")
+    with open(log_path, "wb") as log:
+        process = subprocess.Popen(
+            [
+                sys.executable, "-m", "django_prod.mux",
+                "--socket", str(path),
+                "--host", host,
+                "--port", str(port),
+                "--user", user,
+                "--key", key_path,
+                "--persist", str(persist),
+                "--settings", json.dumps(ssh_settings or {}),
+            ],
+            stdin=subprocess.DEVNULL,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+            start_new_session=True,
+        )
+
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if ping(path):
+            return MuxClient(path, host, port)
+        if process.poll() is not None:
+            break
+        time.sleep(0.1)
+    process.kill()
+    error = log_path.read_text(errors="replace").strip().splitlines()
+    raise DeploymentError(f"SSH multiplexer did not start: {error[-1] if error else 'timed out'}")
+
+
+class MuxServer:
+    """Serve channels of one SSH transport on a Unix socket until it has been idle long enough."""
+
+    def __init__(self, transport: paramiko.Transport, path: Path, persist: int):
+        self.transport = transport
+        self.path = path
+        self.persist = persist
+        self.active = 0
+        self.last_used = time.monotonic()
+        self.lock = threading.Lock()
+
+    def serve(self):
+        previous_umask = os.umask(0o177)
+        try:
+            listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            listener.bind(str(self.path))
+        finally:
+            os.umask(previous_umask)
+        listener.listen(64)
+        listener.settimeout(1)
+        try:
+            while self.transport.is_active():
+                with self.lock:
+                    if not self.active and time.monotonic() - self.last_used > self.persist:
+                        break
+                try:
+                    conn, _ = listener.accept()
+                except socket.timeout:
+                    continue
+                conn.settimeout(None)
+                with self.lock:
+                    self.active += 1
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+        finally:
+            listener.close()
+            self.path.unlink(missing_ok=True)
+            self.transport.close()
+
+    def _handle(self, conn: socket.socket):
+        try:
+            self._serve_channel(conn)
+        except (OSError, EOFError, ValueError, paramiko.SSHException):
+            pass
+        finally:
+            conn.close()
+            with self.lock:
+                self.active -= 1
+                self.last_used = time.monotonic()
+
+    def _serve_channel(self, conn: socket.socket):
+        request = json.loads(_recv_line(conn) or b"{}")
+        if request.get("kind") == "ping":
+            _send_frame(conn, ACK)
+            return
+
+        try:
+            channel = self.transport.open_session(
+                window_size=request.get("window_size"), max_packet_size=request.get("max_packet_size")
+            )
+            if request.get("kind") == "exec":
+                channel.exec_command(request["command"])
+            elif request.get("kind") == "subsystem":
+                channel.invoke_subsystem(request["name"])
+            else:
+                raise paramiko.SSHException(f"Unknown request: {request.get('kind')}")
+        except (paramiko.SSHException, KeyError) as e:
+            _send_frame(conn, ERROR, str(e).encode())
+            return
+        _send_frame(conn, ACK)
+
+        upstream = threading.Thread(target=self._forward_input, args=(conn, channel), daemon=True)
+        upstream.start()
+        try:
+            self._forward_output(conn, channel)
+        finally:
+            channel.close()
+
+    def _forward_input(self, conn: socket.socket, channel: paramiko.Channel):
+        """Client frames to the channel: stdin data and EOF. The client closing closes the channel."""
+        try:
+            while (frame := _recv_frame(conn)) is not None:
+                kind, payload = frame
+                if kind == STDIN:
+                    channel.sendall(payload)
+                elif kind == EOF:
+                    channel.shutdown_write()
+        except (OSError, EOFError):
+            pass
+        channel.close()
+
+    def _forward_output(self, conn: socket.socket, channel: paramiko.Channel):
+        """Channel output to the client, then EOF and the exit status."""
+        while True:
+            while channel.recv_ready():
+                _send_frame(conn, STDOUT, channel.recv(READ_SIZE))
+            while channel.recv_stderr_ready():
+                _send_frame(conn, STDERR, channel.recv_stderr(READ_SIZE))
+            if channel.eof_received or channel.closed:
+                while channel.recv_ready():
+                    _send_frame(conn, STDOUT, channel.recv(READ_SIZE))
+                while channel.recv_stderr_ready():
+                    _send_frame(conn, STDERR, channel.recv_stderr(READ_SIZE))
+                break
+            select.select([channel], [], [])
+        _send_frame(conn, EOF)
+        channel.status_event.wait()
+        _send_frame(conn, EXIT, str(channel.exit_status).encode())
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(description="Keep an SSH connection open for django-prod commands")
+    parser.add_argument("--socket", required=True)
+    parser.add_argument("--host", required=True)
+    parser.add_argument("--port", type=int, default=22)
+    parser.add_argument("--user", required=True)
+    parser.add_argument("--key", required=True)
+    parser.add_argument("--persist", type=int, default=600)
+    parser.add_argument("--settings", default="{}")
+    args = parser.parse_args(argv)
+
+    ssh = paramiko.SSHClient()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    ssh.connect(
+        hostname=args.host,
+        port=args.port,
+        username=args.user,
+        key_filename=args.key,
+        timeout=30,
+        banner_timeout=30,
+        auth_timeout=30,
+        **connect_kwargs(json.loads(args.settings) or None),
+    )
+    transport = ssh.get_transport()
+    transport.set_keepalive(30)
+    MuxServer(transport, Path(args.socket), args.persist).serve()
+
+
+if __name__ == "__main__":
+    main()
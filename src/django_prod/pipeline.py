@@ -0,0 +1,138 @@
+"""
+Deployment steps as a graph of dependencies.
+
+Each step declares the steps it needs; steps whose dependencies are done run
+concurrently on a thread pool (SSH channels of one connection can be used from
+several threads). The timings of a run give the critical path: the chain of
+steps that decided how long the deploy took.
+
+Steps that are safe to run again declare how many retries they get; when one
+fails, the pipeline asks its `recover` callback (which reconnects after a dropped
+connection) whether to run it again.
+"""
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable
+
+from .exceptions import DeploymentError
+
+
+class Step:
+    """A named unit of work that runs once all the steps it requires are done."""
+
+    def __init__(
+        self,
+        name: str,
+        run: Callable[[], object],
+        requires: tuple[str, ...] | list[str] = (),
+        retries: int = 0,
+    ):
+        self.name = name
+        self.run = run
+        self.requires = list(requires)
+        # Only idempotent steps may be retried
+        self.retries = retries
+        self.attempts = 0
+        self.started = None
+        self.finished = None
+
+    @property
+    def duration(self) -> float:
+        if self.started is None or self.finished is None:
+            return 0.0
+        return self.finished - self.started
+
+
+class Pipeline:
+    """Run steps concurrently in dependency order."""
+
+    def __init__(self, steps: list[Step] = (), max_workers: int = 4):
+        self.steps = {}
+        self.max_workers = max_workers
+        for step in steps:
+            self.add(step)
+
+    def add(self, step: Step, before: list[str] = ()):
+        """Add a step, optionally making existing steps wait for it."""
+        if step.name in self.steps:
+            raise DeploymentError(f"Duplicate deploy step: {step.name}")
+        for name in before:
+            if name not in self.steps:
+                raise DeploymentError(f"Deploy step {step.name} runs before unknown step {name}")
+            self.steps[name].requires.append(step.name)
+        self.steps[step.name] = step
+
+    def order(self) -> list[str]:
+        """Return the step names in an order compatible with their dependencies."""
+        for step in self.steps.values():
+            for name in step.requires:
+                if name not in self.steps:
+                    raise DeploymentError(f"Deploy step {step.name} requires unknown step {name}")
+
+        remaining = {name: set(step.requires) for name, step in self.steps.items()}
+        ordered = []
+        while remaining:
+            ready = sorted(name for name, requires in remaining.items() if not requires)
+            if not ready:
+                raise DeploymentError(f"Deploy steps depend on each other: {', '.join(sorted(remaining))}")
+            for name in ready:
+                del remaining[name]
+                ordered.append(name)
+            for requires in remaining.values():
+                requires.difference_update(ready)
+        return ordered
+
+    def run(self, recover: Callable[[Step, BaseException], bool] | None = None):
+        """
+        Run every step, starting each one as soon as its dependencies are done.
+
+        A failed step with retries left runs again if `recover(step, error)` returns True.
+        Otherwise its exception stops scheduling new steps and is re-raised once the steps
+        already running have finished.
+        """
+        order = self.order()
+        done = set()
+        running = {}
+        error = None
+        executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="deploy-step")
+        try:
+            while True:
+                if error is None:
+                    for name in order:
+                        step = self.steps[name]
+                        if name in done or step in running.values() or not set(step.requires) <= done:
+                            continue
+                        step.started = time.perf_counter()
+                        step.attempts += 1
+                        running[executor.submit(step.run)] = step
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    step = running.pop(future)
+                    step.finished = time.perf_counter()
+                    exception = future.exception()
+                    if exception is not None:
+                        if error is None and step.attempts <= step.retries and recover and recover(step, exception):
+                            # Not in `done`, so the step is scheduled again
+                            continue
+                        error = error or exception
+                    else:
+                        done.add(step.name)
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+        if error is not None:
+            raise error
+
+    def critical_path(self) -> list[Step]:
+        """Return the chain of steps, each waiting on the previous one, that ended last."""
+        timed = [step for step in self.steps.values() if step.finished is not None]
+        if not timed:
+            return []
+        path = [max(timed, key=lambda step: step.finished)]
+        while True:
+            requires = [self.steps[name] for name in path[-1].requires if self.steps[name].finished is not None]
+            if not requires:
+                break
+            path.append(max(requires, key=lambda step: step.finished))
+        return list(reversed(path))
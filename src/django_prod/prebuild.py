@@ -0,0 +1,140 @@
+"""
+Build the dependency layers of the image while the project is still uploading.
+
+The expensive `pip install` layer of prod.Dockerfile only depends on
+requirements.txt. The instructions up to that layer are extracted into a small
+Dockerfile, sent with the files they copy, and built in the background on the
+server. The real build then finds those layers in the Docker build cache.
+"""
+import re
+import shlex
+
+import paramiko
+
+from .transfer import write_remote_file
+
+PREBUILD_DIRNAME = ".django_prod_prebuild"
+PREBUILD_DOCKERFILE = "Dockerfile.deps"
+PREBUILD_LOG = "build.log"
+
+_INSTRUCTION = re.compile(r"^\s*(\w+)\s+(.*)$", re.DOTALL)
+
+
+def prebuild_image(project_name: str) -> str:
+    """Tag given to the dependency stage, so it is not pruned as a dangling image."""
+    return re.sub(r"[^a-z0-9_.-]", "-", project_name.lower()).strip("-.") + "-deps:prebuild"
+
+
+def _instructions(dockerfile: str) -> list[str]:
+    """Split a Dockerfile into instructions, joining continuation lines."""
+    instructions = []
+    current = ""
+    for line in dockerfile.splitlines():
+        stripped = line.strip()
+        if not current and (not stripped or stripped.startswith("#")):
+            continue
+        if stripped.endswith("\\"):
+            current += line + "\n"
+            continue
+        instructions.append(current + line)
+        current = ""
+    if current:
+        instructions.append(current)
+    return instructions
+
+
+def _copy_sources(arguments: str) -> list[str] | None:
+    """Return the source paths of a COPY/ADD, or None if they cannot be determined."""
+    parts = [part for part in arguments.replace("\\\n", " ").split() if not part.startswith("--")]
+    if len(parts) < 2 or parts[0].startswith("["):
+        return None
+    return [source.removeprefix("./") for source in parts[:-1]]
+
+
+def dependency_stage(dockerfile: str) -> tuple[str, list[str]] | None:
+    """
+    Extract the instructions that only depend on a few small files.
+
+    Returns:
+        Tuple of (Dockerfile content, relative paths it copies), or None when there is
+        no RUN step worth building ahead of the upload
+    """
+    kept = []
+    sources = []
+    has_run = False
+    for instruction in _instructions(dockerfile):
+        match = _INSTRUCTION.match(instruction)
+        if not match:
+            break
+        keyword, arguments = match.group(1).upper(), match.group(2)
+        if keyword in ("COPY", "ADD"):
+            copied = _copy_sources(arguments)
+            if copied is None or any(source in (".", "*") or "*" in source for source in copied):
+                break
+            sources.extend(copied)
+        elif keyword == "FROM" and kept:
+            # Stop at the next stage of a multi-stage build
+            break
+        elif keyword == "RUN":
+            has_run = True
+        kept.append(instruction)
+
+    # Drop trailing instructions after the last RUN: they add nothing to the cache
+    while kept and _INSTRUCTION.match(kept[-1]).group(1).upper() != "RUN":
+        kept.pop()
+    if not has_run or not kept:
+        return None
+    return "\n".join(kept) + "\n", sources
+
+
+class DependencyPrebuild:
+    """A `docker build` of the dependency stage running in the background on the server."""
+
+    def __init__(self, ssh: paramiko.SSHClient, remote_path: str, image: str):
+        self.ssh = ssh
+        self.directory = f"{remote_path}/{PREBUILD_DIRNAME}"
+        self.image = image
+        self.channel = None
+
+    def start(self, dockerfile: str, files: dict[str, bytes]):
+        """Send the dependency Dockerfile and its files, then start the build without waiting."""
+        directory = shlex.quote(self.directory)
+        _, stdout, _ = self.ssh.exec_command(f"rm -rf {directory} && mkdir -p {directory}", timeout=60)
+        stdout.channel.recv_exit_status()
+        write_remote_file(self.ssh, f"{self.directory}/{PREBUILD_DOCKERFILE}", dockerfile.encode())
+        for relative_path, data in files.items():
+            target = f"{self.directory}/{relative_path}"
+            if "/" in relative_path:
+                parent = shlex.quote(target.rsplit("/", 1)[0])
+                _, stdout, _ = self.ssh.exec_command(f"mkdir -p {parent}", timeout=60)
+                stdout.channel.recv_exit_status()
+            write_remote_file(self.ssh, target, data)
+
+        # Output goes to a log file so an unread channel can never block the build
+        self.channel = self.ssh.get_transport().open_session()
+        self.channel.exec_command(
+            f"cd {directory} && docker build -f {PREBUILD_DOCKERFILE} -t {shlex.quote(self.image)} . "
+            f"> {PREBUILD_LOG} 2>&1"
+        )
+
+    def wait(self, timeout: float = 600) -> tuple[bool, str]:
+        """
+        Wait for the background build to finish.
+
+        Returns:
+            Tuple of (success, last lines of the build log)
+        """
+        if self.channel is None:
+            return False, ""
+        self.channel.settimeout(timeout)
+        try:
+            exit_code = self.channel.recv_exit_status() if self.channel.status_event.wait(timeout) else None
+        finally:
+            self.channel.close()
+        if exit_code == 0:
+            return True, ""
+        _, stdout, _ = self.ssh.exec_command(f"tail -n 20 {shlex.quote(self.directory)}/{PREBUILD_LOG}", timeout=30)
+        log_tail = stdout.read().decode(errors="replace").strip()
+        if exit_code is None:
+            return False, f"still running after {timeout}s\n{log_tail}"
+        return False, log_tail
@@ -0,0 +1,131 @@
+"""
+One-round-trip snapshot of the remote environment.
+
+Instead of running `docker --version`, `docker compose version`, `command -v ...`
+and friends as separate commands, the deploy runs a single shell script that
+creates the app directory and prints everything the later steps need as JSON.
+
+Once Docker and compose have been checked, the result is kept on the server in a
+provisioning state file along with a fingerprint of the host (machine id, kernel,
+Docker binaries). While the fingerprint matches, later probes read Docker and
+compose from that file instead of running them, and the deploy skips host setup.
+"""
+import json
+import shlex
+import time
+
+import paramiko
+
+from .exceptions import DeploymentError
+from .releases import current_release_command
+from .remote import run_remote
+
+PROVISION_STATE_FILENAME = ".django_prod_provisioned.json"
+
+# Prints a JSON value: the string in $1, or null when it is empty
+_JSON_STRING = r"""json_str() {
+  if [ -n "$1" ]; then
+    printf '"%s"' "$(printf '%s' "$1" | tr -d '\n' | sed 's/\\/\\\\/g; s/"/\\"/g')"
+  else
+    printf null
+  fi
+}
+has() { command -v "$1" >/dev/null 2>&1 && printf true || printf false; }
+"""
+
+
+def probe_command(remote_path: str, trust_provisioning: bool = True) -> str:
+    """
+    Shell script creating `remote_path` and printing the environment snapshot as one JSON line.
+
+    Docker and compose are only queried when the provisioning state file is missing, was
+    written for another host fingerprint, or `trust_provisioning` is False.
+    """
+    path = shlex.quote(remote_path)
+    state = shlex.quote(f"{remote_path}/{PROVISION_STATE_FILENAME}")
+    trust = "1" if trust_provisioning else ""
+    return _JSON_STRING + f"""mkdir -p {path} || exit 1
+fingerprint=$({{ cat /etc/machine-id 2>/dev/null || hostname; uname -r
+  ls -lLi "$(command -v docker)" "$(command -v docker-compose)" 2>/dev/null; }} | cksum | cut -d ' ' -f 1)
+docker_version= ; compose= ; compose_version= ; provisioning=null
+if [ -n "{trust}" ] && [ -f {state} ] && grep -q "\\"fingerprint\\": \\"$fingerprint\\"" {state}; then
+  provisioning=$(cat {state})
+else
+  docker_version=$(docker --version 2>/dev/null)
+  if docker compose version >/dev/null 2>&1; then
+    compose="docker compose"; compose_version=$(docker compose version --short 2>/dev/null)
+  elif docker-compose --version >/dev/null 2>&1; then
+    compose="docker-compose"; compose_version=$(docker-compose --version 2>/dev/null)
+  fi
+fi
+cpus=$(nproc 2>/dev/null || getconf _NPROCESSORS_ONLN 2>/dev/null)
+memory=$(awk '/^MemTotal:/ {{printf "%.0f", $2 * 1024}}' /proc/meminfo 2>/dev/null)
+disk=$(df -Pk {path} 2>/dev/null | awk 'NR == 2 {{printf "%.0f", $4 * 1024}}')
+current=$({current_release_command(remote_path)})
+printf '{{"docker": %s, "compose": %s, "compose_version": %s, "cpus": %s, "memory_bytes": %s, ' \\
+  "$(json_str "$docker_version")" "$(json_str "$compose")" "$(json_str "$compose_version")" \\
+  "${{cpus:-0}}" "${{memory:-0}}"
+printf '"disk_free_bytes": %s, "arch": %s, "rsync": %s, "tar": %s, "zstd": %s, "python3": %s, ' \\
+  "${{disk:-0}}" "$(json_str "$(uname -m)")" "$(has rsync)" "$(has tar)" "$(has zstd)" "$(has python3)"
+printf '"current_release": %s, "fingerprint": %s, "provisioning": %s}}\\n' \\
+  "$(json_str "$current")" "$(json_str "$fingerprint")" "$provisioning"
+"""
+
+
+class RemoteEnvironment:
+    """What the server has installed and how big it is, as reported by the probe script."""
+
+    def __init__(self, snapshot: dict):
+        # State left by a previous deploy on this same host, None when it has to be checked again
+        self.fingerprint = snapshot.get("fingerprint")
+        self.provisioning = snapshot.get("provisioning") or None
+        setup = self.provisioning or snapshot
+        self.docker = setup.get("docker")
+        self.compose = setup.get("compose")
+        self.compose_version = setup.get("compose_version")
+        self.cpus = int(snapshot.get("cpus") or 0)
+        self.memory_bytes = int(snapshot.get("memory_bytes") or 0)
+        self.disk_free_bytes = int(snapshot.get("disk_free_bytes") or 0)
+        self.arch = snapshot.get("arch")
+        self.rsync = bool(snapshot.get("rsync"))
+        self.tar = bool(snapshot.get("tar"))
+        self.zstd = bool(snapshot.get("zstd"))
+        self.python3 = bool(snapshot.get("python3"))
+        self.current_release = snapshot.get("current_release") or None
+
+    def describe(self) -> str:
+        return (
+            f"{self.arch or 'unknown arch'}, {self.cpus} CPUs, {self.memory_bytes / 1024**3:.1f} GiB RAM, "
+            f"{self.disk_free_bytes / 1024**3:.1f} GiB free"
+        )
+
+    def provisioning_state(self) -> dict:
+        """The provisioning state to store once Docker and compose have been checked."""
+        return {
+            "fingerprint": self.fingerprint,
+            "docker": self.docker,
+            "compose": self.compose,
+            "compose_version": self.compose_version,
+            "verified_at": int(time.time()),
+        }
+
+
+def probe_remote(
+    ssh: paramiko.SSHClient,
+    remote_path: str,
+    trust_provisioning: bool = True,
+    timeout: int = 60,
+) -> RemoteEnvironment:
+    """
+    Create `remote_path` and take a snapshot of the remote environment in one command.
+
+    Raises:
+        DeploymentError: If the probe script fails or prints something that is not JSON
+    """
+    exit_code, out, err = run_remote(ssh, probe_command(remote_path, trust_provisioning), timeout=timeout)
+    if exit_code != 0:
+        raise DeploymentError(f"Could not probe the server (exit code {exit_code}): {err or out}")
+    try:
+        return RemoteEnvironment(json.loads(out.strip().splitlines()[-1]))
+    except (IndexError, ValueError) as e:
+        raise DeploymentError(f"Unexpected output from the server probe: {out[:200]!r}") from e
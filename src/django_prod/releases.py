@@ -0,0 +1,130 @@
+"""
+Versioned release directories on the remote server.
+
+Each deploy is uploaded into `<remote_path>/releases/<timestamp>`, seeded with
+hardlinks to the previous release so unchanged files cost no copy, and then
+activated by atomically swapping the `<remote_path>/current` symlink. Images
+built for a release are tagged with its name so a rollback only has to swap
+the symlink back and restart the containers.
+"""
+import re
+import shlex
+from datetime import datetime, timezone
+from pathlib import Path, PurePosixPath
+
+RELEASES_DIRNAME = "releases"
+CURRENT_LINK = "current"
+DEFAULT_KEEP_RELEASES = 5
+
+
+def new_release_name(existing: list[str] = ()) -> str:
+    """
+    Name a new release after the current UTC time, to the microsecond.
+
+    Names sort in deploy order, which pruning and rollback rely on. When a release on the
+    server already has a greater name (deploys in the same instant, or from a machine whose
+    clock is ahead), the new name is the newest one plus one instead.
+    Names of the older second-resolution format count as the start of their second.
+    """
+    name = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S%f")
+    newest = max((release.ljust(len(name), "0") for release in existing if release.isdigit()), default="")
+    if newest >= name:
+        name = str(int(newest) + 1)
+    return name
+
+
+def compose_project_name(remote_path: str) -> str:
+    """Compose project name, kept equal to the pre-release directory name so volumes are preserved."""
+    return PurePosixPath(remote_path).name
+
+
+def compose_image_names(compose_file: Path) -> list[str]:
+    """Return the `image:` names declared in a docker-compose file."""
+    try:
+        content = compose_file.read_text()
+    except OSError:
+        return []
+    return re.findall(r"^\s+image:\s*[\"']?([^\s\"']+)", content, flags=re.MULTILINE)
+
+
+def _image_repository(image: str) -> str:
+    """Strip the tag from an image name (keeping a registry port)."""
+    name, _, tag = image.rpartition(":")
+    return name if name and "/" not in tag else image
+
+
+def release_path(remote_path: str, release: str) -> str:
+    return f"{remote_path}/{RELEASES_DIRNAME}/{release}"
+
+
+def current_release_command(remote_path: str) -> str:
+    """Print the name of the current release, or nothing before the first release."""
+    return f"basename \"$(readlink {shlex.quote(f'{remote_path}/{CURRENT_LINK}')})\" 2>/dev/null || true"
+
+
+def prepare_release_command(remote_path: str, release: str, previous: str | None) -> str:
+    """
+    Create a release directory, hardlinking the previous release's files into it.
+
+    Fails without touching anything when the release directory already exists, so an
+    existing release, the current one included, is never replaced.
+    """
+    target = shlex.quote(release_path(remote_path, release))
+    exists = f"{{ echo 'Release {release} already exists on the server' >&2; exit 1; }}"
+    create = f"mkdir -p {shlex.quote(f'{remote_path}/{RELEASES_DIRNAME}')} && {{ [ ! -e {target} ] || {exists}; }}"
+    if not previous:
+        return f"{create} && mkdir {target}"
+    source = shlex.quote(release_path(remote_path, previous))
+    return f"{create} && cp -al {source} {target}"
+
+
+def switch_release_command(remote_path: str, release: str) -> str:
+    """Atomically point `current` at a release by renaming a fresh symlink over it."""
+    link = shlex.quote(f"{remote_path}/{CURRENT_LINK}")
+    tmp_link = shlex.quote(f"{remote_path}/{CURRENT_LINK}.tmp")
+    relative = shlex.quote(f"{RELEASES_DIRNAME}/{release}")
+    return f"ln -sfn {relative} {tmp_link} && mv -Tf {tmp_link} {link}"
+
+
+def list_releases_command(remote_path: str) -> str:
+    return f"ls -1 {shlex.quote(f'{remote_path}/{RELEASES_DIRNAME}')} 2>/dev/null || true"
+
+
+def releases_to_prune(releases: list[str], current: str | None, keep: int) -> list[str]:
+    """Return releases beyond the `keep` most recent ones, never including the current one."""
+    ordered = sorted(releases, reverse=True)
+    return [release for release in ordered[max(keep, 1):] if release != current]
+
+
+def previous_release(releases: list[str], current: str | None) -> str | None:
+    """The newest release older than `current`, None when there is none."""
+    older = [release for release in releases if current and release < current]
+    return max(older, default=None)
+
+
+def prune_releases_command(remote_path: str, releases: list[str], images: list[str]) -> str:
+    """Delete old release directories and the image tags built for them."""
+    commands = []
+    for release in releases:
+        commands.append(f"rm -rf {shlex.quote(release_path(remote_path, release))}")
+        for image in images:
+            commands.append(f"docker rmi {shlex.quote(release_image(image, release))} >/dev/null 2>&1")
+    return "; ".join(commands) + "; true"
+
+
+def release_image(image: str, release: str) -> str:
+    return f"{_image_repository(image)}:release-{release}"
+
+
+def tag_release_images_command(images: list[str], release: str) -> str:
+    """Keep a per-release tag of the images so a rollback does not need a rebuild."""
+    return " && ".join(
+        f"docker tag {shlex.quote(image)} {shlex.quote(release_image(image, release))}" for image in images
+    )
+
+
+def restore_release_images_command(images: list[str], release: str) -> str:
+    """Point the compose image names back at the images built for a release."""
+    return " && ".join(
+        f"docker tag {shlex.quote(release_image(image, release))} {shlex.quote(image)}" for image in images
+    )
@@ -0,0 +1,457 @@
+"""
+Remote command execution with live output.
+
+The channel is waited on with select(): paramiko signals a file descriptor as soon
+as stdout or stderr data, or EOF, arrives. Output is therefore read while the
+command runs (a chatty `docker build` can never fill the channel window and stall),
+handed line by line to callbacks, and the call returns as soon as the command exits.
+
+RemoteAgent talks to the agent of agent.py over one long-lived channel instead:
+commands, file writes, deltas and hashing become requests on that channel and no
+longer pay for a channel and a shell each.
+"""
+import collections
+import itertools
+import os
+import select
+import shlex
+import threading
+import time
+from pathlib import Path
+from typing import Callable
+
+import paramiko
+
+from . import agent, delta
+from .exceptions import ConnectionLost, DeploymentError
+
+READ_SIZE = 32768
+
+
+def module_source(module) -> str:
+    """
+    Source of a module run on the server with `python3 -c` (agent.py, delta.py, imagetar.py).
+
+    These modules run on whatever python3 the server's distribution ships: they only
+    depend on the standard library and must stay compatible with older Python 3 versions.
+    """
+    return Path(module.__file__).read_text()
+
+
+# Output of a command kept in memory; anything older is only in the output log, if any
+OUTPUT_TAIL_BYTES = 64 * 1024
+
+
+class LineBuffer:
+    """
+    Split a byte stream into decoded lines, passing each complete line to a callback.
+
+    Only the last `limit` bytes are kept in a ring buffer, so a command printing
+    megabytes (a verbose build, `docker compose logs`) cannot grow memory unbounded.
+    """
+
+    def __init__(self, on_line: Callable[[str], None] | None = None, limit: int = OUTPUT_TAIL_BYTES):
+        self.on_line = on_line
+        self.limit = limit
+        self.chunks = collections.deque()
+        self.size = 0
+        self.truncated = False
+        self.pending = b""
+
+    def feed(self, data: bytes):
+        self.chunks.append(data)
+        self.size += len(data)
+        while self.size > self.limit:
+            excess = self.size - self.limit
+            if len(self.chunks[0]) <= excess:
+                self.size -= len(self.chunks.popleft())
+            else:
+                self.chunks[0] = self.chunks[0][excess:]
+                self.size -= excess
+            self.truncated = True
+        if self.on_line is None:
+            return
+        *lines, self.pending = (self.pending + data).split(b"\n")
+        for line in lines:
+            self.on_line(line.decode(errors="replace").rstrip("\r"))
+        # A line without end (progress bars redrawn with \r) is passed on once it gets too long
+        if len(self.pending) > self.limit:
+            self.flush()
+
+    def flush(self):
+        if self.on_line is not None and self.pending:
+            self.on_line(self.pending.decode(errors="replace").rstrip("\r"))
+        self.pending = b""
+
+    def text(self) -> str:
+        text = b"".join(self.chunks).decode(errors="replace")
+        if self.truncated:
+            # The first line was cut by the ring buffer
+            text = "[earlier output dropped]\n" + text.partition("\n")[2]
+        return text.strip()
+
+
+def output_tail(text: str, lines: int = 20) -> str:
+    """The last `lines` lines of command output, for error messages."""
+    all_lines = text.splitlines()
+    if len(all_lines) <= lines:
+        return text
+    return "...\n" + "\n".join(all_lines[-lines:])
+
+
+class OutputLog:
+    """
+    Full output of remote commands, written to a local file as it arrives.
+
+    Commands run concurrently, so every line is prefixed with the number of its command
+    (and `!` for stderr).
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.file = open(path, "w", encoding="utf-8")
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+
+    def command(self, cmd: str) -> int:
+        command_id = next(self.ids)
+        self._write(f"[{command_id}] $ {cmd}")
+        return command_id
+
+    def writer(self, command_id: int, stream: str) -> Callable[[str], None]:
+        marker = "!" if stream == "stderr" else ""
+        return lambda line: self._write(f"[{command_id}{marker}] {line}")
+
+    def exit(self, command_id: int, exit_code: int):
+        self._write(f"[{command_id}] exit {exit_code}")
+
+    def _write(self, line: str):
+        with self.lock:
+            self.file.write(line + "\n")
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def run_remote(
+    ssh: paramiko.SSHClient,
+    cmd: str,
+    timeout: float = 120,
+    on_stdout: Callable[[str], None] | None = None,
+    on_stderr: Callable[[str], None] | None = None,
+) -> tuple[int, str, str]:
+    """
+    Run a command on the server, streaming its output as it arrives.
+
+    Args:
+        ssh: SSH client
+        cmd: Command to execute
+        timeout: Seconds the command may run before DeploymentError is raised
+        on_stdout: Called with each stdout line as soon as it is complete
+        on_stderr: Called with each stderr line as soon as it is complete
+
+    Returns:
+        Tuple of (exit_code, stdout, stderr)
+    """
+    deadline = time.monotonic() + timeout
+    channel = ssh.get_transport().open_session(timeout=timeout)
+    stdout = LineBuffer(on_stdout)
+    stderr = LineBuffer(on_stderr)
+    try:
+        channel.exec_command(cmd)
+        channel.shutdown_write()
+
+        while True:
+            while channel.recv_ready():
+                stdout.feed(channel.recv(READ_SIZE))
+            while channel.recv_stderr_ready():
+                stderr.feed(channel.recv_stderr(READ_SIZE))
+            if channel.eof_received or channel.closed:
+                # Everything sent before EOF is buffered already
+                while channel.recv_ready():
+                    stdout.feed(channel.recv(READ_SIZE))
+                while channel.recv_stderr_ready():
+                    stderr.feed(channel.recv_stderr(READ_SIZE))
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise DeploymentError(f"Command timed out after {timeout}s: {cmd[:50]}...")
+            select.select([channel], [], [], remaining)
+
+        # The exit status may follow EOF
+        if not channel.status_event.wait(max(0.0, deadline - time.monotonic())):
+            raise DeploymentError(f"Command timed out after {timeout}s: {cmd[:50]}...")
+        # A channel closed without exit status went down with the connection
+        if channel.exit_status == -1 and not ssh.get_transport().is_active():
+            raise ConnectionLost(f"SSH connection lost while running: {cmd[:50]}...")
+        stdout.flush()
+        stderr.flush()
+        return channel.exit_status, stdout.text(), stderr.text()
+    finally:
+        channel.close()
+
+
+
+def detached_command(job_dir: str, cmd: str) -> str:
+    """
+    Shell command starting `cmd` in the background, detached from the SSH channel.
+
+    Its output goes to `output.log` in `job_dir` and its exit code to `exit_code` when
+    it is done, so it keeps running when the connection drops.
+    """
+    directory = shlex.quote(job_dir)
+    job = (
+        f"sh -c {shlex.quote(cmd)}; echo $? > {directory}/exit_code.tmp; "
+        f"mv {directory}/exit_code.tmp {directory}/exit_code"
+    )
+    return (
+        f"rm -rf {directory} && mkdir -p {directory} && "
+        f"nohup sh -c {shlex.quote(job)} > {directory}/output.log 2>&1 < /dev/null &"
+    )
+
+
+def follow_command(job_dir: str, lines_seen: int = 0) -> str:
+    """
+    Shell command printing the output of a detached command after its first `lines_seen`
+    lines as it grows, then exiting with the command's exit code.
+
+    Only complete lines are printed until the command is done, so the number of lines
+    received is where to re-attach after a dropped connection.
+    """
+    directory = shlex.quote(job_dir)
+    return f"""cd {directory} || exit 1
+n={int(lines_seen)}
+while :; do
+  [ -f exit_code ] && finished=1
+  if [ -n "$finished" ]; then
+    sed -n "$((n + 1)),\\$p" output.log
+    exit "$(cat exit_code)"
+  fi
+  total=$(wc -l < output.log)
+  if [ "$total" -gt "$n" ]; then
+    sed -n "$((n + 1)),${{total}}p" output.log
+    n=$total
+  fi
+  sleep 1
+done"""
+
+# Files are sent to the agent in pieces of at most this size, several pieces per request
+AGENT_BATCH_BYTES = 4 * 1024 * 1024
+
+# write_files requests sent ahead of the acknowledgements, to keep the channel busy
+AGENT_WINDOW = 4
+
+
+class AgentCall:
+    """A request sent to the remote agent, waiting for its response."""
+
+    def __init__(self, on_output: Callable[[str, str], None] | None = None):
+        self.on_output = on_output
+        self.event = threading.Event()
+        self.result = None
+        self.attachment = b""
+        self.error = None
+        self.lost = False
+
+    def wait(self, timeout: float | None = None):
+        if not self.event.wait(timeout):
+            raise DeploymentError(f"Remote agent did not answer within {timeout}s")
+        if self.lost:
+            raise ConnectionLost("Remote agent: the agent exited")
+        if self.error is not None:
+            raise DeploymentError(f"Remote agent: {self.error}")
+        return self.result
+
+
+class RemoteAgent:
+    """
+    Client of the agent in agent.py, running on the server over a single channel.
+
+    Requests from several threads are multiplexed on the channel and matched to their
+    responses by id, so a long command does not hold up file writes.
+    """
+
+    def __init__(self, channel: paramiko.Channel):
+        self.channel = channel
+        self.send_lock = threading.Lock()
+        self.calls_lock = threading.Lock()
+        self.calls = {}
+        self.ids = itertools.count(1)
+        self.closed = False
+        self.reader = threading.Thread(target=self._read_responses, daemon=True)
+        self.reader.start()
+
+    @classmethod
+    def start(cls, ssh: paramiko.SSHClient, timeout: float = 30) -> "RemoteAgent":
+        """
+        Send the agent to the server with `python3 -c` and wait until it answers.
+
+        Raises:
+            DeploymentError: If the agent could not start on the server
+        """
+        command = " ".join(
+            ["python3", "-u", "-c", shlex.quote(module_source(agent)), shlex.quote(module_source(delta))]
+        )
+        channel = ssh.get_transport().open_session()
+        channel.exec_command(command)
+        client = cls(channel)
+        try:
+            client.call("ping", timeout=timeout)
+        except DeploymentError:
+            client.close()
+            raise
+        return client
+
+    def _read_responses(self):
+        stream = self.channel.makefile("rb")
+        try:
+            while True:
+                message, attachment = agent.read_message(stream)
+                if message is None:
+                    break
+                if "id" in message and ("result" in message or "error" in message):
+                    with self.calls_lock:
+                        call = self.calls.pop(message["id"], None)
+                    if call is not None:
+                        call.result = message.get("result")
+                        call.attachment = attachment
+                        call.error = message["error"]["message"] if "error" in message else None
+                        call.event.set()
+                elif message.get("method") == "output":
+                    params = message["params"]
+                    with self.calls_lock:
+                        call = self.calls.get(params["id"])
+                    if call is not None and call.on_output is not None:
+                        call.on_output(params["stream"], params["data"])
+        except (OSError, EOFError, ValueError):
+            pass
+        self.closed = True
+        with self.calls_lock:
+            pending, self.calls = self.calls, {}
+        for call in pending.values():
+            call.lost = True
+            call.event.set()
+
+    def submit(self, method: str, attachment: bytes = b"", on_output=None, **params) -> AgentCall:
+        """Send a request without waiting for its response."""
+        if self.closed:
+            raise ConnectionLost("Remote agent: the agent exited")
+        request_id = next(self.ids)
+        call = AgentCall(on_output)
+        with self.calls_lock:
+            self.calls[request_id] = call
+        message = {"jsonrpc": "2.0", "id": request_id, "method": method, "params": params}
+        with self.send_lock:
+            self.channel.sendall(agent.encode_message(message, attachment))
+        return call
+
+    def call(self, method: str, attachment: bytes = b"", timeout: float | None = 300, **params):
+        return self.submit(method, attachment, **params).wait(timeout)
+
+    def run(
+        self,
+        cmd: str,
+        timeout: float = 120,
+        on_stdout: Callable[[str], None] | None = None,
+        on_stderr: Callable[[str], None] | None = None,
+    ) -> tuple[int, str, str]:
+        """Run a shell command through the agent, with the same contract as run_remote."""
+        buffers = {"stdout": LineBuffer(on_stdout), "stderr": LineBuffer(on_stderr)}
+        call = self.submit(
+            "run",
+            on_output=lambda stream, data: buffers[stream].feed(data.encode()),
+            command=cmd,
+            timeout=timeout,
+        )
+        result = call.wait(timeout + 30)
+        if result["timed_out"]:
+            raise DeploymentError(f"Command timed out after {timeout}s: {cmd[:50]}...")
+        for buffer in buffers.values():
+            buffer.flush()
+        return result["exit_code"], buffers["stdout"].text(), buffers["stderr"].text()
+
+    def write_files(self, remote_dir: str, files: list[tuple[Path, Path]], on_file_done=None) -> int:
+        """
+        Write local files below `remote_dir`, returning the number of bytes sent.
+
+        Small files are packed together and large ones split into pieces; a few
+        requests are kept in flight so the channel never waits for an acknowledgement.
+        """
+        in_flight = []
+        bytes_sent = 0
+
+        def flush(pieces, data):
+            nonlocal bytes_sent
+            in_flight.append(self.submit("write_files", b"".join(data), root=remote_dir, pieces=pieces))
+            bytes_sent += sum(len(part) for part in data)
+            while len(in_flight) >= AGENT_WINDOW:
+                acknowledge(in_flight.pop(0))
+
+        def acknowledge(call):
+            for path in call.wait()["completed"]:
+                if on_file_done:
+                    on_file_done(path)
+
+        pieces, data, size = [], [], 0
+        for local_path, relative_path in files:
+            mode = local_path.stat().st_mode
+            with open(local_path, "rb") as f:
+                total = os.fstat(f.fileno()).st_size
+                offset = 0
+                while True:
+                    chunk = f.read(AGENT_BATCH_BYTES - size)
+                    pieces.append([relative_path.as_posix(), offset, len(chunk), total, mode])
+                    data.append(chunk)
+                    size += len(chunk)
+                    offset += len(chunk)
+                    if size >= AGENT_BATCH_BYTES:
+                        flush(pieces, data)
+                        pieces, data, size = [], [], 0
+                    if offset >= total:
+                        break
+        if pieces:
+            flush(pieces, data)
+        for call in in_flight:
+            acknowledge(call)
+        return bytes_sent
+
+    def write_file(self, remote_file: str, data: bytes):
+        """Write `data` to a file on the server, replacing it atomically."""
+        directory, _, name = remote_file.rpartition("/")
+        self.call("write_files", data, root=directory or "/", pieces=[[name, 0, len(data), len(data), 0o644]])
+
+    def read_file(self, remote_file: str) -> bytes | None:
+        """Whole contents of a file on the server, or None when it does not exist."""
+        call = self.submit("read_file", path=remote_file)
+        if call.wait(300) is None:
+            return None
+        return call.attachment
+
+    def remove_files(self, remote_path: str, relative_paths: list[str]):
+        self.call("remove_files", root=remote_path, paths=relative_paths)
+
+    def file_sizes(self, remote_path: str, relative_paths: list[str]) -> dict[str, int]:
+        return self.call("stat", root=remote_path, paths=relative_paths)
+
+    def hash_files(self, remote_path: str, relative_paths: list[str]) -> dict[str, str | None]:
+        """BLAKE2b digests (32 bytes) of remote files, as manifest.hash_file computes without xxhash."""
+        return self.call("hash_files", root=remote_path, paths=relative_paths, timeout=None)
+
+    def signatures(self, block_sizes: dict[str, int]) -> dict:
+        return self.call("signatures", block_sizes=block_sizes, timeout=None)
+
+    def apply_delta(self, remote_file: str, block_size: int, payload: bytes, expected_sha256: str):
+        self.call("apply_delta", payload, path=remote_file, block_size=block_size, sha256=expected_sha256)
+
+    def stats(self) -> dict:
+        return self.call("stats", timeout=30)
+
+    def close(self):
+        """Ask the agent to exit, then close its channel."""
+        if not self.closed:
+            try:
+                self.submit("shutdown").wait(5)
+            except (DeploymentError, OSError):
+                pass
+        self.channel.close()
@@ -0,0 +1,121 @@
+"""
+Upload checkpoints that let an interrupted deploy resume where it stopped.
+
+The checkpoint lives next to deployment_target.json and records, for one
+(vps_ip, remote_path) target, the release directory being filled and the release
+it was seeded from, the files whose upload finished and the byte offset reached
+in a partially uploaded large file. Entries are tied to the file hash so a file
+edited since the interrupted run is uploaded again.
+"""
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+UPLOAD_STATE_FILENAME = ".deployment_upload_state.json"
+
+# Minimum delay between two checkpoint writes
+SAVE_INTERVAL = 1.0
+
+
+class UploadCheckpoint:
+    """Thread-safe record of upload progress, persisted to a local JSON file."""
+
+    def __init__(self, path: Path, vps_ip: str, remote_path: str):
+        self.path = path
+        self.vps_ip = vps_ip
+        self.remote_path = remote_path
+        self.release = None
+        # Release whose files were hardlinked into `release`, None for an empty start
+        self.base = None
+        self.hashes = {}
+        self.completed = {}
+        self.partial = {}
+        self._lock = threading.Lock()
+        self._last_save = 0.0
+
+    @classmethod
+    def load(cls, path: Path, vps_ip: str, remote_path: str) -> "UploadCheckpoint":
+        """Load the checkpoint for this target, ignoring state left for another target."""
+        checkpoint = cls(path, vps_ip, remote_path)
+        try:
+            data = json.loads(path.read_text())
+        except (OSError, json.JSONDecodeError):
+            return checkpoint
+        if data.get("vps_ip") == vps_ip and data.get("remote_path") == remote_path:
+            checkpoint.release = data.get("release")
+            checkpoint.base = data.get("base")
+            checkpoint.completed = data.get("completed", {})
+            checkpoint.partial = data.get("partial", {})
+        return checkpoint
+
+    @property
+    def has_progress(self) -> bool:
+        return bool(self.completed or self.partial)
+
+    def resumable(self, manifest: dict, paths: list[str]) -> tuple[set[str], dict[str, int]]:
+        """
+        Return the paths recorded as uploaded and the partial offsets still valid for `manifest`.
+
+        The caller must still confirm these against the remote before skipping anything.
+        """
+        completed = {path for path in paths if self.completed.get(path) == manifest[path]["hash"]}
+        partial = {}
+        for path, (file_hash, offset) in self.partial.items():
+            if path in manifest and path not in completed and file_hash == manifest[path]["hash"]:
+                partial[path] = offset
+        return completed, partial
+
+    def begin(self, manifest: dict, verified: set[str], release: str | None = None, base: str | None = None):
+        """Start tracking a new upload run, keeping only the verified completed files."""
+        with self._lock:
+            self.release = release
+            self.base = base
+            self.hashes = {path: entry["hash"] for path, entry in manifest.items()}
+            self.completed = {path: self.hashes[path] for path in verified}
+            self.partial = {}
+        self.save(force=True)
+
+    def file_done(self, relative_path: str):
+        with self._lock:
+            self.completed[relative_path] = self.hashes.get(relative_path)
+            self.partial.pop(relative_path, None)
+        self.save()
+
+    def file_progress(self, relative_path: str, offset: int):
+        with self._lock:
+            self.partial[relative_path] = [self.hashes.get(relative_path), offset]
+        self.save()
+
+    def save(self, force: bool = False):
+        """Write the checkpoint, at most once per SAVE_INTERVAL unless forced."""
+        with self._lock:
+            now = time.monotonic()
+            if not force and now - self._last_save < SAVE_INTERVAL:
+                return
+            self._last_save = now
+            data = {
+                "vps_ip": self.vps_ip,
+                "remote_path": self.remote_path,
+                "release": self.release,
+                "base": self.base,
+                "completed": self.completed,
+                "partial": self.partial,
+            }
+        try:
+            tmp_path = self.path.with_suffix(".tmp")
+            tmp_path.write_text(json.dumps(data))
+            os.replace(tmp_path, self.path)
+        except OSError:
+            pass
+
+    def clear(self):
+        """Forget the checkpoint once the upload has fully succeeded."""
+        with self._lock:
+            self.completed = {}
+            self.partial = {}
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
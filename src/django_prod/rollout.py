@@ -0,0 +1,97 @@
+"""
+Rolling deploys of one project to several servers.
+
+deployment_target.json may list several servers under "targets". They are deployed
+in batches: the hosts of a batch are deployed concurrently, and the next batch only
+starts once every host of the current one passed its health check. At most
+`max_unavailable` hosts of a batch restart their containers at the same time.
+"""
+import shlex
+import threading
+
+DEFAULT_BATCH_SIZE = 2
+
+# Checked on each server after its containers started
+DEFAULT_HEALTH_CHECK_URL = "http://127.0.0.1:8000/"
+HEALTH_CHECK_TIMEOUT = 60
+
+
+def rollout_targets(config: dict) -> list[dict]:
+    """
+    The servers listed under "targets", each completed with the top-level SSH user and key.
+
+    Returns an empty list for a single-server configuration.
+    """
+    defaults = {key: config[key] for key in ("ssh_user", "path_to_ssh_key") if key in config}
+    return [{**defaults, **target} for target in config.get("targets", [])]
+
+
+def make_batches(targets: list, batch_size: int) -> list[list]:
+    batch_size = max(1, batch_size)
+    return [targets[start:start + batch_size] for start in range(0, len(targets), batch_size)]
+
+
+def health_check_command(url: str, timeout: int = HEALTH_CHECK_TIMEOUT) -> str:
+    """
+    Shell command waiting until `url` answers on the server, failing after `timeout` seconds.
+
+    Any HTTP response below 500 counts as healthy: the app may well answer 400 or 404
+    to a request for its root on a local address. Uses curl, or python3 without it.
+    """
+    quoted = shlex.quote(url)
+    python_check = shlex.quote(
+        "import sys, urllib.request, urllib.error\n"
+        "try:\n"
+        "    print(urllib.request.urlopen(sys.argv[1], timeout=5).status)\n"
+        "except urllib.error.HTTPError as e:\n"
+        "    print(e.code)\n"
+        "except Exception:\n"
+        "    print(0)\n"
+    )
+    return f"""if command -v curl >/dev/null 2>&1; then
+  check() {{ curl -s -o /dev/null -m 5 -w '%{{http_code}}' {quoted} 2>/dev/null; }}
+elif command -v python3 >/dev/null 2>&1; then
+  check() {{ python3 -c {python_check} {quoted}; }}
+else
+  echo "Neither curl nor python3 on the server, skipping the health check"; exit 0
+fi
+deadline=$(($(date +%s) + {int(timeout)}))
+while :; do
+  code=$(check)
+  case "$code" in [1-4][0-9][0-9]) echo "HTTP $code from {url}"; exit 0;; esac
+  if [ "$(date +%s)" -ge "$deadline" ]; then
+    echo "No healthy answer from {url} after {int(timeout)}s (last status: ${{code:-none}})"; exit 1
+  fi
+  sleep 2
+done"""
+
+
+class HostOutput:
+    """
+    Write-only stream prefixing each line with its host, for the multiplexed rollout view.
+
+    Lines of several hosts are written whole under a shared lock so they never mix.
+    Indented command output is left out unless `verbose`, to keep the view compact.
+    """
+
+    def __init__(self, stream, label: str, lock: threading.Lock, verbose: bool = False):
+        self.stream = stream
+        self.label = label
+        self.lock = lock
+        self.verbose = verbose
+        self.pending = ""
+
+    def write(self, text: str):
+        *lines, self.pending = (self.pending + text).split("\n")
+        for line in lines:
+            if not line.strip() or (line.startswith("    ") and not self.verbose):
+                continue
+            with self.lock:
+                self.stream.write(f"{self.label} | {line}\n")
+                self.stream.flush()
+
+    def flush(self):
+        pass
+
+    def isatty(self) -> bool:
+        return self.stream.isatty()
@@ -0,0 +1,512 @@
+"""
+File transfer helpers used by the django_prod_deploy command.
+
+The archive upload streams a tar of the project straight into a remote `tar -x`
+over a single SSH channel, so no temporary archive is ever written to disk.
+The SFTP upload runs several pipelined SFTP sessions over the same transport.
+"""
+import io
+import json
+import queue
+import shlex
+import stat
+import tarfile
+import threading
+from pathlib import Path
+
+import paramiko
+
+from . import delta
+from .connection import transfer_error
+from .exceptions import DeploymentError
+from .remote import module_source
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - optional dependency
+    zstandard = None
+
+
+# Small chunks keep the SSH window busy without buffering large files in memory
+STREAM_CHUNK_SIZE = 256 * 1024
+
+# Files below this size are grouped into batches by the SFTP uploader
+SMALL_FILE_SIZE = 256 * 1024
+SMALL_FILE_BATCH_BYTES = 4 * 1024 * 1024
+SMALL_FILE_BATCH_COUNT = 64
+
+
+class ChannelWriter:
+    """Minimal write-only file object that forwards bytes to an SSH channel."""
+
+    def __init__(self, channel: paramiko.Channel):
+        self.channel = channel
+        self.bytes_sent = 0
+
+    def write(self, data: bytes) -> int:
+        self.channel.sendall(data)
+        self.bytes_sent += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+def detect_archive_compression(ssh: paramiko.SSHClient, remote=None) -> str | None:
+    """
+    Return the compression to use for archive uploads, or None if the remote has no tar.
+
+    zstd is preferred when the `zstandard` package is installed locally and the
+    remote has a `zstd` binary; gzip is used otherwise. The remote is only queried
+    when no RemoteEnvironment snapshot is given.
+    """
+    if remote is not None:
+        has_tar, has_zstd = remote.tar, remote.zstd
+    else:
+        _, stdout, _ = ssh.exec_command("command -v tar; command -v zstd", timeout=30)
+        found = stdout.read().decode()
+        has_tar, has_zstd = "tar" in found, "zstd" in found
+    if not has_tar:
+        return None
+    if zstandard is not None and has_zstd:
+        return "zstd"
+    return "gzip"
+
+
+def _tar_extract_command(target_dir: str, compression: str) -> str:
+    target = shlex.quote(target_dir)
+    if compression == "zstd":
+        return f"mkdir -p {target} && zstd -dc | tar -xf - -C {target}"
+    return f"mkdir -p {target} && tar -xzf - -C {target}"
+
+
+def _stream_tar(ssh: paramiko.SSHClient, remote_cmd: str, compression: str, fill) -> int:
+    """
+    Run `remote_cmd` and stream into its stdin a tar archive populated by `fill(archive)`.
+
+    Returns:
+        Number of compressed bytes sent over the channel
+    """
+    channel = ssh.get_transport().open_session()
+    channel.exec_command(remote_cmd)
+    writer = ChannelWriter(channel)
+
+    compressor = None
+    try:
+        if compression == "zstd":
+            compressor = zstandard.ZstdCompressor(level=3).stream_writer(writer, closefd=False)
+            archive = tarfile.open(fileobj=compressor, mode="w|", bufsize=STREAM_CHUNK_SIZE)
+        else:
+            archive = tarfile.open(fileobj=writer, mode="w|gz", bufsize=STREAM_CHUNK_SIZE, compresslevel=6)
+
+        with archive:
+            fill(archive)
+
+        if compressor is not None:
+            compressor.close()
+
+        channel.shutdown_write()
+        exit_code = channel.recv_exit_status()
+        if exit_code != 0:
+            err = channel.makefile_stderr("rb").read().decode().strip()
+            raise DeploymentError(f"Remote tar extraction failed (exit code {exit_code}): {err}")
+    except (OSError, paramiko.SSHException) as e:
+        raise transfer_error(ssh.get_transport(), f"Archive upload failed: {e}") from e
+    finally:
+        channel.close()
+
+    return writer.bytes_sent
+
+
+def stream_tar_archive(
+    ssh: paramiko.SSHClient,
+    files: list[tuple[Path, Path]],
+    remote_path: str,
+    compression: str = "gzip",
+    progress=None,
+    checkpoint=None,
+) -> int:
+    """
+    Stream a compressed tar of `files` into `tar -x` on the remote server.
+
+    Args:
+        ssh: Connected SSH client
+        files: List of (local_path, relative_path) tuples
+        remote_path: Directory the archive is unpacked into
+        compression: "gzip" or "zstd"
+        progress: Optional callable(done, total) invoked as files are archived
+        checkpoint: Optional UploadCheckpoint recording archived files
+
+    Returns:
+        Number of compressed bytes sent over the channel
+    """
+    total = len(files)
+
+    def fill(archive):
+        for i, (local_path, relative_path) in enumerate(files, 1):
+            archive.add(str(local_path), arcname=relative_path.as_posix(), recursive=False)
+            if checkpoint:
+                checkpoint.file_done(relative_path.as_posix())
+            if progress:
+                progress(i, total)
+
+    return _stream_tar(ssh, _tar_extract_command(remote_path, compression), compression, fill)
+
+
+def stream_chunks(ssh: paramiko.SSHClient, chunks, store_path: str, compression: str = "gzip") -> int:
+    """
+    Upload content-addressed chunks into the remote chunk store.
+
+    Chunks are unpacked into a staging directory and only moved into the store
+    once the whole archive was received, so an interrupted upload never leaves
+    a truncated chunk under its final name.
+
+    Args:
+        ssh: Connected SSH client
+        chunks: Iterable of (chunk_id, data) tuples
+        store_path: Remote chunk store directory
+        compression: "gzip" or "zstd"
+
+    Returns:
+        Number of compressed bytes sent over the channel
+    """
+    incoming = f"{store_path}/.incoming"
+    remote_cmd = (
+        f"rm -rf {shlex.quote(incoming)} && {_tar_extract_command(incoming, compression)}"
+        f" && cd {shlex.quote(incoming)}"
+        " && find . -type f -exec sh -c 'mv -f \"$@\" ..' _ {} +"
+        f" && cd .. && rmdir {shlex.quote(incoming)}"
+    )
+
+    def fill(archive):
+        for name, data in chunks:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mode = 0o644
+            archive.addfile(info, io.BytesIO(data))
+
+    return _stream_tar(ssh, remote_cmd, compression, fill)
+
+
+def missing_remote_chunks(ssh: paramiko.SSHClient, store_path: str, chunk_ids: list[str]) -> set[str]:
+    """Return the chunk ids that are not yet in the remote chunk store."""
+    store = shlex.quote(store_path)
+    channel = ssh.get_transport().open_session()
+    try:
+        channel.exec_command(f'mkdir -p {store} && cd {store} && while read id; do [ -f "$id" ] || echo "$id"; done')
+        channel.sendall(("\n".join(chunk_ids) + "\n").encode())
+        channel.shutdown_write()
+        output = channel.makefile("rb").read().decode()
+        exit_code = channel.recv_exit_status()
+    finally:
+        channel.close()
+    if exit_code != 0:
+        raise DeploymentError("Failed to query the remote chunk store")
+    return set(output.split())
+
+
+def assemble_remote_files(ssh: paramiko.SSHClient, store_path: str, remote_path: str, recipes: dict[str, list[str]]):
+    """
+    Rebuild files on the remote by concatenating chunks from the store.
+
+    Args:
+        ssh: Connected SSH client
+        store_path: Remote chunk store directory
+        remote_path: Directory the files are written into
+        recipes: Mapping of relative path to its ordered list of chunk ids
+    """
+    lines = ["set -e", f"cd {shlex.quote(store_path)}"]
+    for relative_path, chunk_ids in recipes.items():
+        target = shlex.quote(f"{remote_path}/{relative_path}")
+        tmp = shlex.quote(f"{remote_path}/{relative_path}.django_prod_tmp")
+        lines.append(f"mkdir -p \"$(dirname {target})\"")
+        # Ids go through xargs from a here-document: a multi-GB file has too many for one command line
+        lines.append(f"xargs cat > {tmp} <<'DJANGO_PROD_CHUNKS'")
+        lines.extend(chunk_ids)
+        lines.append("DJANGO_PROD_CHUNKS")
+        lines.append(f"mv -f {tmp} {target}")
+    script = "\n".join(lines) + "\n"
+
+    channel = ssh.get_transport().open_session()
+    try:
+        channel.exec_command("sh -s")
+        channel.sendall(script.encode())
+        channel.shutdown_write()
+        # Read stderr before waiting for the exit: a large error output would block the remote
+        err = channel.makefile_stderr("rb").read().decode().strip()
+        exit_code = channel.recv_exit_status()
+    finally:
+        channel.close()
+    if exit_code != 0:
+        raise DeploymentError(f"Failed to rebuild files from chunks: {err}")
+
+
+def make_remote_dirs(ssh: paramiko.SSHClient, remote_path: str, files: list[tuple[Path, Path]]):
+    """Create the parent directories of all `files` below `remote_path` in one command."""
+    directories = {relative_path.parent.as_posix() for _, relative_path in files if relative_path.parent != Path(".")}
+    if not directories:
+        return
+    dir_paths = " ".join(shlex.quote(f"{remote_path}/{d}") for d in sorted(directories))
+    _, stdout, stderr = ssh.exec_command(f"mkdir -p {dir_paths}", timeout=60)
+    if stdout.channel.recv_exit_status() != 0:
+        raise DeploymentError(f"Failed to create remote directories: {stderr.read().decode().strip()}")
+
+
+def schedule_sftp_batches(files: list[tuple[Path, Path]]) -> list[list[tuple[Path, Path, int]]]:
+    """
+    Split files into upload batches, largest first.
+
+    Each large file gets its own batch so several can be in flight at once, while
+    small files are grouped so a worker handles many of them per queue round-trip.
+    """
+    sized = sorted(((local, rel, local.stat().st_size) for local, rel in files), key=lambda f: f[2], reverse=True)
+
+    batches = [[entry] for entry in sized if entry[2] >= SMALL_FILE_SIZE]
+    current, current_bytes = [], 0
+    for entry in sized:
+        if entry[2] >= SMALL_FILE_SIZE:
+            continue
+        current.append(entry)
+        current_bytes += entry[2]
+        if len(current) >= SMALL_FILE_BATCH_COUNT or current_bytes >= SMALL_FILE_BATCH_BYTES:
+            batches.append(current)
+            current, current_bytes = [], 0
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _sftp_put(
+    sftp: paramiko.SFTPClient,
+    local_path: Path,
+    remote_file: str,
+    offset: int = 0,
+    on_progress=None,
+) -> int:
+    """
+    Upload one file with pipelined writes, returning the number of bytes sent.
+
+    A non-zero `offset` resumes a partial upload, keeping the first `offset`
+    bytes already on the remote. `on_progress(offset)` is called after each chunk.
+    """
+    sent = 0
+    mode = local_path.stat().st_mode
+    with open(local_path, "rb") as src, sftp.open(remote_file, "r+b" if offset else "wb") as dst:
+        if offset:
+            src.seek(offset)
+            dst.seek(offset)
+        dst.set_pipelined(True)
+        while chunk := src.read(STREAM_CHUNK_SIZE):
+            dst.write(chunk)
+            sent += len(chunk)
+            if on_progress:
+                on_progress(offset + sent)
+        if mode & stat.S_IXUSR:
+            dst.chmod(stat.S_IMODE(mode))
+    return sent
+
+
+def sftp_upload(
+    ssh: paramiko.SSHClient,
+    files: list[tuple[Path, Path]],
+    remote_path: str,
+    jobs: int = 4,
+    progress=None,
+    checkpoint=None,
+    offsets: dict[str, int] | None = None,
+) -> int:
+    """
+    Upload files over `jobs` concurrent SFTP sessions sharing the SSH transport.
+
+    Args:
+        ssh: Connected SSH client
+        files: List of (local_path, relative_path) tuples
+        remote_path: Directory the files are uploaded into
+        jobs: Number of SFTP sessions (channels) to run in parallel
+        progress: Optional callable(done, total) invoked as files complete
+        checkpoint: Optional UploadCheckpoint recording finished files and partial offsets
+        offsets: Optional mapping of relative path to the byte offset to resume from
+
+    Returns:
+        Number of bytes sent
+    """
+    make_remote_dirs(ssh, remote_path, files)
+
+    work = queue.Queue()
+    for batch in schedule_sftp_batches(files):
+        work.put(batch)
+
+    transport = ssh.get_transport()
+    lock = threading.Lock()
+    state = {"done": 0, "bytes": 0, "error": None}
+    total = len(files)
+
+    def worker():
+        try:
+            sftp = paramiko.SFTPClient.from_transport(transport)
+        except paramiko.SSHException as e:
+            with lock:
+                state["error"] = state["error"] or e
+            return
+        try:
+            while state["error"] is None:
+                try:
+                    batch = work.get_nowait()
+                except queue.Empty:
+                    return
+                for local_path, relative_path, size in batch:
+                    key = relative_path.as_posix()
+                    on_progress = None
+                    if checkpoint and size >= SMALL_FILE_SIZE:
+                        on_progress = lambda offset, key=key: checkpoint.file_progress(key, offset)
+                    sent = _sftp_put(
+                        sftp,
+                        local_path,
+                        f"{remote_path}/{key}",
+                        offset=(offsets or {}).get(key, 0),
+                        on_progress=on_progress,
+                    )
+                    if checkpoint:
+                        checkpoint.file_done(key)
+                    with lock:
+                        state["done"] += 1
+                        state["bytes"] += sent
+                        if progress:
+                            progress(state["done"], total)
+        except (OSError, paramiko.SSHException) as e:
+            with lock:
+                state["error"] = state["error"] or e
+        finally:
+            sftp.close()
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(max(1, jobs))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if state["error"] is not None:
+        raise transfer_error(transport, f"SFTP upload failed: {state['error']}") from state["error"]
+    return state["bytes"]
+
+
+def remote_file_sizes(
+    ssh: paramiko.SSHClient,
+    remote_path: str,
+    relative_paths: list[str],
+    batch_size: int = 200,
+) -> dict[str, int]:
+    """Return the size of each existing file below `remote_path`; missing files are left out."""
+    sizes = {}
+    for start in range(0, len(relative_paths), batch_size):
+        batch = relative_paths[start:start + batch_size]
+        targets = " ".join(shlex.quote(path) for path in batch)
+        _, stdout, _ = ssh.exec_command(
+            f"cd {shlex.quote(remote_path)} && stat -c '%s %n' -- {targets}", timeout=60
+        )
+        for line in stdout.read().decode().splitlines():
+            size, _, path = line.partition(" ")
+            if size.isdigit():
+                sizes[path] = int(size)
+    return sizes
+
+
+def write_remote_file(ssh: paramiko.SSHClient, remote_file: str, data: bytes):
+    """Write `data` to a file on the remote server, replacing it atomically."""
+    target = shlex.quote(remote_file)
+    tmp = shlex.quote(f"{remote_file}.tmp")
+    channel = ssh.get_transport().open_session()
+    try:
+        channel.exec_command(f"cat > {tmp} && mv {tmp} {target}")
+        channel.sendall(data)
+        channel.shutdown_write()
+        exit_code = channel.recv_exit_status()
+    finally:
+        channel.close()
+    if exit_code != 0:
+        raise DeploymentError(f"Failed to write {remote_file} (exit code {exit_code})")
+
+
+def read_remote_file(ssh: paramiko.SSHClient, remote_file: str, timeout: float = 120) -> bytes | None:
+    """
+    Read a whole file from the remote server, or None when it cannot be read.
+
+    Unlike command output, which only keeps its tail, the contents are never truncated.
+    """
+    channel = ssh.get_transport().open_session(timeout=timeout)
+    try:
+        channel.settimeout(timeout)
+        channel.exec_command(f"cat {shlex.quote(remote_file)}")
+        channel.shutdown_write()
+        data = channel.makefile("rb").read()
+        channel.makefile_stderr("rb").read()
+        exit_code = channel.recv_exit_status()
+    finally:
+        channel.close()
+    return data if exit_code == 0 else None
+
+
+def remove_remote_files(ssh: paramiko.SSHClient, remote_path: str, relative_paths: list[str], batch_size: int = 200):
+    """Delete files below `remote_path` in batches of `batch_size` paths per command."""
+    for start in range(0, len(relative_paths), batch_size):
+        batch = relative_paths[start:start + batch_size]
+        targets = " ".join(shlex.quote(f"{remote_path}/{path}") for path in batch)
+        _, stdout, _ = ssh.exec_command(f"rm -f {targets}", timeout=60)
+        if stdout.channel.recv_exit_status() != 0:
+            raise DeploymentError(f"Failed to remove {len(batch)} deleted files on the remote")
+
+
+def _delta_helper_command(*args: str) -> str:
+    """Build the remote command running the delta module with `python3 -c`."""
+    return " ".join(["python3", "-c", shlex.quote(module_source(delta)), *(shlex.quote(arg) for arg in args)])
+
+
+def fetch_delta_signatures(ssh: paramiko.SSHClient, block_sizes: dict[str, int]) -> dict | None:
+    """
+    Compute block signatures of remote files with the delta helper.
+
+    Args:
+        ssh: Connected SSH client
+        block_sizes: Mapping of remote file path to block size
+
+    Returns:
+        Mapping of remote file path to its signature (None for unreadable files),
+        or None if the helper cannot run on the remote
+    """
+    channel = ssh.get_transport().open_session()
+    try:
+        channel.exec_command(_delta_helper_command("sig"))
+        channel.sendall(json.dumps(block_sizes).encode())
+        channel.shutdown_write()
+        output = channel.makefile("rb").read()
+        exit_code = channel.recv_exit_status()
+    finally:
+        channel.close()
+    if exit_code != 0:
+        return None
+    try:
+        return json.loads(output)
+    except json.JSONDecodeError:
+        return None
+
+
+def apply_remote_delta(
+    ssh: paramiko.SSHClient,
+    remote_file: str,
+    block_size: int,
+    payload: bytes,
+    expected_sha256: str,
+):
+    """Send an encoded delta and rebuild `remote_file` with the delta helper."""
+    channel = ssh.get_transport().open_session()
+    try:
+        channel.exec_command(_delta_helper_command("patch", remote_file, str(block_size), expected_sha256))
+        for start in range(0, len(payload), STREAM_CHUNK_SIZE):
+            channel.sendall(payload[start:start + STREAM_CHUNK_SIZE])
+        channel.shutdown_write()
+        exit_code = channel.recv_exit_status()
+        err = channel.makefile_stderr("rb").read().decode().strip()
+    finally:
+        channel.close()
+    if exit_code != 0:
+        raise DeploymentError(f"Delta patch failed for {remote_file}: {err.splitlines()[-1] if err else exit_code}")
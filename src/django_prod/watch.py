@@ -0,0 +1,185 @@
+"""
+File watchers used by `django_prod_deploy --watch`.
+
+On Linux the project tree is watched with inotify (through ctypes, no extra
+dependency); elsewhere, or when inotify is unavailable, the tree is polled.
+Bursts of events are debounced into batches of relative paths.
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+from pathlib import Path
+
+from .ignore import IgnoreMatcher, walk_project
+
+# Wait this long without new events before handing out a batch...
+DEBOUNCE_SECONDS = 0.2
+# ...but never hold a batch back for longer than this
+MAX_BATCH_DELAY = 1.0
+
+POLL_INTERVAL = 1.0
+
+_IN_MODIFY = 0x00000002
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_ISDIR = 0x40000000
+_IN_Q_OVERFLOW = 0x00004000
+_WATCH_MASK = _IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+class PollingWatcher:
+    """Detect changes by comparing (mtime, size) snapshots of the project tree."""
+
+    def __init__(self, root: Path, matcher: IgnoreMatcher):
+        self.root = root
+        self.matcher = matcher
+        self.snapshot = self._scan()
+
+    def _scan(self) -> dict[str, tuple[int, int]]:
+        snapshot = {}
+        for local_path, relative_path in walk_project(self.root, self.matcher):
+            try:
+                stat = local_path.stat()
+            except FileNotFoundError:
+                continue
+            snapshot[relative_path.as_posix()] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def poll(self, timeout: float) -> set[str]:
+        time.sleep(min(timeout, POLL_INTERVAL))
+        current = self._scan()
+        changed = {path for path, state in current.items() if self.snapshot.get(path) != state}
+        changed |= self.snapshot.keys() - current.keys()
+        self.snapshot = current
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """Watch every non-ignored directory of the project with inotify."""
+
+    def __init__(self, root: Path, matcher: IgnoreMatcher):
+        self.root = root
+        self.matcher = matcher
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}
+        self._watch_tree(root, "")
+        # Files known under the watched tree, reported as changed when their directory goes away
+        self.files = {relative_path.as_posix() for _, relative_path in walk_project(root, matcher)}
+
+    def _watch_tree(self, directory: Path, relative_dir: str):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), _WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {directory}")
+        self.watches[wd] = relative_dir
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            return
+        for entry in entries:
+            relative_path = f"{relative_dir}/{entry.name}" if relative_dir else entry.name
+            if entry.is_dir(follow_symlinks=False) and not self.matcher.is_ignored(relative_path, is_dir=True):
+                self._watch_tree(Path(entry.path), relative_path)
+
+    def _files_below(self, relative_dir: str) -> set[str]:
+        files = set()
+        for directory, dirnames, filenames in os.walk(self.root / relative_dir):
+            base = Path(directory).relative_to(self.root).as_posix()
+            dirnames[:] = [d for d in dirnames if not self.matcher.is_ignored(f"{base}/{d}", is_dir=True)]
+            files.update(f"{base}/{name}" for name in filenames if not self.matcher.is_ignored(f"{base}/{name}"))
+        return files
+
+    def _unwatch_tree(self, relative_dir: str):
+        """Stop watching a directory that left the tree: its watch would report under a stale path."""
+        for wd, watched in list(self.watches.items()):
+            if watched == relative_dir or watched.startswith(relative_dir + "/"):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def poll(self, timeout: float) -> set[str]:
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0").decode(errors="surrogateescape")
+            offset += length
+
+            if mask & _IN_Q_OVERFLOW:
+                # Events were dropped: report every file, present or gone, so nothing is missed
+                current = {relative_path.as_posix() for _, relative_path in walk_project(self.root, self.matcher)}
+                changed = self.files | current
+                self.files = current
+                return changed
+            relative_dir = self.watches.get(wd)
+            if relative_dir is None or not name:
+                continue
+            relative_path = f"{relative_dir}/{name}" if relative_dir else name
+            if mask & _IN_ISDIR:
+                if mask & (_IN_MOVED_FROM | _IN_DELETE):
+                    # A directory moved away only reports itself: its files are gone too
+                    gone = {path for path in self.files if path.startswith(relative_path + "/")}
+                    self.files -= gone
+                    changed |= gone
+                    self._unwatch_tree(relative_path)
+                elif mask & (_IN_CREATE | _IN_MOVED_TO) and not self.matcher.is_ignored(relative_path, is_dir=True):
+                    self._watch_tree(self.root / relative_path, relative_path)
+                    # Files may have been created before the watch was added
+                    added = self._files_below(relative_path)
+                    self.files |= added
+                    changed |= added
+                continue
+            if not self.matcher.is_ignored(relative_path):
+                if mask & (_IN_MOVED_FROM | _IN_DELETE):
+                    self.files.discard(relative_path)
+                else:
+                    self.files.add(relative_path)
+                changed.add(relative_path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def create_watcher(root: Path, matcher: IgnoreMatcher):
+    """Return an inotify watcher when possible, a polling watcher otherwise."""
+    try:
+        return InotifyWatcher(root, matcher)
+    except (OSError, AttributeError, TypeError):
+        return PollingWatcher(root, matcher)
+
+
+def batches(watcher):
+    """Yield sets of changed relative paths, debouncing bursts of events."""
+    while True:
+        pending = watcher.poll(timeout=3600)
+        if not pending:
+            continue
+        first_event = time.monotonic()
+        while time.monotonic() - first_event < MAX_BATCH_DELAY:
+            more = watcher.poll(timeout=DEBOUNCE_SECONDS)
+            if not more:
+                break
+            pending |= more
+        yield pending
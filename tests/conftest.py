@@ -0,0 +1,17 @@
+import paramiko
+import pytest
+
+from sshserver import LocalSSHServer
+
+
+@pytest.fixture(scope="session")
+def ssh_keys():
+    return paramiko.RSAKey.generate(2048), paramiko.RSAKey.generate(2048)
+
+
+@pytest.fixture
+def ssh_server(ssh_keys):
+    host_key, client_key = ssh_keys
+    server = LocalSSHServer(host_key, client_key)
+    yield server
+    server.close()
@@ -0,0 +1,136 @@
+"""
+Local paramiko SSH server standing in for a deployment target in tests.
+
+It accepts one client key and runs each exec request as `sh -c COMMAND` on this
+machine, streaming stdin, stdout, stderr and the exit status over the channel,
+so the upload and tuning code talk to it exactly as to a real server.
+"""
+import socket
+import subprocess
+import threading
+
+import paramiko
+
+from django_prod.tuning import connect_kwargs
+
+
+class _ServerInterface(paramiko.ServerInterface):
+    def __init__(self, server: "LocalSSHServer"):
+        self.server = server
+
+    def get_allowed_auths(self, username):
+        return "publickey"
+
+    def check_auth_publickey(self, username, key):
+        if key == self.server.client_key:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        command = command.decode()
+        self.server.commands.append(command)
+        threading.Thread(target=_run_command, args=(channel, command), daemon=True).start()
+        return True
+
+
+def _run_command(channel: paramiko.Channel, command: str):
+    process = subprocess.Popen(
+        ["sh", "-c", command], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+
+    def feed_stdin():
+        try:
+            while data := channel.recv(64 * 1024):
+                process.stdin.write(data)
+                # Interactive commands (the agent, the mux) wait for each request
+                process.stdin.flush()
+        except (OSError, EOFError):
+            pass
+        finally:
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+
+    def pump_stderr():
+        try:
+            while data := process.stderr.read1(64 * 1024):
+                channel.sendall_stderr(data)
+        except OSError:
+            pass
+
+    threads = [threading.Thread(target=feed_stdin, daemon=True), threading.Thread(target=pump_stderr, daemon=True)]
+    for thread in threads:
+        thread.start()
+    try:
+        while data := process.stdout.read1(64 * 1024):
+            channel.sendall(data)
+        threads[1].join()
+        channel.send_exit_status(process.wait())
+    except OSError:
+        process.kill()
+    finally:
+        try:
+            channel.close()
+        except (OSError, EOFError):
+            # The client already dropped the connection
+            pass
+
+
+class LocalSSHServer:
+    """SSH server on 127.0.0.1 accepting `client_key`, run in background threads until `close()`."""
+
+    def __init__(self, host_key: paramiko.PKey, client_key: paramiko.PKey):
+        self.host_key = host_key
+        self.client_key = client_key
+        self.commands = []
+        self.transports = []
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(16)
+        self.port = self.sock.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                client, _ = self.sock.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(client)
+            transport.add_server_key(self.host_key)
+            try:
+                transport.start_server(server=_ServerInterface(self))
+            except (paramiko.SSHException, EOFError):
+                transport.close()
+                continue
+            # Opened channels wait in the transport's accept queue, which keeps them alive;
+            # the exec requests do the work
+            self.transports.append(transport)
+
+    def connect(self, settings: dict | None = None) -> paramiko.SSHClient:
+        """Open a client connection, with tuned SSH settings when given."""
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        ssh.connect(
+            "127.0.0.1",
+            port=self.port,
+            username="deploy",
+            pkey=self.client_key,
+            look_for_keys=False,
+            allow_agent=False,
+            timeout=10,
+            **connect_kwargs(settings),
+        )
+        return ssh
+
+    def close(self):
+        self.sock.close()
+        for transport in self.transports:
+            transport.close()
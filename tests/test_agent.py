@@ -0,0 +1,116 @@
+import hashlib
+import io
+import os
+import time
+from pathlib import Path
+
+import pytest
+
+from django_prod import agent
+from django_prod.delta import compute_delta, encode_delta
+from django_prod.exceptions import ConnectionLost, DeploymentError
+from django_prod.remote import AGENT_BATCH_BYTES, RemoteAgent
+
+
+def test_messages_carry_raw_attachments():
+    stream = io.BytesIO(
+        agent.encode_message({"id": 1, "method": "write_files"}, b"\x00\n{binary}")
+        + agent.encode_message({"id": 2, "method": "ping"})
+    )
+    assert agent.read_message(stream) == ({"id": 1, "method": "write_files", "attachment": 10}, b"\x00\n{binary}")
+    assert agent.read_message(stream) == ({"id": 2, "method": "ping"}, b"")
+    assert agent.read_message(stream) == (None, b"")
+
+    with pytest.raises(EOFError):
+        agent.read_message(io.BytesIO(agent.encode_message({"id": 3}, b"data")[:-1]))
+
+
+@pytest.fixture
+def remote_agent(ssh_server, monkeypatch):
+    # Commands must not depend on the login shell of the deploying user
+    monkeypatch.setenv("SHELL", "/bin/false")
+    ssh = ssh_server.connect()
+    client = RemoteAgent.start(ssh)
+    yield client
+    client.close()
+    ssh.close()
+
+
+def test_files_round_trip(remote_agent, tmp_path):
+    local, remote = tmp_path / "local", tmp_path / "remote"
+    (local / "app").mkdir(parents=True)
+    files = {"app/views.py": b"print()\n", "app/empty.txt": b"", "big.bin": os.urandom(AGENT_BATCH_BYTES + 1000)}
+    for path, data in files.items():
+        (local / path).write_bytes(data)
+    (local / "app" / "views.py").chmod(0o755)
+
+    done = []
+    bytes_sent = remote_agent.write_files(str(remote), [(local / path, Path(path)) for path in files], done.append)
+    assert bytes_sent == sum(len(data) for data in files.values())
+    assert sorted(done) == sorted(files)
+    for path, data in files.items():
+        assert (remote / path).read_bytes() == data
+    assert (remote / "app" / "views.py").stat().st_mode & 0o777 == 0o755
+    assert not list(remote.rglob("*.django_prod_part"))
+
+    assert remote_agent.file_sizes(str(remote), ["big.bin", "missing", "app"]) == {"big.bin": len(files["big.bin"])}
+    assert remote_agent.hash_files(str(remote), ["app/views.py", "missing"]) == {
+        "app/views.py": hashlib.blake2b(files["app/views.py"], digest_size=32).hexdigest(),
+        "missing": None,
+    }
+    assert remote_agent.read_file(str(remote / "app" / "views.py")) == b"print()\n"
+    assert remote_agent.read_file(str(remote / "missing")) is None
+
+    remote_agent.remove_files(str(remote), ["app/views.py", "missing"])
+    assert not (remote / "app" / "views.py").exists()
+    assert remote_agent.stats()["bytes_written"] == bytes_sent
+
+
+def test_apply_delta(remote_agent, tmp_path):
+    block_size = 1024
+    old = os.urandom(16 * block_size)
+    new = old[:4000] + b"inserted" + old[4000:]
+    (tmp_path / "asset.bin").write_bytes(old)
+    remote_file = str(tmp_path / "asset.bin")
+
+    signature = remote_agent.signatures({remote_file: block_size})[remote_file]
+    payload = encode_delta(compute_delta(new, signature, block_size))
+    assert len(payload) < len(new) / 2
+    remote_agent.apply_delta(remote_file, block_size, payload, hashlib.sha256(new).hexdigest())
+    assert (tmp_path / "asset.bin").read_bytes() == new
+
+    with pytest.raises(DeploymentError, match="Checksum mismatch"):
+        remote_agent.apply_delta(remote_file, block_size, payload, hashlib.sha256(old).hexdigest())
+    assert (tmp_path / "asset.bin").read_bytes() == new
+
+
+def test_run_streams_output_through_sh(remote_agent):
+    lines = []
+    exit_code, out, err = remote_agent.run(
+        'for word in one two; do echo "$word"; done; [ "$0" = /bin/sh ] && echo sh >&2; exit 3',
+        on_stdout=lines.append,
+    )
+    assert (exit_code, out, err) == (3, "one\ntwo", "sh")
+    assert lines == ["one", "two"]
+
+    with pytest.raises(DeploymentError, match="timed out after 1s"):
+        remote_agent.run("sleep 30", timeout=1)
+
+
+def test_commands_run_concurrently_with_other_requests(remote_agent):
+    call = remote_agent.submit("run", command="sleep 2", timeout=10)
+    started = time.monotonic()
+    remote_agent.call("ping", timeout=5)
+    assert time.monotonic() - started < 1.5
+    assert call.wait(10) == {"exit_code": 0, "timed_out": False}
+
+
+def test_errors(remote_agent):
+    with pytest.raises(DeploymentError, match="Method not found: nothing"):
+        remote_agent.call("nothing")
+    with pytest.raises(DeploymentError, match="FileNotFoundError"):
+        remote_agent.apply_delta("/nonexistent/asset.bin", 1024, b"", "")
+    remote_agent.close()
+    remote_agent.reader.join(5)
+    with pytest.raises(ConnectionLost):
+        remote_agent.call("ping")
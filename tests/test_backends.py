@@ -0,0 +1,42 @@
+from django_prod.backends import MIN_MEASURED_BYTES, TransferStats, choose_backend, record_stats
+
+
+class FakeBackend:
+    def __init__(self, name, available=True):
+        self.name = name
+        self._available = available
+
+    def available(self):
+        return self._available
+
+
+def backends(*unavailable):
+    return {name: FakeBackend(name, name not in unavailable) for name in ("rsync", "tar", "agent", "sftp", "scp")}
+
+
+def test_large_uploads_try_each_backend_once():
+    history = {"rsync": {"rate": 5e6}}
+    assert choose_backend(backends(), history, MIN_MEASURED_BYTES).name == "tar"
+    assert choose_backend(backends("tar"), history, MIN_MEASURED_BYTES).name == "agent"
+    history.update(tar={"rate": 9e6}, agent={"rate": 1e6}, sftp={"rate": 2e6})
+    assert choose_backend(backends(), history, MIN_MEASURED_BYTES).name == "tar"
+
+
+def test_small_uploads_do_not_explore():
+    assert choose_backend(backends(), {}, 1000).name == "rsync"
+    assert choose_backend(backends("rsync"), {}, 1000).name == "tar"
+    assert choose_backend(backends(), {"sftp": {"rate": 1e6}}, 1000).name == "sftp"
+
+
+def test_scp_only_without_any_other_backend():
+    assert choose_backend(backends("rsync", "tar", "agent", "sftp"), {}, MIN_MEASURED_BYTES).name == "scp"
+
+
+def test_record_stats():
+    history = {}
+    record_stats(history, TransferStats("tar", 3, MIN_MEASURED_BYTES - 1, 100, 0.1))
+    assert history == {}
+    record_stats(history, TransferStats("tar", 3, 4_000_000, 2_000_000, 2.0))
+    assert history == {"tar": {"rate": 2_000_000, "bytes_sent": 2_000_000, "seconds": 2.0}}
+    record_stats(history, TransferStats("tar", 3, 4_000_000, 2_000_000, 1.0))
+    assert history["tar"]["rate"] == 3_000_000
@@ -0,0 +1,66 @@
+import random
+
+from django_prod.chunking import (
+    MAX_CHUNK_SIZE,
+    MIN_CHUNK_SIZE,
+    chunk_boundaries,
+    chunk_file,
+    chunk_id,
+    read_chunk,
+)
+from django_prod.transfer import assemble_remote_files
+
+
+def test_boundaries_cover_data_within_bounds():
+    data = random.Random(1).randbytes(3 * 1024 * 1024)
+    boundaries = chunk_boundaries(data)
+    assert boundaries[-1] == len(data)
+    sizes = [end - start for start, end in zip([0, *boundaries], boundaries)]
+    assert all(size <= MAX_CHUNK_SIZE for size in sizes)
+    assert all(size > MIN_CHUNK_SIZE for size in sizes[:-1])
+
+
+def test_small_and_empty_data():
+    assert chunk_boundaries(b"") == []
+    assert chunk_boundaries(b"x" * MIN_CHUNK_SIZE) == [MIN_CHUNK_SIZE]
+
+
+def test_insertion_keeps_later_chunks():
+    data = random.Random(2).randbytes(2 * 1024 * 1024)
+    edited = data[:100_000] + b"inserted" + data[100_000:]
+    ids = {chunk_id(data[start:end]) for start, end in zip([0, *chunk_boundaries(data)], chunk_boundaries(data))}
+    edited_boundaries = chunk_boundaries(edited)
+    edited_ids = [chunk_id(edited[start:end]) for start, end in zip([0, *edited_boundaries], edited_boundaries)]
+    assert sum(chunk not in ids for chunk in edited_ids) <= 2
+
+
+def test_chunk_file_roundtrip(tmp_path):
+    path = tmp_path / "asset.bin"
+    path.write_bytes(random.Random(3).randbytes(1024 * 1024 + 17))
+    chunks = chunk_file(path)
+    assert b"".join(read_chunk(path, offset, length) for _, offset, length in chunks) == path.read_bytes()
+    assert all(chunk == chunk_id(read_chunk(path, offset, length)) for chunk, offset, length in chunks)
+
+
+def test_assemble_remote_files(ssh_server, tmp_path):
+    store = tmp_path / "store"
+    store.mkdir()
+    data = random.Random(4).randbytes(1024 * 1024)
+    source = tmp_path / "source.bin"
+    source.write_bytes(data)
+    recipe = []
+    for chunk, offset, length in chunk_file(source):
+        (store / chunk).write_bytes(read_chunk(source, offset, length))
+        recipe.append(chunk)
+    # Far more ids than fit on one command line
+    many = ["0" * 64] * 50_000
+    (store / many[0]).write_bytes(b"")
+
+    ssh = ssh_server.connect()
+    try:
+        assemble_remote_files(ssh, str(store), str(tmp_path / "release"), {"a/b.bin": recipe, "many.bin": many})
+    finally:
+        ssh.close()
+    assert (tmp_path / "release" / "a" / "b.bin").read_bytes() == data
+    assert (tmp_path / "release" / "many.bin").read_bytes() == b""
+    assert ssh_server.commands == ["sh -s"]
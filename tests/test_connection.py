@@ -0,0 +1,95 @@
+import errno
+import socket
+
+import paramiko
+import pytest
+
+from django_prod.connection import is_connection_error, reconnect, transfer_error, transport_lost
+from django_prod.exceptions import ConnectionLost, DeploymentError
+
+
+def raised_from(error: BaseException, cause: BaseException) -> BaseException:
+    try:
+        raise error from cause
+    except BaseException as e:
+        return e
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        ConnectionLost("gone"),
+        ConnectionResetError(),
+        BrokenPipeError(),
+        socket.timeout(),
+        EOFError(),
+        paramiko.SSHException("Channel closed."),
+        OSError(errno.EHOSTUNREACH, "No route to host"),
+        raised_from(DeploymentError("Upload failed"), ConnectionResetError()),
+    ],
+)
+def test_connection_errors(error):
+    assert is_connection_error(error)
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        FileNotFoundError(errno.ENOENT, "No such file", "app/gone.py"),
+        PermissionError(errno.EACCES, "Permission denied"),
+        DeploymentError("Command failed"),
+        paramiko.AuthenticationException(),
+        raised_from(DeploymentError("Upload failed"), FileNotFoundError()),
+        raised_from(DeploymentError("Login failed"), paramiko.AuthenticationException()),
+    ],
+)
+def test_other_errors(error):
+    assert not is_connection_error(error)
+
+
+class FakeTransport:
+    def __init__(self, active: bool):
+        self.active = active
+
+    def is_active(self) -> bool:
+        return self.active
+
+
+class FakeClient:
+    def __init__(self, transport):
+        self.transport = transport
+
+    def get_transport(self):
+        return self.transport
+
+
+def test_transfer_error_and_transport_lost():
+    assert type(transfer_error(FakeTransport(True), "failed")) is DeploymentError
+    assert isinstance(transfer_error(FakeTransport(False), "failed"), ConnectionLost)
+    assert isinstance(transfer_error(None, "failed"), ConnectionLost)
+    assert not transport_lost(FakeClient(FakeTransport(True)))
+    assert transport_lost(FakeClient(FakeTransport(False)))
+    assert transport_lost(FakeClient(None))
+
+
+def failing(error: BaseException):
+    def connect():
+        raise error
+
+    return connect
+
+
+def test_reconnect():
+    attempts = []
+
+    def connect():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise ConnectionRefusedError()
+        return "client"
+
+    assert reconnect(connect, delays=(0, 0, 0)) == "client"
+    with pytest.raises(ConnectionLost, match="after 2 attempts"):
+        reconnect(failing(socket.timeout()), delays=(0, 0))
+    with pytest.raises(paramiko.AuthenticationException):
+        reconnect(failing(paramiko.AuthenticationException()), delays=(0,))
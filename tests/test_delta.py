@@ -0,0 +1,97 @@
+import hashlib
+import io
+import mmap
+import os
+import random
+
+import pytest
+
+from django_prod.delta import (
+    MIN_BLOCK_SIZE,
+    apply_patch,
+    block_size_for,
+    compute_delta,
+    encode_delta,
+    file_signature,
+)
+
+
+def patch_roundtrip(tmp_path, old: bytes, new: bytes):
+    path = tmp_path / "file.bin"
+    path.write_bytes(old)
+    block_size = block_size_for(len(old))
+    operations = list(compute_delta(new, file_signature(str(path), block_size), block_size))
+    apply_patch(str(path), block_size, hashlib.sha256(new).hexdigest(), io.BytesIO(encode_delta(operations)))
+    assert path.read_bytes() == new
+    return operations
+
+
+def literal_bytes(operations) -> int:
+    return sum(len(value) for op, value in operations if op == "data")
+
+
+def test_block_size_bounds():
+    assert block_size_for(0) == MIN_BLOCK_SIZE
+    assert block_size_for(10**12) == 64 * 1024
+    assert block_size_for(64 * 1024 * 1024) % 8 == 0
+
+
+def test_identical_file_is_all_copies(tmp_path):
+    data = os.urandom(200_000)
+    operations = patch_roundtrip(tmp_path, data, data)
+    assert literal_bytes(operations) < block_size_for(len(data))
+
+
+def test_insertion_sends_little_data(tmp_path):
+    old = os.urandom(500_000)
+    new = old[:123_457] + b"inserted bytes" + old[123_457:]
+    operations = patch_roundtrip(tmp_path, old, new)
+    assert literal_bytes(operations) < 3 * block_size_for(len(old))
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_random_edits(tmp_path, seed):
+    rng = random.Random(seed)
+    old = bytearray(rng.randbytes(rng.randrange(0, 150_000)))
+    new = bytearray(old)
+    for _ in range(rng.randrange(1, 6)):
+        at = rng.randrange(0, len(new) + 1)
+        new[at:at + rng.randrange(0, 5000)] = rng.randbytes(rng.randrange(0, 5000))
+    patch_roundtrip(tmp_path, bytes(old), bytes(new))
+
+
+@pytest.mark.parametrize("size", [1000, 300_000])
+def test_mapped_file_gives_the_same_delta(tmp_path, size):
+    old = os.urandom(size)
+    new = old[:500] + b"edit" + old[500:]
+    path = tmp_path / "new.bin"
+    path.write_bytes(new)
+    block_size = block_size_for(len(old))
+    (tmp_path / "old.bin").write_bytes(old)
+    signature = file_signature(str(tmp_path / "old.bin"), block_size)
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        payload = encode_delta(compute_delta(mapped, signature, block_size))
+    assert payload == encode_delta(compute_delta(new, signature, block_size))
+
+
+def test_empty_and_unrelated_files(tmp_path):
+    patch_roundtrip(tmp_path, os.urandom(10_000), b"")
+    patch_roundtrip(tmp_path, b"", os.urandom(10_000))
+    patch_roundtrip(tmp_path, os.urandom(10_000), os.urandom(3 * 1024 * 1024))
+
+
+def test_checksum_mismatch_keeps_file(tmp_path):
+    path = tmp_path / "file.bin"
+    path.write_bytes(b"old contents")
+    stream = io.BytesIO(encode_delta([("data", b"new contents")]))
+    with pytest.raises(ValueError, match="Checksum mismatch"):
+        apply_patch(str(path), MIN_BLOCK_SIZE, hashlib.sha256(b"other").hexdigest(), stream)
+    assert path.read_bytes() == b"old contents"
+    assert not (tmp_path / "file.bin.django_prod_delta").exists()
+
+
+def test_truncated_stream(tmp_path):
+    path = tmp_path / "file.bin"
+    path.write_bytes(b"old")
+    with pytest.raises(ValueError, match="Truncated"):
+        apply_patch(str(path), MIN_BLOCK_SIZE, "", io.BytesIO(encode_delta([("data", b"new")])[:-3]))
@@ -0,0 +1,26 @@
+import json
+import os
+
+from django_prod import imagetar
+from django_prod.distribute import read_layer_listing
+from django_prod.remote import OUTPUT_TAIL_BYTES
+
+
+def test_layer_listing_is_read_whole(ssh_server, tmp_path, monkeypatch):
+    # A docker with many images: their listing is larger than the output tail kept by run_remote
+    listing = "\n".join(json.dumps([f"sha256:{number:064x}"]) for number in range(2000)) + "\n"
+    assert len(listing) > OUTPUT_TAIL_BYTES
+    (tmp_path / "listing.txt").write_text(listing)
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    (bin_dir / "docker").write_text(f'#!/bin/sh\n[ "$1" = image ] && [ "$2" = inspect ] && cat {tmp_path}/listing.txt\n')
+    (bin_dir / "docker").chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+    ssh = ssh_server.connect()
+    try:
+        received = read_layer_listing(ssh)
+    finally:
+        ssh.close()
+    assert received == listing
+    assert len(imagetar.present_chain_ids(received)) == 2000
@@ -0,0 +1,53 @@
+import subprocess
+
+from django_prod.hotreload import Changeset, hot_reload_command
+
+
+def test_changeset_classification():
+    assert Changeset([], []).is_empty
+    code = Changeset(["app/views.py"], ["app/old.py"])
+    assert code.paths == ["app/views.py", "app/old.py"]
+    assert not (code.needs_rebuild or code.needs_migrate or code.needs_collectstatic)
+    assert code.describe() == "copy + reload"
+
+    changes = Changeset(["app/static/site.css", "app/migrations/0002_x.py"], [])
+    assert changes.needs_migrate and changes.needs_collectstatic
+    assert changes.describe() == "copy + migrate + collectstatic + reload"
+
+    # Only top-level build files force a rebuild
+    assert not Changeset(["docs/requirements.txt"], []).needs_rebuild
+    rebuild = Changeset(["app/views.py", "requirements.txt"], ["prod.Dockerfile"])
+    assert rebuild.describe() == "rebuild required (prod.Dockerfile, requirements.txt changed)"
+
+
+def test_hot_reload_command_copies_deletes_and_reloads(tmp_path):
+    source = tmp_path / "release"
+    (source / "app").mkdir(parents=True)
+    (source / "app" / "my views.py").write_text("print()\n")
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    log = tmp_path / "docker.log"
+    # Stand-in for docker recording its arguments and the archive it is given
+    (bin_dir / "docker").write_text(f'#!/bin/sh\necho "$@" >> {log}\n[ "$1" = cp ] && tar -tf - >> {log}\nexit 0\n')
+    (bin_dir / "docker").chmod(0o755)
+
+    changeset = Changeset(["app/my views.py", "app/migrations/0002_x.py"], ["app/old.py"])
+    (source / "app" / "migrations").mkdir()
+    (source / "app" / "migrations" / "0002_x.py").write_text("")
+    command = hot_reload_command("abc123", str(source), changeset)
+    subprocess.run(["sh", "-c", command], check=True, env={"PATH": f"{bin_dir}:/usr/bin:/bin"})
+
+    assert log.read_text().splitlines() == [
+        "cp - abc123:/code",
+        "app/migrations/0002_x.py",
+        "app/my views.py",
+        "exec abc123 rm -f /code/app/old.py",
+        "exec abc123 python manage.py migrate --noinput",
+        "kill -s HUP abc123",
+    ]
+
+
+def test_hot_reload_command_without_copies():
+    command = hot_reload_command("abc123", "/srv/app/releases/1", Changeset([], ["static/x.css"]))
+    assert "tar" not in command
+    assert command.endswith("python manage.py collectstatic --noinput && docker kill -s HUP abc123")
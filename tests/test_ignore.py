@@ -0,0 +1,75 @@
+from pathlib import Path
+
+import pytest
+
+from django_prod.ignore import IgnoreMatcher, parse_ignore_lines, walk_project
+
+
+def matcher(*lines: str, anchored: bool = False) -> IgnoreMatcher:
+    return IgnoreMatcher(parse_ignore_lines(lines, anchored=anchored))
+
+
+@pytest.mark.parametrize(
+    "lines, path, is_dir, ignored",
+    [
+        (["*.log"], "logs/debug.log", False, True),
+        (["*.log", "!keep.log"], "logs/keep.log", False, False),
+        (["build/"], "build", True, True),
+        (["build/"], "build", False, False),
+        (["/media"], "media", True, True),
+        (["/media"], "app/media", True, False),
+        (["docs/*.md"], "docs/readme.md", False, True),
+        (["docs/*.md"], "docs/api/readme.md", False, False),
+        (["docs/**/*.md"], "docs/api/v1/readme.md", False, True),
+        (["**/cache"], "a/b/cache", True, True),
+        (["file?.txt"], "file1.txt", False, True),
+        (["file[!0-9].txt"], "file1.txt", False, False),
+        (["file[!0-9].txt"], "filea.txt", False, True),
+        (["\\!important"], "!important", False, True),
+        (["# comment", ""], "# comment", False, False),
+    ],
+)
+def test_gitignore_semantics(lines, path, is_dir, ignored):
+    assert matcher(*lines).is_ignored(path, is_dir) is ignored
+
+
+def test_dockerignore_patterns_are_anchored():
+    rules = matcher("tmp", anchored=True)
+    assert rules.is_ignored("tmp", True)
+    assert not rules.is_ignored("app/tmp", True)
+
+
+def test_nested_rules_apply_below_their_directory():
+    nested = matcher().with_rules(parse_ignore_lines(["*.csv"], base="data"))
+    assert nested.is_ignored("data/export.csv")
+    assert nested.is_ignored("data/2024/export.csv")
+    assert not nested.is_ignored("export.csv")
+
+
+def test_dockerignore_roundtrip():
+    rendered = matcher("*.log", "!keep.log", "/media/", anchored=False).to_dockerignore()
+    assert rendered.splitlines() == ["**/*.log", "!**/keep.log", "media"]
+
+
+def write(root: Path, relative: str, data: str = ""):
+    path = root / relative
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(data)
+
+
+def test_walk_project(tmp_path):
+    write(tmp_path, ".gitignore", "*.sqlite3\n.env.prod\nsettings_prod.py\nmedia/\n")
+    write(tmp_path, ".django_prod_ignore", "notes.txt\n")
+    write(tmp_path, "data/.gitignore", "*.csv\n!keep.csv\n")
+    for relative in (
+        "manage.py", "db.sqlite3", ".env.prod", "app/settings_prod.py", "media/photo.jpg", "notes.txt",
+        "data/export.csv", "data/keep.csv", "venv/bin/python", "app/__pycache__/x.pyc", "deployment_target.json",
+    ):
+        write(tmp_path, relative)
+
+    files = {relative.as_posix() for _, relative in walk_project(tmp_path)}
+    # The generated production files are always uploaded, even when git ignores them
+    assert files == {
+        ".gitignore", ".django_prod_ignore", "manage.py", ".env.prod", "app/settings_prod.py",
+        "data/.gitignore", "data/keep.csv",
+    }
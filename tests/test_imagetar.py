@@ -0,0 +1,83 @@
+import hashlib
+import io
+import json
+import tarfile
+
+from django_prod.imagetar import chain_ids, present_chain_ids, write_missing_layers
+
+
+def diff_id(data: bytes) -> str:
+    return "sha256:" + hashlib.sha256(data).hexdigest()
+
+
+def add_file(archive: tarfile.TarFile, name: str, data: bytes):
+    member = tarfile.TarInfo(name)
+    member.size = len(data)
+    archive.addfile(member, io.BytesIO(data))
+
+
+def save_images(path, images: dict[str, list[bytes]]):
+    """Write a `docker save` style archive holding `images`, name -> layer contents."""
+    manifest = []
+    with tarfile.open(path, "w") as archive:
+        layers = {}
+        for name, contents in images.items():
+            for data in contents:
+                layers[diff_id(data)] = data
+            config = {"rootfs": {"type": "layers", "diff_ids": [diff_id(data) for data in contents]}}
+            config_name = f"{name}.json"
+            add_file(archive, config_name, json.dumps(config).encode())
+            paths = [f"{diff_id(data)[7:]}/layer.tar" for data in contents]
+            manifest.append({"Config": config_name, "RepoTags": [f"{name}:latest"], "Layers": paths})
+        for layer_id, data in layers.items():
+            add_file(archive, f"{layer_id[7:]}/layer.tar", data)
+        add_file(archive, "manifest.json", json.dumps(manifest).encode())
+
+
+def filtered_names(path, present: set) -> tuple[set, int, int]:
+    out = io.BytesIO()
+    skipped, skipped_bytes = write_missing_layers(str(path), present, out)
+    out.seek(0)
+    with tarfile.open(fileobj=out) as archive:
+        return set(archive.getnames()), skipped, skipped_bytes
+
+
+def test_chain_ids():
+    assert chain_ids([]) == []
+    first, second = diff_id(b"base"), diff_id(b"app")
+    expected = "sha256:" + hashlib.sha256(f"{first} {second}".encode()).hexdigest()
+    assert chain_ids([first, second]) == [first, expected]
+
+
+def test_present_chain_ids_skips_noise():
+    listing = json.dumps([diff_id(b"base"), diff_id(b"deps")]) + "\nWARNING: something\n\nnull\n"
+    assert present_chain_ids(listing) == set(chain_ids([diff_id(b"base"), diff_id(b"deps")]))
+
+
+def test_skips_layers_the_receiver_has(tmp_path):
+    path = tmp_path / "images.tar"
+    base, deps, app = b"base" * 100, b"deps" * 100, b"app v2"
+    save_images(path, {"web": [base, deps, app]})
+    listing = json.dumps([diff_id(base), diff_id(deps), diff_id(b"app v1")])
+
+    names, skipped, skipped_bytes = filtered_names(path, present_chain_ids(listing))
+    assert (skipped, skipped_bytes) == (2, len(base) + len(deps))
+    assert f"{diff_id(app)[7:]}/layer.tar" in names
+    assert f"{diff_id(base)[7:]}/layer.tar" not in names
+    assert {"manifest.json", "web.json"} <= names
+
+
+def test_same_diff_id_on_another_parent_is_sent(tmp_path):
+    path = tmp_path / "images.tar"
+    save_images(path, {"web": [b"base", b"app"]})
+    listing = json.dumps([diff_id(b"other base"), diff_id(b"app")])
+    _, skipped, _ = filtered_names(path, present_chain_ids(listing))
+    assert skipped == 0
+
+
+def test_layer_shared_with_a_missing_image_is_kept(tmp_path):
+    path = tmp_path / "images.tar"
+    save_images(path, {"web": [b"base", b"web"], "worker": [b"other", b"web"]})
+    names, skipped, _ = filtered_names(path, set(chain_ids([diff_id(b"base"), diff_id(b"web")])))
+    assert skipped == 1
+    assert f"{diff_id(b'web')[7:]}/layer.tar" in names
@@ -0,0 +1,38 @@
+from django_prod.ignore import walk_project
+from django_prod.localbuild import BUILD_CONTEXT_DIRNAME, platform_for, stage_build_context
+
+
+def write(root, relative: str, data: str = "x"):
+    path = root / relative
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(data)
+    return path
+
+
+def test_build_context_holds_only_uploaded_files(tmp_path):
+    for relative in (
+        "manage.py", "app/views.py", "prod.Dockerfile", "docker-compose.yaml", ".env.prod", ".env",
+        ".venv/bin/python", ".git/HEAD", "deployment_target.json", "app/__pycache__/views.pyc",
+    ):
+        write(tmp_path, relative)
+    # A stale context from an interrupted build is replaced
+    write(tmp_path, f"{BUILD_CONTEXT_DIRNAME}/stale.py")
+
+    context = tmp_path / BUILD_CONTEXT_DIRNAME
+    stage_build_context(walk_project(tmp_path), context)
+
+    staged = {path.relative_to(context).as_posix() for path in context.rglob("*") if path.is_file()}
+    assert staged == {"manage.py", "app/views.py", "prod.Dockerfile", "docker-compose.yaml", ".env.prod"}
+    assert (context / "manage.py").stat().st_ino == (tmp_path / "manage.py").stat().st_ino
+
+
+def test_build_context_is_not_uploaded(tmp_path):
+    write(tmp_path, "manage.py")
+    write(tmp_path, f"{BUILD_CONTEXT_DIRNAME}/manage.py")
+    assert [relative.as_posix() for _, relative in walk_project(tmp_path)] == ["manage.py"]
+
+
+def test_platform_for():
+    assert platform_for("x86_64") == "linux/amd64"
+    assert platform_for("aarch64") == "linux/arm64"
+    assert platform_for(None) is None
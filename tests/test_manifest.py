@@ -0,0 +1,86 @@
+import json
+import os
+from pathlib import Path
+
+import pytest
+
+from django_prod.exceptions import DeploymentError
+from django_prod.manifest import (
+    HASH_ALGORITHM,
+    HashCache,
+    build_manifest,
+    diff_manifests,
+    dump_manifest,
+    hash_file,
+    parse_manifest,
+)
+
+
+def make_files(root: Path, contents: dict) -> list[tuple[Path, Path]]:
+    files = []
+    for relative, data in contents.items():
+        path = root / relative
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+        files.append((path, Path(relative)))
+    return files
+
+
+def test_dump_parse_roundtrip(tmp_path):
+    files = make_files(tmp_path, {"manage.py": b"print()", "app/views.py": b"x" * 100_000})
+    manifest = build_manifest(files)
+    assert parse_manifest(dump_manifest(manifest).decode()) == manifest
+    assert manifest["app/views.py"]["size"] == 100_000
+    assert manifest["manage.py"]["hash"] == hash_file(tmp_path / "manage.py")
+
+
+def test_parse_drops_hashes_of_another_algorithm():
+    content = json.dumps({"version": 1, "algorithm": "md5", "files": {"a.py": {"size": 1, "mtime": 2, "hash": "x"}}})
+    assert parse_manifest(content) == {"a.py": {"size": 1, "mtime": 2, "hash": None}}
+
+
+@pytest.mark.parametrize("content", ['{"files": ', "[]", '{"files": []}', ""])
+def test_parse_invalid_manifest_fails(content):
+    with pytest.raises(DeploymentError, match="--full-upload"):
+        parse_manifest(content)
+
+
+def test_parse_large_manifest():
+    files = {f"static/{i:05d}/file.css": {"size": i, "mtime": i, "hash": f"{i:032x}"} for i in range(5000)}
+    assert parse_manifest(dump_manifest(files).decode()) == files
+
+
+def test_diff_manifests():
+    remote = {"same": {"hash": "1"}, "changed": {"hash": "2"}, "deleted": {"hash": "3"}, "rehash": {"hash": None}}
+    local = {"same": {"hash": "1"}, "changed": {"hash": "20"}, "new": {"hash": "4"}, "rehash": {"hash": "5"}}
+    assert diff_manifests(local, remote) == (["changed", "new", "rehash"], ["deleted"])
+
+
+def test_hash_cache_reuses_and_invalidates(tmp_path):
+    files = make_files(tmp_path / "project", {"a.py": b"a", "b.py": b"b"})
+    cache_path = tmp_path / "cache.json"
+    cache = HashCache.load(cache_path)
+    first = build_manifest(files, cache=cache)
+    cache.save()
+    assert json.loads(cache_path.read_text())["algorithm"] == HASH_ALGORITHM
+
+    cache = HashCache.load(cache_path)
+    assert set(cache.entries) == {"a.py", "b.py"}
+    stat = files[0][0].stat()
+    assert cache.lookup("a.py", stat) == first["a.py"]["hash"]
+
+    files[0][0].write_bytes(b"changed")
+    os.utime(files[0][0], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert cache.lookup("a.py", files[0][0].stat()) is None
+    second = build_manifest(files[1:], cache=cache)
+    assert second["b.py"]["hash"] == first["b.py"]["hash"]
+    # Files gone from the project leave the cache
+    assert set(cache.entries) == {"b.py"}
+
+
+def test_hash_cache_ignores_other_algorithm(tmp_path):
+    cache_path = tmp_path / "cache.json"
+    cache_path.write_text(json.dumps({"algorithm": "md5", "entries": {"a.py": [1, 2, 3, "x"]}}))
+    assert HashCache.load(cache_path).entries == {}
+    cache_path.write_text("not json")
+    assert HashCache.load(cache_path).entries == {}
@@ -0,0 +1,91 @@
+import time
+from pathlib import Path
+
+import pytest
+
+import django_prod
+from django_prod import mux
+from django_prod.remote import run_remote
+
+
+def test_socket_path_depends_on_the_key_and_port(tmp_path):
+    key = str(tmp_path / "id_ed25519")
+    path = mux.socket_path("203.0.113.10", "deploy", key)
+    assert path == mux.socket_path("203.0.113.10", "deploy", str(tmp_path / "." / "id_ed25519"), 22)
+    assert path != mux.socket_path("203.0.113.10", "deploy", str(tmp_path / "other_key"))
+    assert path != mux.socket_path("203.0.113.10", "deploy", key, 2222)
+    assert path != mux.socket_path("203.0.113.10", "root", key)
+    assert path.parent.stat().st_mode & 0o777 == 0o700
+
+
+@pytest.fixture
+def multiplexer(ssh_server, ssh_keys, tmp_path, monkeypatch):
+    """A multiplexer process connected to the SSH server stand-in, stopped after one idle second."""
+    key_path = str(tmp_path / "id_rsa")
+    ssh_keys[1].write_private_key_file(key_path)
+    monkeypatch.setenv("PYTHONPATH", str(Path(django_prod.__file__).parent.parent))
+
+    def connect():
+        return mux.connect("127.0.0.1", "deploy", key_path, persist=1, port=ssh_server.port)
+
+    client = connect()
+    yield client, connect
+    path = client.transport.path
+    deadline = time.monotonic() + 10
+    while path.exists() and time.monotonic() < deadline:
+        time.sleep(0.1)
+
+
+def test_commands_share_one_connection(multiplexer, ssh_server):
+    client, connect = multiplexer
+    _, stdout, stderr = client.exec_command("echo out; echo err >&2; exit 2")
+    assert (stdout.read(), stderr.read()) == (b"out\n", b"err\n")
+    assert stdout.channel.recv_exit_status() == 2
+
+    lines = []
+    assert run_remote(connect(), "seq 3", on_stdout=lines.append) == (0, "1\n2\n3", "")
+    assert lines == ["1", "2", "3"]
+    assert len(ssh_server.transports) == 1
+    assert client.transport.getpeername() == ("127.0.0.1", ssh_server.port)
+
+
+def test_interactive_channel(multiplexer):
+    client, _ = multiplexer
+    channel = client.get_transport().open_session()
+    channel.settimeout(10)
+    channel.exec_command('while read line; do echo "got $line"; done')
+    stdout = channel.makefile("rb")
+    for request in (b"one", b"two"):
+        channel.sendall(request + b"\n")
+        assert stdout.readline() == b"got " + request + b"\n"
+    channel.shutdown_write()
+    assert channel.recv_exit_status() == 0
+    channel.close()
+
+
+def test_liveness_is_cached(multiplexer, monkeypatch):
+    client, _ = multiplexer
+    pings = []
+    real_ping = mux.ping
+    monkeypatch.setattr(mux, "ping", lambda path: pings.append(path) or real_ping(path))
+
+    transport = client.get_transport()
+    transport.alive_at = None
+    assert transport.is_active() and transport.is_active()
+    assert len(pings) == 1
+    # An opened channel shows the multiplexer is alive as well
+    transport.alive_at = None
+    client.exec_command("true")[1].channel.recv_exit_status()
+    assert transport.is_active() and len(pings) == 1
+
+    transport.alive_at -= mux.LIVENESS_TTL
+    assert transport.is_active() and len(pings) == 2
+
+
+def test_a_stopped_multiplexer_is_not_active(tmp_path):
+    transport = mux.MuxTransport(tmp_path / "gone.sock", "203.0.113.10")
+    assert not transport.is_active()
+    transport.alive_at = time.monotonic()
+    with pytest.raises(OSError):
+        transport.open_session()
+    assert not transport.is_active()
@@ -0,0 +1,129 @@
+import threading
+import time
+
+import pytest
+
+from django_prod.exceptions import DeploymentError
+from django_prod.pipeline import Pipeline, Step
+
+
+def recording(log: list, name: str, delay: float = 0.0):
+    def run():
+        log.append(f"start {name}")
+        time.sleep(delay)
+        log.append(f"end {name}")
+
+    return run
+
+
+def test_order_and_validation():
+    pipeline = Pipeline([Step("launch", None, ["upload", "docker"]), Step("upload", None, ["connect"])])
+    pipeline.add(Step("connect", None))
+    pipeline.add(Step("docker", None, ["connect"]))
+    pipeline.add(Step("backup", None, ["connect"]), before=["launch"])
+    assert pipeline.order() == ["connect", "backup", "docker", "upload", "launch"]
+
+    with pytest.raises(DeploymentError, match="Duplicate"):
+        pipeline.add(Step("docker", None))
+    with pytest.raises(DeploymentError, match="unknown step missing"):
+        pipeline.add(Step("notify", None), before=["missing"])
+
+    pipeline.add(Step("orphan", None, ["nowhere"]))
+    with pytest.raises(DeploymentError, match="requires unknown step nowhere"):
+        pipeline.order()
+
+
+def test_cycle_is_reported():
+    pipeline = Pipeline([Step("a", None, ["b"]), Step("b", None, ["a"]), Step("c", None)])
+    with pytest.raises(DeploymentError, match="depend on each other: a, b"):
+        pipeline.order()
+
+
+def test_independent_steps_run_concurrently():
+    log = []
+    both_running = threading.Barrier(2, timeout=5)
+
+    def meet(name):
+        def run():
+            both_running.wait()
+            log.append(name)
+
+        return run
+
+    pipeline = Pipeline([
+        Step("connect", recording(log, "connect")),
+        Step("upload", meet("upload"), ["connect"]),
+        Step("docker", meet("docker"), ["connect"]),
+        Step("launch", recording(log, "launch"), ["upload", "docker"]),
+    ])
+    pipeline.run()
+    assert log[:2] == ["start connect", "end connect"]
+    assert set(log[2:4]) == {"upload", "docker"}
+    assert log[4:] == ["start launch", "end launch"]
+
+
+def test_failure_stops_scheduling():
+    log = []
+
+    def fail():
+        raise DeploymentError("upload failed")
+
+    pipeline = Pipeline([
+        Step("upload", fail),
+        Step("slow", recording(log, "slow", 0.1)),
+        Step("launch", recording(log, "launch"), ["upload"]),
+    ])
+    with pytest.raises(DeploymentError, match="upload failed"):
+        pipeline.run()
+    # The step already running finishes, the dependent one never starts
+    assert log == ["start slow", "end slow"]
+
+
+def test_retries_ask_recover():
+    attempts = []
+    recovered = []
+
+    def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise ConnectionResetError()
+
+    def recover(step, error):
+        recovered.append((step.name, type(error)))
+        return True
+
+    pipeline = Pipeline([Step("upload", flaky, retries=2)])
+    pipeline.run(recover)
+    assert len(attempts) == 3
+    assert recovered == [("upload", ConnectionResetError)] * 2
+
+
+def test_no_retry_without_retries_or_recovery():
+    def fail():
+        raise ConnectionResetError()
+
+    with pytest.raises(ConnectionResetError):
+        Pipeline([Step("custom", fail)]).run(lambda step, error: True)
+
+    step = Step("upload", fail, retries=3)
+    with pytest.raises(ConnectionResetError):
+        Pipeline([step]).run(lambda step, error: False)
+    assert step.attempts == 1
+
+    step = Step("upload", fail, retries=2)
+    with pytest.raises(ConnectionResetError):
+        Pipeline([step]).run(lambda step, error: True)
+    assert step.attempts == 3
+
+
+def test_critical_path():
+    pipeline = Pipeline([
+        Step("connect", lambda: None),
+        Step("docker", lambda: time.sleep(0.01), ["connect"]),
+        Step("upload", lambda: time.sleep(0.15), ["connect"]),
+        Step("launch", lambda: None, ["docker", "upload"]),
+    ])
+    assert pipeline.critical_path() == []
+    pipeline.run()
+    assert [step.name for step in pipeline.critical_path()] == ["connect", "upload", "launch"]
+    assert pipeline.steps["upload"].duration >= 0.15
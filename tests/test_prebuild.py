@@ -0,0 +1,43 @@
+from pathlib import Path
+
+import django_prod
+from django_prod.prebuild import dependency_stage, prebuild_image
+
+BOILERPLATE = Path(django_prod.__file__).parent / "templates" / "boilerplate" / "prod.Dockerfile.txt"
+
+
+def test_boilerplate_dockerfile():
+    dockerfile, sources = dependency_stage(BOILERPLATE.read_text())
+    assert sources == ["requirements.txt", "entrypoint.prod.sh"]
+    assert dockerfile.startswith("FROM python:")
+    assert "pip install -r requirements/prod.txt" in dockerfile
+    assert dockerfile.rstrip().endswith("RUN chmod +x /code/entrypoint.prod.sh")
+    assert "COPY . ." not in dockerfile
+
+
+def test_continuation_lines_and_comments():
+    dockerfile, sources = dependency_stage(
+        "# syntax\nFROM python:3.12\n\nCOPY --chown=app requirements.txt /tmp/\n"
+        "RUN pip install \\\n    -r /tmp/requirements.txt\nENV DEBUG=0\nCOPY . .\n"
+    )
+    assert sources == ["requirements.txt"]
+    assert dockerfile == "FROM python:3.12\nCOPY --chown=app requirements.txt /tmp/\n" \
+        "RUN pip install \\\n    -r /tmp/requirements.txt\n"
+
+
+def test_stops_at_the_next_stage_and_at_globs():
+    _, sources = dependency_stage("FROM node AS assets\nCOPY package.json .\nRUN npm ci\nFROM python\nRUN pip x\n")
+    assert sources == ["package.json"]
+    assert dependency_stage("FROM python\nCOPY requirements*.txt .\nRUN pip install -r requirements.txt\n") is None
+    assert dependency_stage('FROM python\nCOPY ["a", "b"]\nRUN true\n') is None
+
+
+def test_nothing_to_prebuild():
+    assert dependency_stage("FROM python\nCOPY . .\nRUN pip install .\n") is None
+    assert dependency_stage("FROM python\nENV A=1\n") is None
+    assert dependency_stage("") is None
+
+
+def test_prebuild_image():
+    assert prebuild_image("My_Site.") == "my_site-deps:prebuild"
+    assert prebuild_image("app name") == "app-name-deps:prebuild"
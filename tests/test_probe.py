@@ -0,0 +1,89 @@
+import json
+import os
+
+import pytest
+
+from django_prod import probe
+from django_prod.exceptions import DeploymentError
+from django_prod.probe import PROVISION_STATE_FILENAME, RemoteEnvironment, probe_remote
+
+
+@pytest.fixture
+def docker(tmp_path, monkeypatch):
+    """A `docker` on the PATH answering like one with the compose plugin, logging its calls."""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    calls = tmp_path / "docker.log"
+    (bin_dir / "docker").write_text(
+        f'#!/bin/sh\necho "$@" >> {calls}\n'
+        'case "$*" in\n'
+        '  --version) echo \'Docker version 27.1.1, build "abc"\';;\n'
+        '  "compose version --short") echo 2.29.1;;\n'
+        'esac\n'
+    )
+    (bin_dir / "docker").chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    return calls
+
+
+def test_probe_reports_the_environment(ssh_server, docker, tmp_path):
+    app = tmp_path / "srv" / "app"
+    ssh = ssh_server.connect()
+    try:
+        env = probe_remote(ssh, str(app))
+        assert app.is_dir()
+        assert env.docker == 'Docker version 27.1.1, build "abc"'
+        assert (env.compose, env.compose_version) == ("docker compose", "2.29.1")
+        assert env.provisioning is None and env.fingerprint
+        assert env.cpus >= 1 and env.memory_bytes > 0 and env.disk_free_bytes > 0
+        assert env.arch == os.uname().machine
+        assert env.tar and env.current_release is None
+
+        (app / "releases" / "20240101000000000000").mkdir(parents=True)
+        (app / "current").symlink_to("releases/20240101000000000000")
+        assert probe_remote(ssh, str(app)).current_release == "20240101000000000000"
+    finally:
+        ssh.close()
+
+
+def test_probe_trusts_matching_provisioning_state(ssh_server, docker, tmp_path):
+    app = tmp_path / "app"
+    ssh = ssh_server.connect()
+    try:
+        env = probe_remote(ssh, str(app))
+        (app / PROVISION_STATE_FILENAME).write_text(json.dumps(env.provisioning_state()))
+        docker.unlink()
+
+        trusted = probe_remote(ssh, str(app))
+        assert not docker.exists()
+        assert trusted.provisioning["fingerprint"] == env.fingerprint
+        assert (trusted.docker, trusted.compose) == (env.docker, env.compose)
+
+        assert probe_remote(ssh, str(app), trust_provisioning=False).provisioning is None
+        assert docker.exists()
+
+        # Another host (or reinstalled Docker) has another fingerprint
+        (app / PROVISION_STATE_FILENAME).write_text(json.dumps({**env.provisioning_state(), "fingerprint": "1"}))
+        assert probe_remote(ssh, str(app)).provisioning is None
+    finally:
+        ssh.close()
+
+
+def test_probe_failures(ssh_server, tmp_path, monkeypatch):
+    blocker = tmp_path / "file"
+    blocker.write_text("")
+    ssh = ssh_server.connect()
+    try:
+        with pytest.raises(DeploymentError, match=r"Could not probe the server \(exit code 1\): mkdir"):
+            probe_remote(ssh, str(blocker / "app"))
+        monkeypatch.setattr(probe, "probe_command", lambda *args: "echo 'Welcome!'")
+        with pytest.raises(DeploymentError, match="Unexpected output from the server probe: 'Welcome!'"):
+            probe_remote(ssh, str(tmp_path))
+    finally:
+        ssh.close()
+
+
+def test_remote_environment_defaults():
+    env = RemoteEnvironment({"cpus": "", "memory_bytes": 2 * 1024**3, "disk_free_bytes": 0, "arch": "aarch64"})
+    assert (env.cpus, env.docker, env.rsync, env.current_release) == (0, None, False, None)
+    assert env.describe() == "aarch64, 0 CPUs, 2.0 GiB RAM, 0.0 GiB free"
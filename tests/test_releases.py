@@ -0,0 +1,74 @@
+import subprocess
+
+import pytest
+
+from django_prod.exceptions import DeploymentError
+from django_prod.management.commands.django_prod_rollback import Command as RollbackCommand
+from django_prod.releases import (
+    CURRENT_LINK,
+    new_release_name,
+    prepare_release_command,
+    previous_release,
+    releases_to_prune,
+    switch_release_command,
+)
+
+
+def test_release_names_are_unique_and_increasing():
+    names = []
+    for _ in range(50):
+        names.append(new_release_name(names))
+    assert len(set(names)) == len(names)
+    assert names == sorted(names)
+
+
+def test_release_name_follows_a_release_from_the_future():
+    ahead = "29990101000000000000"
+    name = new_release_name(["20240101000000", ahead, "not-a-release"])
+    assert name == "29990101000000000001"
+    assert name > ahead
+
+
+def test_release_name_follows_second_resolution_names():
+    assert new_release_name(["29990101000000"]) == "29990101000000000001"
+    assert new_release_name(["20200101000000"]) > "20200101000000"
+
+
+def test_releases_to_prune_keeps_newest_and_current():
+    releases = ["20240101000000", "20240102000000", "20240103000000000000", "20240103000000000001"]
+    assert releases_to_prune(releases, "20240101000000", 2) == ["20240102000000"]
+    assert releases_to_prune(releases, "20240103000000000001", 3) == ["20240101000000"]
+    assert releases_to_prune(releases, None, 0) == releases[:-1][::-1]
+
+
+def test_previous_release():
+    releases = ["20240103000000000001", "20240101000000", "20240103000000000000"]
+    assert previous_release(releases, "20240103000000000001") == "20240103000000000000"
+    assert previous_release(releases, "20240103000000000000") == "20240101000000"
+    assert previous_release(releases, "20240101000000") is None
+    assert previous_release(releases, None) is None
+
+
+def test_rollback_without_previous_release():
+    with pytest.raises(DeploymentError, match="No previous release"):
+        RollbackCommand()._previous_release(["20240101000000"], "20240101000000")
+
+
+def run(command: str) -> subprocess.CompletedProcess:
+    return subprocess.run(["sh", "-c", command], capture_output=True, text=True)
+
+
+def test_prepare_release_never_replaces_a_release(tmp_path):
+    remote = str(tmp_path)
+    assert run(prepare_release_command(remote, "1", None)).returncode == 0
+    (tmp_path / "releases" / "1" / "app.py").write_text("live")
+    assert run(switch_release_command(remote, "1")).returncode == 0
+
+    assert run(prepare_release_command(remote, "2", "1")).returncode == 0
+    assert (tmp_path / "releases" / "2" / "app.py").read_text() == "live"
+
+    for previous in ("1", None):
+        result = run(prepare_release_command(remote, "1", previous))
+        assert result.returncode != 0
+        assert "already exists" in result.stderr
+    assert (tmp_path / CURRENT_LINK / "app.py").read_text() == "live"
@@ -0,0 +1,70 @@
+from django_prod.remote import OUTPUT_TAIL_BYTES, LineBuffer, OutputLog, output_tail, run_remote
+
+
+def test_line_buffer_splits_lines_across_chunks():
+    lines = []
+    buffer = LineBuffer(lines.append)
+    for data in (b"first li", b"ne\r\nsecond\nthi", b"rd"):
+        buffer.feed(data)
+    assert lines == ["first line", "second"]
+    buffer.flush()
+    assert lines == ["first line", "second", "third"]
+    assert buffer.text() == "first line\r\nsecond\nthird"
+
+
+def test_line_buffer_keeps_only_the_tail():
+    lines = []
+    buffer = LineBuffer(lines.append, limit=100)
+    for number in range(1000):
+        buffer.feed(f"line {number}\n".encode())
+    assert len(lines) == 1000
+    assert buffer.size <= 100
+    text = buffer.text()
+    assert text.startswith("[earlier output dropped]\nline ")
+    assert text.endswith("line 999")
+    # The partial first line is dropped, whole lines are kept
+    assert all(line.startswith("line ") for line in text.splitlines()[1:])
+
+
+def test_line_buffer_passes_on_overlong_lines():
+    lines = []
+    buffer = LineBuffer(lines.append, limit=10)
+    buffer.feed(b"\r" + b"=" * 20)
+    assert lines == ["\r" + "=" * 20]
+    assert buffer.pending == b""
+
+
+def test_output_tail():
+    assert output_tail("a\nb", lines=2) == "a\nb"
+    assert output_tail("\n".join(map(str, range(30))), lines=3) == "...\n27\n28\n29"
+
+
+def test_output_log(tmp_path):
+    log = OutputLog(tmp_path / "output.log")
+    first, second = log.command("echo hi"), log.command("false")
+    log.writer(first, "stdout")("hi")
+    log.writer(second, "stderr")("oops")
+    log.exit(second, 1)
+    log.close()
+    assert (tmp_path / "output.log").read_text().splitlines() == [
+        "[1] $ echo hi", "[2] $ false", "[1] hi", "[2!] oops", "[2] exit 1",
+    ]
+
+
+def test_run_remote_streams_and_keeps_the_tail(ssh_server):
+    lines, errors = [], []
+    ssh = ssh_server.connect()
+    try:
+        exit_code, out, err = run_remote(
+            ssh,
+            "i=0; while [ $i -lt 20000 ]; do echo line $i; i=$((i + 1)); done; echo failed >&2; exit 4",
+            on_stdout=lines.append,
+            on_stderr=errors.append,
+        )
+    finally:
+        ssh.close()
+    assert exit_code == 4
+    assert len(lines) == 20000 and lines[-1] == "line 19999"
+    assert len(out) <= OUTPUT_TAIL_BYTES + 100
+    assert out.startswith("[earlier output dropped]") and out.endswith("line 19999")
+    assert (err, errors) == ("failed", ["failed"])
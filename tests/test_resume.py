@@ -0,0 +1,89 @@
+import json
+
+import pytest
+
+from django_prod.management.commands.django_prod_deploy import Command
+from django_prod.resume import UploadCheckpoint
+
+MANIFEST = {"a.py": {"hash": "1"}, "b.py": {"hash": "2"}, "big.bin": {"hash": "3"}}
+
+
+def test_checkpoint_roundtrip(tmp_path):
+    path = tmp_path / "state.json"
+    checkpoint = UploadCheckpoint(path, "203.0.113.10", "/srv/app")
+    checkpoint.begin(MANIFEST, {"a.py"}, "20240102000000000000", "20240101000000000000")
+    checkpoint.file_done("b.py")
+    checkpoint.file_progress("big.bin", 4096)
+    checkpoint.save(force=True)
+
+    loaded = UploadCheckpoint.load(path, "203.0.113.10", "/srv/app")
+    assert (loaded.release, loaded.base) == ("20240102000000000000", "20240101000000000000")
+    assert loaded.resumable(MANIFEST, ["a.py", "b.py", "big.bin"]) == ({"a.py", "b.py"}, {"big.bin": 4096})
+
+    edited = {**MANIFEST, "b.py": {"hash": "20"}, "big.bin": {"hash": "30"}}
+    assert loaded.resumable(edited, ["a.py", "b.py", "big.bin"]) == ({"a.py"}, {})
+
+
+def test_checkpoint_of_another_target_is_ignored(tmp_path):
+    path = tmp_path / "state.json"
+    path.write_text(json.dumps({"vps_ip": "203.0.113.10", "remote_path": "/srv/app", "completed": {"a.py": "1"}}))
+    assert not UploadCheckpoint.load(path, "203.0.113.11", "/srv/app").has_progress
+    assert not UploadCheckpoint.load(path, "203.0.113.10", "/srv/other").has_progress
+    path.write_text("not json")
+    assert not UploadCheckpoint.load(path, "203.0.113.10", "/srv/app").has_progress
+
+
+def test_clear_removes_the_file(tmp_path):
+    path = tmp_path / "state.json"
+    checkpoint = UploadCheckpoint(path, "203.0.113.10", "/srv/app")
+    checkpoint.begin(MANIFEST, {"a.py"}, "1")
+    assert path.exists()
+    checkpoint.clear()
+    assert not path.exists() and not checkpoint.has_progress
+
+
+INTERRUPTED = "20240102000000000000"
+
+
+@pytest.fixture
+def deploy(tmp_path):
+    path = tmp_path / "state.json"
+    checkpoint = UploadCheckpoint(path, "203.0.113.10", "/srv/app")
+    checkpoint.begin(MANIFEST, {"a.py"}, INTERRUPTED, "20240101000000000000")
+
+    command = Command()
+    command.remote_path = "/srv/app"
+    command.full_upload = False
+    command.previous_release = "20240101000000000000"
+    command.checkpoint = UploadCheckpoint.load(path, "203.0.113.10", "/srv/app")
+    command.commands = []
+
+    def run_command(ssh, cmd, check=True, timeout=None):
+        command.commands.append(cmd)
+        return 0, INTERRUPTED if cmd.startswith("ls ") else "", ""
+
+    command._run_command = run_command
+    return command
+
+
+def test_resumes_release_seeded_from_current(deploy):
+    deploy._prepare_release(None)
+    assert deploy.release == INTERRUPTED
+    assert deploy.checkpoint.has_progress
+
+
+def test_does_not_resume_release_seeded_from_another_base(deploy):
+    # Another machine deployed while this upload was interrupted
+    deploy.previous_release = "20240103000000000000"
+    deploy._prepare_release(None)
+    assert deploy.release > INTERRUPTED
+    assert not deploy.checkpoint.has_progress
+    assert "cp -al /srv/app/releases/20240103000000000000 " in deploy.commands[-1]
+
+
+def test_full_upload_starts_afresh(deploy):
+    deploy.full_upload = True
+    deploy._prepare_release(None)
+    assert deploy.release > INTERRUPTED
+    assert not deploy.checkpoint.has_progress
+    assert "cp -al" not in deploy.commands[-1]
@@ -0,0 +1,70 @@
+import io
+import subprocess
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+from django_prod.rollout import HostOutput, health_check_command, make_batches, rollout_targets
+
+
+def test_rollout_targets():
+    assert rollout_targets({"vps_ip": "203.0.113.10", "ssh_user": "root"}) == []
+    config = {
+        "ssh_user": "deploy",
+        "path_to_ssh_key": "~/.ssh/id_ed25519",
+        "targets": [{"vps_ip": "203.0.113.10"}, {"vps_ip": "203.0.113.11", "ssh_user": "admin"}],
+    }
+    assert rollout_targets(config) == [
+        {"ssh_user": "deploy", "path_to_ssh_key": "~/.ssh/id_ed25519", "vps_ip": "203.0.113.10"},
+        {"ssh_user": "admin", "path_to_ssh_key": "~/.ssh/id_ed25519", "vps_ip": "203.0.113.11"},
+    ]
+
+
+def test_make_batches():
+    assert make_batches([1, 2, 3, 4, 5], 2) == [[1, 2], [3, 4], [5]]
+    assert make_batches([1, 2], 0) == [[1], [2]]
+    assert make_batches([], 3) == []
+
+
+def test_host_output_prefixes_whole_lines():
+    stream = io.StringIO()
+    output = HostOutput(stream, "web-1", threading.Lock())
+    output.write("Uploading")
+    assert stream.getvalue() == ""
+    output.write(" files\n    building layer 1\n\nDone\n")
+    assert stream.getvalue() == "web-1 | Uploading files\nweb-1 | Done\n"
+
+    stream = io.StringIO()
+    HostOutput(stream, "web-2", threading.Lock(), verbose=True).write("Build\n    step 1/4\n")
+    assert stream.getvalue() == "web-2 | Build\nweb-2 |     step 1/4\n"
+
+
+@pytest.fixture
+def http_server():
+    class NotFound(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_error(404)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), NotFound)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}/"
+    server.shutdown()
+    server.server_close()
+
+
+def test_health_check_accepts_client_errors(http_server):
+    result = subprocess.run(["sh", "-c", health_check_command(http_server, 10)], capture_output=True, text=True)
+    assert result.returncode == 0
+    assert result.stdout.strip() == f"HTTP 404 from {http_server}"
+
+
+def test_health_check_times_out():
+    # Nothing listens on the discard port
+    url = "http://127.0.0.1:9/"
+    result = subprocess.run(["sh", "-c", health_check_command(url, 0)], capture_output=True, text=True)
+    assert result.returncode == 1
+    assert result.stdout.startswith(f"No healthy answer from {url} after 0s")
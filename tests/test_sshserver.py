@@ -0,0 +1,17 @@
+def test_interactive_command(ssh_server):
+    ssh = ssh_server.connect()
+    channel = ssh.get_transport().open_session()
+    try:
+        channel.settimeout(10)
+        channel.exec_command('while read line; do echo "got $line"; done; echo done >&2; exit 3')
+        stdout = channel.makefile("rb")
+        for request in (b"one", b"two"):
+            # Each answer comes before the next request is sent
+            channel.sendall(request + b"\n")
+            assert stdout.readline() == b"got " + request + b"\n"
+        channel.shutdown_write()
+        assert channel.makefile_stderr("rb").read() == b"done\n"
+        assert channel.recv_exit_status() == 3
+    finally:
+        channel.close()
+        ssh.close()
@@ -0,0 +1,67 @@
+import os
+
+import paramiko
+
+from django_prod.transfer import read_remote_file
+from django_prod.tuning import (
+    DEFAULT_SSH_SETTINGS,
+    PACKET_SIZE_CANDIDATES,
+    WINDOW_SIZE_CANDIDATES,
+    measure_throughput,
+    supported_ciphers,
+    tune_ssh,
+)
+
+
+def test_measure_throughput(ssh_server):
+    ssh = ssh_server.connect()
+    try:
+        rate = measure_throughput(ssh, os.urandom(512 * 1024))
+    finally:
+        ssh.close()
+    assert rate > 0
+    assert ssh_server.commands == ["cat > /dev/null"]
+
+
+def test_tuned_settings_are_negotiated(ssh_server):
+    cipher = supported_ciphers()[-1]
+    settings = {**DEFAULT_SSH_SETTINGS, "cipher": cipher, "window_size": WINDOW_SIZE_CANDIDATES[-1]}
+    ssh = ssh_server.connect(settings)
+    try:
+        transport = ssh.get_transport()
+        assert transport.local_cipher == cipher
+        assert transport.default_window_size == WINDOW_SIZE_CANDIDATES[-1]
+    finally:
+        ssh.close()
+
+
+def test_tune_ssh_picks_measured_settings(ssh_server):
+    messages = []
+    best = tune_ssh(ssh_server.connect, os.urandom(256 * 1024), log=messages.append)
+    assert best["throughput"] > 0
+    assert best["cipher"] in (None, *supported_ciphers())
+    assert best["window_size"] in WINDOW_SIZE_CANDIDATES
+    assert best["max_packet_size"] in PACKET_SIZE_CANDIDATES
+    assert best["compress"] in (False, True)
+    assert messages and not any("failed" in message for message in messages)
+
+
+def test_tune_ssh_without_connection():
+    def connect(settings):
+        raise paramiko.SSHException("refused")
+
+    messages = []
+    best = tune_ssh(connect, b"x", log=messages.append)
+    assert best["throughput"] == 0.0
+    assert all("failed (refused)" in message for message in messages)
+
+
+def test_read_remote_file_is_not_truncated(ssh_server, tmp_path):
+    data = os.urandom(300 * 1024)
+    (tmp_path / "manifest").write_bytes(data)
+    ssh = ssh_server.connect()
+    try:
+        assert read_remote_file(ssh, str(tmp_path / "manifest")) == data
+        assert read_remote_file(ssh, str(tmp_path / "missing")) is None
+    finally:
+        ssh.close()
@@ -0,0 +1,104 @@
+import shutil
+import sys
+import time
+
+import pytest
+
+from django_prod.ignore import IgnoreMatcher
+from django_prod.watch import InotifyWatcher, PollingWatcher, batches
+
+
+def write(root, relative: str, data: str = "x"):
+    path = root / relative
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(data)
+
+
+def collect(watcher) -> set[str]:
+    """Every path reported until the watcher goes quiet."""
+    changed = set()
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        more = watcher.poll(timeout=1.2 if isinstance(watcher, PollingWatcher) else 0.3)
+        if not more and changed:
+            break
+        changed |= more
+    return changed
+
+
+@pytest.fixture(params=["inotify", "polling"])
+def make_watcher(request):
+    watchers = []
+
+    def make(root):
+        if request.param == "inotify":
+            if not sys.platform.startswith("linux"):
+                pytest.skip("inotify is Linux only")
+            watcher = InotifyWatcher(root, IgnoreMatcher.for_project(root))
+        else:
+            watcher = PollingWatcher(root, IgnoreMatcher.for_project(root))
+        watchers.append(watcher)
+        return watcher
+
+    yield make
+    for watcher in watchers:
+        watcher.close()
+
+
+def test_file_changes(tmp_path, make_watcher):
+    write(tmp_path, "app/views.py")
+    write(tmp_path, "app/old.py")
+    watcher = make_watcher(tmp_path)
+    time.sleep(0.01)
+    write(tmp_path, "app/views.py", "changed")
+    write(tmp_path, "app/new.py")
+    (tmp_path / "app/old.py").unlink()
+    write(tmp_path, "app/__pycache__/views.pyc")
+    assert collect(watcher) == {"app/views.py", "app/new.py", "app/old.py"}
+
+
+def test_renamed_directory_reports_old_and_new_files(tmp_path, make_watcher):
+    write(tmp_path, "app/foo/a.py")
+    write(tmp_path, "app/foo/sub/b.py")
+    watcher = make_watcher(tmp_path)
+    (tmp_path / "app/foo").rename(tmp_path / "app/bar")
+    assert collect(watcher) == {"app/foo/a.py", "app/foo/sub/b.py", "app/bar/a.py", "app/bar/sub/b.py"}
+
+    # The moved directory is watched under its new name
+    write(tmp_path, "app/bar/sub/b.py", "changed")
+    assert collect(watcher) == {"app/bar/sub/b.py"}
+
+
+def test_directory_moved_out_of_the_project(tmp_path, make_watcher):
+    project = tmp_path / "project"
+    write(project, "app/foo/a.py")
+    write(project, "manage.py")
+    watcher = make_watcher(project)
+    (project / "app/foo").rename(tmp_path / "elsewhere")
+    assert collect(watcher) == {"app/foo/a.py"}
+
+    # Changes outside the project are no longer reported
+    write(tmp_path, "elsewhere/a.py", "changed")
+    write(project, "manage.py", "changed")
+    assert collect(watcher) == {"manage.py"}
+
+
+def test_deleted_directory(tmp_path, make_watcher):
+    write(tmp_path, "static/css/site.css")
+    write(tmp_path, "static/js/site.js")
+    watcher = make_watcher(tmp_path)
+    shutil.rmtree(tmp_path / "static")
+    assert collect(watcher) == {"static/css/site.css", "static/js/site.js"}
+
+
+def test_batches_debounces_bursts(tmp_path):
+    class Scripted:
+        def __init__(self):
+            self.events = [set(), {"a.py"}, {"b.py"}, set(), {"c.py"}, set()]
+
+        def poll(self, timeout):
+            return self.events.pop(0)
+
+    stream = batches(Scripted())
+    assert next(stream) == {"a.py", "b.py"}
+    assert next(stream) == {"c.py"}